@@ -1,4 +1,9 @@
-from ezypanel import create_app
+from dotenv import load_dotenv
+
+# Load .env before ezypanel.config reads the environment.
+load_dotenv()
+
+from ezypanel import create_app  # noqa: E402
 
 app = create_app()
 
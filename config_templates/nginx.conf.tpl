@@ -1,6 +1,8 @@
 server {
     listen 80;
+    {{TLS}}
     server_name {{HOSTNAME}};
+    {{TRAFFIC_LIMITS}}
     root {{DOCUMENT_ROOT}};
     index index.php index.html;
 
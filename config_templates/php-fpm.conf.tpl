@@ -13,6 +13,10 @@ pm.min_spare_servers = 1
 pm.max_spare_servers = 3
 pm.max_requests = 500
 
+ping.path = {{PING_PATH}}
+ping.response = {{PING_RESPONSE}}
+{{MONITORING_DIRECTIVES}}
+
 php_admin_value[memory_limit] = 256M
 php_admin_value[upload_max_filesize] = 64M
 php_admin_value[post_max_size] = 64M
@@ -20,8 +24,7 @@ php_admin_value[max_execution_time] = 300
 php_admin_value[max_input_time] = 300
 php_admin_value[request_terminate_timeout] = 300
 
-php_admin_value[session.save_path] = /app/data/var/wwww/{{HOSTNAME}}/sessions
-php_admin_value[session.save_handler] = files
+{{SESSION_DIRECTIVES}}
 php_admin_value[session.gc_maxlifetime] = 1440
 php_admin_value[session.cookie_httponly] = 1
 php_admin_value[session.cookie_secure] = 1
@@ -1,14 +1,31 @@
-from flask import Flask
-from dotenv import load_dotenv
+from __future__ import annotations
+
 import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:  # pragma: no cover - typing only
+    from flask import Flask
+
+    from .config import Config
+
+# Database URIs whose directories and schema were already prepared in this
+# process. Under ``gunicorn --preload`` the master fills this in before
+# forking, so workers inherit it and skip bootstrap entirely.
+_bootstrapped: set[str] = set()
 
-from .config import Config
-from .extensions import db
-from .routes import panel_bp
 
-def create_app(config_class: type[Config] = Config) -> Flask:
-    load_dotenv()
-    Config.ensure_directories()
+def create_app(config_class: type[Config] | None = None, bootstrap_app: bool = True) -> Flask:
+    # Flask, SQLAlchemy and the views are imported here rather than at module
+    # level so ``import ezypanel`` stays free of work and side effects.
+    from flask import Flask
+
+    from .api import api_bp
+    from .commands import panel_cli
+    from .config import Config
+    from .extensions import db
+    from .routes import panel_bp
+
+    config_class = config_class or Config
 
     app = Flask(__name__)
     app.config.from_object(config_class)
@@ -26,8 +43,91 @@ def create_app(config_class: type[Config] = Config) -> Flask:
 
     db.init_app(app)
 
-    with app.app_context():
-        db.create_all()
+    if bootstrap_app:
+        bootstrap(app, config_class)
 
     app.register_blueprint(panel_bp, url_prefix="/panel")
+    app.register_blueprint(api_bp, url_prefix="/panel/api/v1")
+    app.cli.add_command(panel_cli)
     return app
+
+
+def bootstrap(app: Flask, config_class: type[Config] | None = None) -> None:
+    """Create data directories and the database schema once per process.
+
+    Safe to call repeatedly; only the first call for a given database does
+    any work. Pooled database connections are disposed afterwards so nothing
+    opened here is shared with forked gunicorn workers.
+    """
+
+    from .config import Config
+    from .extensions import db
+
+    database_uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if database_uri in _bootstrapped:
+        return
+
+    (config_class or Config).ensure_directories()
+    with app.app_context():
+        db.create_all()
+        _upgrade_schema()
+        _finish_pool_drains()
+        _index_snapshot_objects()
+        db.engine.dispose()
+    _bootstrapped.add(database_uri)
+
+
+def _upgrade_schema() -> None:
+    """Add columns introduced after a table was first created.
+
+    ``db.create_all`` only creates missing tables, so existing panel databases
+    would otherwise miss newly added nullable/defaulted columns.
+    """
+
+    from sqlalchemy import inspect, text
+
+    from .extensions import db
+
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in present:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            default = column.default.arg if column.default is not None else None
+            if isinstance(default, bool):
+                ddl += f" DEFAULT {int(default)}"
+            elif isinstance(default, (int, float)):
+                ddl += f" DEFAULT {default}"
+            elif isinstance(default, str):
+                ddl += " DEFAULT '{}'".format(default.replace("'", "''"))
+            logging.getLogger(__name__).info("schema_upgrade %s", ddl)
+            with db.engine.begin() as connection:
+                connection.execute(text(ddl))
+
+
+def _finish_pool_drains() -> None:
+    """Finish blue pool drains left over from a previous run."""
+
+    from .migration import finish_due_drains
+
+    for drain, result in finish_due_drains():
+        if not result.success:
+            logging.getLogger(__name__).warning(
+                "pool_drain_pending hostname=%s pool=%s error=%s", drain.hostname, drain.pool_path, result.message
+            )
+
+
+def _index_snapshot_objects() -> None:
+    """Build the snapshot object index for stores that predate it."""
+
+    from .models import Snapshot, SnapshotObject
+    from .snapshots import rebuild_object_index
+
+    if SnapshotObject.query.first() is None and Snapshot.query.first() is not None:
+        rebuild_object_index()
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+from dataclasses import asdict
+from typing import Callable
+
+from flask import Blueprint, Response, abort, jsonify, request
+
+from .fpm_status import samples_path, saturation, slowlog_timeout
+from .locks import lock_metrics
+from .models import DiskUsage, Domain
+from .sessions import session_backend
+from .traffic import SETTINGS as TRAFFIC_SETTINGS
+from .traffic import body_limit_mb, setting
+from .services import (
+    available_extensions,
+    detect_php_versions,
+    detect_pool_enabled_extensions,
+    read_file,
+)
+
+api_bp = Blueprint("api", __name__)
+logger = logging.getLogger(__name__)
+
+
+def _file_token(path: str | None) -> str:
+    try:
+        stat_result = os.stat(path) if path else None
+    except OSError:
+        stat_result = None
+    if stat_result is None:
+        return "-"
+    return f"{stat_result.st_mtime_ns}:{stat_result.st_size}"
+
+
+def _php_conf_token(version: str, sapi: str) -> str:
+    """Changes when an extension is enabled or disabled for ``sapi`` (phpenmod)."""
+
+    return _file_token(f"/etc/php/{version}/{sapi}/conf.d")
+
+
+def _make_etag(*parts: object) -> str:
+    return hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()[:20]
+
+
+def _conditional(etag: str, build: Callable[[], object], max_age: int = 0) -> Response:
+    """Answer 304 when the client's ETag matches, otherwise build the payload.
+
+    ``build`` only runs on a miss, so unchanged resources never read config
+    files or probe PHP.
+    """
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"private, max-age={max_age}, must-revalidate"
+    return response
+
+
+def _domain_etag(domain: Domain) -> str:
+    usage = domain.disk_usage
+    return _make_etag(
+        domain.id,
+        domain.updated_at.isoformat() if domain.updated_at else "",
+        domain.enabled,
+        usage.scanned_at if usage else "",
+        _file_token(domain.nginx_config_path),
+        _file_token(domain.php_fpm_pool_path),
+    )
+
+
+def _domain_payload(domain: Domain) -> dict:
+    usage = domain.disk_usage
+    return {
+        "id": domain.id,
+        "hostname": domain.hostname,
+        "enabled": domain.enabled,
+        "php_version": domain.php_version,
+        "document_root": domain.document_root,
+        "nginx_config_path": domain.nginx_config_path,
+        "php_fpm_pool_path": domain.php_fpm_pool_path,
+        "php_socket_path": domain.php_socket_path,
+        "notes": domain.notes,
+        "disk_quota_mb": domain.disk_quota_mb,
+        "session_backend": session_backend(domain),
+        "slowlog_timeout_s": slowlog_timeout(domain),
+        "disk_usage_bytes": usage.total_bytes if usage else None,
+        "limits": {
+            "cpu_weight": domain.cpu_weight,
+            "cpu_max_percent": domain.cpu_max_percent,
+            "memory_high_mb": domain.memory_high_mb,
+            "memory_max_mb": domain.memory_max_mb,
+            "pids_max": domain.pids_max,
+        },
+        "traffic": {
+            field: setting(domain, field) for field in TRAFFIC_SETTINGS if field != "client_max_body_mb"
+        }
+        | {"client_max_body_mb": body_limit_mb(domain)},
+        "tls": {
+            "source": domain.certificate.source,
+            "names": domain.certificate.names,
+            "not_after": domain.certificate.not_after.isoformat() if domain.certificate.not_after else None,
+            "ocsp_stapling": domain.certificate.has_chain,
+        }
+        if domain.certificate
+        else None,
+        "created_at": domain.created_at.isoformat() if domain.created_at else None,
+        "updated_at": domain.updated_at.isoformat() if domain.updated_at else None,
+    }
+
+
+@api_bp.errorhandler(404)
+def not_found(error):
+    return jsonify(error="not found"), 404
+
+
+@api_bp.route("/domains")
+def list_domains():
+    rows = (
+        Domain.query.outerjoin(DiskUsage)
+        .with_entities(Domain.id, Domain.updated_at, Domain.enabled, DiskUsage.scanned_at)
+        .order_by(Domain.id.asc())
+        .all()
+    )
+    etag = _make_etag(*(f"{row.id}:{row.updated_at}:{row.enabled}:{row.scanned_at}" for row in rows))
+
+    def build() -> dict:
+        domains = Domain.query.order_by(Domain.hostname.asc()).all()
+        return {"domains": [_domain_payload(domain) for domain in domains]}
+
+    return _conditional(etag, build)
+
+
+@api_bp.route("/domains/<int:domain_id>")
+def get_domain(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    return _conditional(_domain_etag(domain), lambda: _domain_payload(domain))
+
+
+@api_bp.route("/domains/<int:domain_id>/config/<kind>")
+def get_domain_config(domain_id: int, kind: str):
+    domain = Domain.query.get_or_404(domain_id)
+    paths = {"nginx": domain.nginx_config_path, "php": domain.php_fpm_pool_path}
+    if kind not in paths:
+        abort(404)
+    path = paths[kind]
+    etag = _make_etag(kind, path, _file_token(path))
+    return _conditional(etag, lambda: {"kind": kind, "path": path, "content": read_file(path)})
+
+
+@api_bp.route("/domains/<int:domain_id>/extensions")
+def get_domain_extensions(domain_id: int):
+    """Slow sub-resource: asks the running pool which extensions it loaded."""
+
+    domain = Domain.query.get_or_404(domain_id)
+    logger.debug("api_domain_extensions domain_id=%s socket=%s", domain_id, domain.php_socket_path)
+    # Built from stats only, so a matching client never triggers the probe.
+    etag = _make_etag(
+        domain.php_version,
+        domain.php_socket_path,
+        _file_token(domain.php_fpm_pool_path),
+        _php_conf_token(domain.php_version, "fpm"),
+        _php_conf_token(domain.php_version, "cli"),
+    )
+    return _conditional(
+        etag,
+        lambda: {
+            "php_version": domain.php_version,
+            "available": available_extensions(domain.php_version),
+            "enabled": detect_pool_enabled_extensions(domain.php_socket_path),
+        },
+        max_age=30,
+    )
+
+
+@api_bp.route("/metrics/locks")
+def get_lock_metrics():
+    """Lock wait counters of the worker that answers (one gunicorn process)."""
+
+    response = jsonify(lock_metrics())
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+@api_bp.route("/fpm/saturation")
+def get_fpm_saturation():
+    hostnames = [row.hostname for row in Domain.query.with_entities(Domain.hostname).order_by(Domain.hostname.asc())]
+    etag = _make_etag(_file_token(str(samples_path())), *hostnames)
+
+    def build() -> dict:
+        return {
+            "pools": {
+                hostname: asdict(summary) | {"saturated": summary.saturated}
+                for hostname, summary in saturation(hostnames).items()
+            }
+        }
+
+    return _conditional(etag, build)
+
+
+@api_bp.route("/php/versions")
+def get_php_versions():
+    versions = detect_php_versions()
+    return _conditional(_make_etag(*versions), lambda: {"versions": versions}, max_age=60)
+
+
+@api_bp.route("/php/versions/<version>/extensions")
+def get_php_version_extensions(version: str):
+    if version not in detect_php_versions():
+        abort(404)
+    etag = _make_etag(version, _php_conf_token(version, "cli"))
+    return _conditional(etag, lambda: {"version": version, "extensions": available_extensions(version)}, max_age=60)
@@ -0,0 +1,300 @@
+from __future__ import annotations
+
+import errno
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .extensions import db
+from .models import Domain
+from .services import CommandResult, _config_value, _simulate
+
+logger = logging.getLogger(__name__)
+
+CONTROLLERS = ("cpu", "memory", "pids")
+PROC_ROOT = Path("/proc")
+# php-fpm rewrites each worker's argv to this title.
+WORKER_TITLE = "php-fpm: pool "
+
+
+@dataclass
+class CgroupUsage:
+    cpu_usage_usec: int = 0
+    cpu_throttled_usec: int = 0
+    nr_throttled: int = 0
+    memory_current: int = 0
+    memory_events: dict[str, int] = field(default_factory=dict)
+    pids_current: int = 0
+
+    @property
+    def cpu_seconds(self) -> float:
+        return round(self.cpu_usage_usec / 1_000_000, 1)
+
+    @property
+    def throttled_seconds(self) -> float:
+        return round(self.cpu_throttled_usec / 1_000_000, 1)
+
+    @property
+    def memory_mb(self) -> float:
+        return round(self.memory_current / (1024 * 1024), 1)
+
+
+def _mount() -> Path:
+    return Path(_config_value("CGROUP_MOUNT"))
+
+
+def cgroup_supported() -> bool:
+    """True when a writable cgroup v2 hierarchy is available to the panel."""
+
+    if _simulate():
+        return False
+    return (_mount() / "cgroup.controllers").exists()
+
+
+def parent_cgroup() -> Path:
+    return _mount() / _config_value("CGROUP_PARENT", "ezypanel")
+
+
+def domain_cgroup(hostname: str) -> Path:
+    return parent_cgroup() / hostname
+
+
+def limit_values(domain: Domain) -> dict[str, str]:
+    """Map a domain's limits onto cgroup v2 interface files ("max" = unlimited)."""
+
+    period = int(_config_value("CGROUP_CPU_PERIOD_US", 100000))
+    cpu_max = "max"
+    if domain.cpu_max_percent:
+        cpu_max = str(max(domain.cpu_max_percent * period // 100, 1000))
+
+    def _megabytes(value: int | None) -> str:
+        return str(value * 1024 * 1024) if value else "max"
+
+    return {
+        "cpu.weight": str(domain.cpu_weight or 100),
+        "cpu.max": f"{cpu_max} {period}",
+        "memory.high": _megabytes(domain.memory_high_mb),
+        "memory.max": _megabytes(domain.memory_max_mb),
+        "pids.max": str(domain.pids_max) if domain.pids_max else "max",
+    }
+
+
+def _evacuate(cgroup: Path) -> int:
+    """Move every process of ``cgroup`` into its leaf child (``EZYPANEL_CGROUP_LEAF``).
+
+    cgroup v2 only lets a cgroup hand controllers to its children while it
+    has no processes of its own. Under ``--cgroupns=private`` the namespace
+    root is such a cgroup, holding supervisord, nginx and the FPM masters.
+    """
+
+    leaf = cgroup / _config_value("CGROUP_LEAF", "panel")
+    leaf.mkdir(exist_ok=True)
+    moved = 0
+    for pid in (cgroup / "cgroup.procs").read_text().split():
+        try:
+            (leaf / "cgroup.procs").write_text(pid)
+        except ProcessLookupError:
+            continue
+        moved += 1
+    logger.info("cgroup_evacuate cgroup=%s leaf=%s moved=%s", cgroup, leaf, moved)
+    return moved
+
+
+def _enable_controllers(cgroup: Path, evacuate: bool = False) -> None:
+    available = set((cgroup / "cgroup.controllers").read_text().split())
+    enabled = set((cgroup / "cgroup.subtree_control").read_text().split())
+    missing = [name for name in CONTROLLERS if name in available and name not in enabled]
+    if not missing:
+        return
+    request = " ".join(f"+{name}" for name in missing)
+    try:
+        (cgroup / "cgroup.subtree_control").write_text(request)
+    except OSError as exc:
+        if exc.errno != errno.EBUSY or not evacuate:
+            raise
+        _evacuate(cgroup)
+        (cgroup / "cgroup.subtree_control").write_text(request)
+
+
+def _ensure_parent() -> None:
+    parent = parent_cgroup()
+    _enable_controllers(_mount(), evacuate=True)
+    parent.mkdir(exist_ok=True)
+    _enable_controllers(parent)
+
+
+def pool_worker_pids() -> dict[str, list[int]]:
+    """Group running php-fpm worker pids by pool name using ``/proc``.
+
+    Masters are left alone: they are shared by every pool of a version
+    (or shard), so only workers can be attributed to a domain.
+    """
+
+    pools: dict[str, list[int]] = {}
+    for entry in PROC_ROOT.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            cmdline = (entry / "cmdline").read_bytes()
+        except OSError:
+            continue
+        title = cmdline.replace(b"\0", b" ").decode(errors="replace").strip()
+        if title.startswith(WORKER_TITLE):
+            pools.setdefault(title[len(WORKER_TITLE):].strip(), []).append(int(entry.name))
+    return pools
+
+
+def _attach(cgroup: Path, pids: list[int]) -> int:
+    current = set((cgroup / "cgroup.procs").read_text().split())
+    moved = 0
+    for pid in pids:
+        if str(pid) in current:
+            continue
+        try:
+            # The kernel accepts a single pid per write.
+            (cgroup / "cgroup.procs").write_text(str(pid))
+        except ProcessLookupError:
+            continue
+        moved += 1
+    return moved
+
+
+def apply_limits(domain: Domain, worker_pids: dict[str, list[int]] | None = None) -> CommandResult:
+    """Create the domain's cgroup, write its limits and attach its pool workers."""
+
+    if not cgroup_supported():
+        return CommandResult(True, stdout="Limits saved; cgroup v2 is not available here.")
+
+    cgroup = domain_cgroup(domain.hostname)
+    try:
+        _ensure_parent()
+        cgroup.mkdir(exist_ok=True)
+        for name, value in limit_values(domain).items():
+            interface = cgroup / name
+            if interface.exists():
+                interface.write_text(value)
+        if worker_pids is None:
+            worker_pids = pool_worker_pids()
+        moved = _attach(cgroup, worker_pids.get(domain.hostname, []))
+    except OSError as exc:
+        logger.warning("cgroup_apply failed hostname=%s error=%s", domain.hostname, exc)
+        if exc.errno == errno.EBUSY:
+            return CommandResult(
+                False,
+                stderr=(
+                    f"cgroup update failed: controllers cannot be enabled under {_mount()} while it "
+                    f"still holds processes that could not be moved to a leaf cgroup ({exc})."
+                ),
+            )
+        return CommandResult(False, stderr=f"cgroup update failed: {exc}")
+
+    logger.debug("cgroup_apply hostname=%s moved=%s", domain.hostname, moved)
+    return CommandResult(True, stdout=f"Limits applied to {cgroup} ({moved} worker(s) moved).")
+
+
+def sync_all() -> list[tuple[Domain, CommandResult]]:
+    """Re-apply every domain's limits and attach newly spawned workers.
+
+    FPM forks workers from its master, so respawned workers start outside the
+    domain's cgroup; the ``panel cgroups --watch`` loop moves them back.
+    """
+
+    worker_pids = pool_worker_pids() if cgroup_supported() else {}
+    domains = Domain.query.order_by(Domain.hostname.asc()).all()
+    return [(domain, apply_limits(domain, worker_pids)) for domain in domains]
+
+
+def watch(iterations: int | None = None) -> None:
+    """Run :func:`sync_all` every ``EZYPANEL_CGROUP_SYNC_INTERVAL`` seconds.
+
+    Workers recycled by ``pm.max_requests`` are respawned in the master's
+    cgroup, so the limits only hold while this loop keeps moving them back.
+    """
+
+    interval = float(_config_value("CGROUP_SYNC_INTERVAL", 10))
+    count = 0
+    while iterations is None or count < iterations:
+        started = time.monotonic()
+        try:
+            for domain, result in sync_all():
+                if not result.success:
+                    logger.warning("cgroup_sync failed hostname=%s error=%s", domain.hostname, result.message)
+        finally:
+            db.session.remove()
+        count += 1
+        if iterations is None or count < iterations:
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+def _read_keyed(path: Path) -> dict[str, int]:
+    values: dict[str, int] = {}
+    try:
+        lines = path.read_text().splitlines()
+    except OSError:
+        return values
+    for line in lines:
+        key, _, value = line.partition(" ")
+        if value.strip().isdigit():
+            values[key] = int(value)
+    return values
+
+
+def _read_int(path: Path) -> int:
+    try:
+        return int(path.read_text().strip())
+    except (OSError, ValueError):
+        return 0
+
+
+def read_usage(domain: Domain) -> CgroupUsage | None:
+    if not cgroup_supported():
+        return None
+    cgroup = domain_cgroup(domain.hostname)
+    if not cgroup.is_dir():
+        return None
+
+    cpu = _read_keyed(cgroup / "cpu.stat")
+    return CgroupUsage(
+        cpu_usage_usec=cpu.get("usage_usec", 0),
+        cpu_throttled_usec=cpu.get("throttled_usec", 0),
+        nr_throttled=cpu.get("nr_throttled", 0),
+        memory_current=_read_int(cgroup / "memory.current"),
+        memory_events=_read_keyed(cgroup / "memory.events"),
+        pids_current=_read_int(cgroup / "pids.current"),
+    )
+
+
+def _master_cgroup(pid: int) -> Path | None:
+    try:
+        stat = (PROC_ROOT / str(pid) / "stat").read_text()
+        parent = stat.rsplit(")", 1)[1].split()[1]
+        membership = (PROC_ROOT / parent / "cgroup").read_text()
+    except (OSError, IndexError):
+        return None
+    for line in membership.splitlines():
+        if line.startswith("0::"):
+            return _mount() / line[3:].lstrip("/")
+    return None
+
+
+def remove_cgroup(domain: Domain) -> None:
+    """Hand remaining workers back to their master's cgroup and remove ours."""
+
+    if not cgroup_supported():
+        return
+    cgroup = domain_cgroup(domain.hostname)
+    if not cgroup.is_dir():
+        return
+    try:
+        for pid in (cgroup / "cgroup.procs").read_text().split():
+            target = _master_cgroup(int(pid))
+            if target is not None and target != cgroup:
+                try:
+                    (target / "cgroup.procs").write_text(pid)
+                except ProcessLookupError:
+                    pass
+        os.rmdir(cgroup)
+    except OSError as exc:
+        logger.warning("cgroup_remove failed hostname=%s error=%s", domain.hostname, exc)
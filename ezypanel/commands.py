@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import click
+from flask.cli import AppGroup
+
+panel_cli = AppGroup("panel", help="EzyPanel maintenance commands.")
+
+
+@panel_cli.command("disk-usage")
+@click.option("--force", is_flag=True, help="Ignore the size index and rescan everything.")
+def disk_usage_command(force: bool) -> None:
+    """Refresh per-domain disk usage and report quota alerts."""
+
+    from .disk_usage import refresh_all_disk_usage
+
+    for usage in refresh_all_disk_usage(force=force):
+        line = f"{usage.domain.hostname}: {usage.total_mb} MB"
+        if usage.alerts:
+            line += " [" + "; ".join(usage.alerts) + "]"
+        click.echo(line)
+
+
+@panel_cli.command("rotate-logs")
+@click.option("--force", is_flag=True, help="Rotate every non-empty log regardless of policy.")
+def rotate_logs_command(force: bool) -> None:
+    """Rotate due domain logs and compress them."""
+
+    from .logrotate import rotate_logs, wait_for_compression
+
+    result = rotate_logs(force=force)
+    click.echo(result.message)
+    wait_for_compression()
+
+
+@panel_cli.command("sessions-gc")
+@click.option("--watch", is_flag=True, help="Keep collecting every EZYPANEL_SESSION_GC_INTERVAL seconds.")
+@click.option("--iterations", type=int, default=None, help="With --watch, stop after this many rounds.")
+def sessions_gc_command(watch: bool, iterations: int | None) -> None:
+    """Expire session files for domains on file-based session backends."""
+
+    from .sessions import collect_all_garbage
+    from .sessions import watch as watch_sessions
+
+    if watch:
+        watch_sessions(iterations=iterations)
+        return
+    for domain, removed in collect_all_garbage():
+        click.echo(f"{domain.hostname}: removed {removed} expired session(s)")
+
+
+@panel_cli.command("cgroups")
+@click.option("--watch", is_flag=True, help="Keep syncing every EZYPANEL_CGROUP_SYNC_INTERVAL seconds.")
+@click.option("--iterations", type=int, default=None, help="With --watch, stop after this many rounds.")
+def cgroups_command(watch: bool, iterations: int | None) -> None:
+    """Apply per-domain resource limits and attach respawned PHP-FPM workers."""
+
+    from .cgroups import sync_all
+    from .cgroups import watch as watch_cgroups
+
+    if watch:
+        watch_cgroups(iterations=iterations)
+        return
+    for domain, result in sync_all():
+        click.echo(f"{domain.hostname}: {result.message}")
+
+
+@panel_cli.command("php-drains")
+def php_drains_command() -> None:
+    """Remove old PHP-FPM pools whose post-switch drain period is over."""
+
+    from .migration import finish_due_drains
+
+    failed = False
+    for drain, result in finish_due_drains():
+        click.echo(f"{drain.hostname} (PHP {drain.php_version}): {result.message}")
+        failed = failed or not result.success
+    if failed:
+        raise click.ClickException("Some drains are still pending.")
+
+
+@panel_cli.command("traffic-sync")
+def traffic_sync_command() -> None:
+    """Re-render every vhost's traffic limits and the shared nginx zones."""
+
+    from .traffic import sync_all
+
+    result = sync_all()
+    if not result.success:
+        raise click.ClickException(result.message)
+    click.echo(result.message)
+
+
+@panel_cli.command("tls-rotate-tickets")
+@click.option("--force", is_flag=True, help="Rotate even if the current key is not due yet.")
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep rotating due keys and refreshing the expiry index every EZYPANEL_TLS_WATCH_INTERVAL seconds.",
+)
+@click.option("--iterations", type=int, default=None, help="With --watch, stop after this many rounds.")
+def tls_rotate_tickets_command(force: bool, watch: bool, iterations: int | None) -> None:
+    """Rotate the shared TLS session ticket keys once they are due."""
+
+    from .tls import rotate_ticket_keys
+    from .tls import watch as watch_tls
+
+    if watch:
+        watch_tls(iterations=iterations)
+        return
+    result = rotate_ticket_keys(force=force)
+    if not result.success:
+        raise click.ClickException(result.message)
+    click.echo(result.message)
+
+
+@panel_cli.command("tls-check")
+def tls_check_command() -> None:
+    """Re-read installed certificates into the expiry index; list those expiring."""
+
+    from .tls import refresh_expiry_index
+
+    for certificate in refresh_expiry_index():
+        click.echo(f"{certificate.domain.hostname}: expires {certificate.expires_label} ({certificate.days_left} days)")
+
+
+@panel_cli.group("snapshots")
+def snapshots_group() -> None:
+    """Take, restore and prune domain snapshots."""
+
+
+def _domain_or_fail(hostname: str):
+    from .models import Domain
+
+    domain = Domain.query.filter_by(hostname=hostname).first()
+    if domain is None:
+        raise click.ClickException(f"Unknown domain {hostname}")
+    return domain
+
+
+@snapshots_group.command("take")
+@click.argument("hostname")
+@click.option("--label", default="", help="Free-form note shown in the panel.")
+def snapshots_take_command(hostname: str, label: str) -> None:
+    """Snapshot HOSTNAME's document root and configs."""
+
+    from .snapshots import create_snapshot
+
+    result = create_snapshot(_domain_or_fail(hostname), label)
+    if not result.success:
+        raise click.ClickException(result.message)
+    click.echo(result.message)
+
+
+@snapshots_group.command("list")
+@click.argument("hostname")
+def snapshots_list_command(hostname: str) -> None:
+    """List HOSTNAME's snapshots, newest first."""
+
+    for snapshot in _domain_or_fail(hostname).snapshots:
+        click.echo(
+            f"{snapshot.id}\t{snapshot.created_label}\t{snapshot.file_count} files\t"
+            f"{snapshot.total_mb} MB\t{snapshot.label or ''}"
+        )
+
+
+@snapshots_group.command("restore")
+@click.argument("hostname")
+@click.argument("snapshot_id", type=int)
+def snapshots_restore_command(hostname: str, snapshot_id: int) -> None:
+    """Restore HOSTNAME to SNAPSHOT_ID."""
+
+    from .models import Snapshot
+    from .snapshots import restore_snapshot
+
+    domain = _domain_or_fail(hostname)
+    snapshot = Snapshot.query.filter_by(id=snapshot_id, domain_id=domain.id).first()
+    if snapshot is None:
+        raise click.ClickException(f"No snapshot {snapshot_id} for {hostname}")
+    result = restore_snapshot(snapshot)
+    if not result.success:
+        raise click.ClickException(result.message)
+    click.echo(result.message)
+
+
+@snapshots_group.command("prune")
+def snapshots_prune_command() -> None:
+    """Apply snapshot retention to every domain."""
+
+    from .models import Domain
+    from .snapshots import prune_snapshots
+
+    for domain in Domain.query.order_by(Domain.hostname.asc()).all():
+        click.echo(f"{domain.hostname}: removed {prune_snapshots(domain)} snapshot(s)")
+
+
+@panel_cli.group("fpm-shards")
+def fpm_shards_group() -> None:
+    """Manage sharded PHP-FPM masters (EZYPANEL_PHP_FPM_SHARDS > 1)."""
+
+
+@fpm_shards_group.command("render")
+def fpm_shards_render_command() -> None:
+    """Write shard master configs and supervisor programs, then update supervisor."""
+
+    from .fpm_shards import render_shards
+
+    click.echo(render_shards().message)
+
+
+@fpm_shards_group.command("rebalance")
+@click.option("--dry-run", is_flag=True, help="Only list the pools that would move.")
+def fpm_shards_rebalance_command(dry_run: bool) -> None:
+    """Move pools onto their hashed or explicitly placed shard."""
+
+    from .fpm_shards import rebalance
+
+    click.echo(rebalance(dry_run=dry_run).message)
+
+
+@fpm_shards_group.command("place")
+@click.argument("hostname")
+@click.argument("shard")
+def fpm_shards_place_command(hostname: str, shard: str) -> None:
+    """Pin HOSTNAME to SHARD (a number, or 'auto' to go back to hashing)."""
+
+    from .fpm_shards import place_domain
+
+    domain = _domain_or_fail(hostname)
+    if shard != "auto" and not shard.isdigit():
+        raise click.BadParameter("shard must be a number or 'auto'")
+    result = place_domain(domain, None if shard == "auto" else int(shard))
+    if not result.success:
+        raise click.ClickException(result.message)
+    click.echo(result.message)
+
+
+@panel_cli.group("fpm-status")
+def fpm_status_group() -> None:
+    """Poll PHP-FPM status pages and manage pool slowlogs."""
+
+
+@fpm_status_group.command("watch")
+@click.option("--iterations", type=int, default=None, help="Stop after this many polls (default: run forever).")
+def fpm_status_watch_command(iterations: int | None) -> None:
+    """Poll every pool at EZYPANEL_FPM_STATUS_INTERVAL into the shared ring buffer."""
+
+    from .fpm_status import watch
+
+    watch(iterations=iterations)
+
+
+@fpm_status_group.command("sync")
+def fpm_status_sync_command() -> None:
+    """Re-render the status/slowlog block of every pool and reload the masters."""
+
+    from .fpm_status import sync_pools
+
+    result = sync_pools()
+    if not result.success:
+        raise click.ClickException(result.message)
+    click.echo(result.message)
@@ -7,7 +7,6 @@ from pathlib import Path
 class Config:
     BASE_DIR = Path(__file__).resolve().parent.parent
     DATA_DIR = BASE_DIR / "data"
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
     CONFIG_TEMPLATE_DIR = BASE_DIR / "config_templates"
 
     EZYPANEL_LOG_LEVEL = os.environ.get("EZYPANEL_LOG_LEVEL", "INFO").upper()
@@ -32,6 +31,9 @@ class Config:
             "EZYPANEL_NGINX_ENABLED", DATA_DIR / "nginx" / "sites-enabled"
         )
     )
+    NGINX_HTTP_INCLUDE_DIR = Path(
+        os.environ.get("EZYPANEL_NGINX_HTTP_INCLUDE", DATA_DIR / "nginx" / "http.d")
+    )
     PHP_FPM_BASE_DIR = Path(
         os.environ.get("EZYPANEL_PHP_FPM_BASE", DATA_DIR / "php-fpm")
     )
@@ -63,8 +65,131 @@ class Config:
         "EZYPANEL_PHP_FPM_SERVICE_TEMPLATE", "php{version}-fpm"
     )
 
+    PHP_FPM_SHARDS = int(os.environ.get("EZYPANEL_PHP_FPM_SHARDS", "1"))
+    PHP_FPM_SHARD_SERVICE_TEMPLATE = os.environ.get(
+        "EZYPANEL_PHP_FPM_SHARD_SERVICE_TEMPLATE", "php{version}-fpm-shard{shard}"
+    )
+    PHP_FPM_BIN_TEMPLATE = os.environ.get(
+        "EZYPANEL_PHP_FPM_BIN_TEMPLATE", "/usr/sbin/php-fpm{version}"
+    )
+    SUPERVISOR_INCLUDE_DIR = Path(
+        os.environ.get("EZYPANEL_SUPERVISOR_INCLUDE_DIR", DATA_DIR / "supervisor")
+    )
+
     AVAILABLE_PHP_VERSIONS = os.environ.get("EZYPANEL_PHP_VERSIONS")
 
+    DISK_USAGE_INDEX_DIR = Path(
+        os.environ.get("EZYPANEL_DISK_USAGE_INDEX_DIR", DATA_DIR / "index" / "disk")
+    )
+    DISK_USAGE_FULL_RESCAN_SECONDS = int(
+        os.environ.get("EZYPANEL_DISK_USAGE_FULL_RESCAN_SECONDS", "86400")
+    )
+    DISK_QUOTA_ALERT_PERCENT = int(
+        os.environ.get("EZYPANEL_DISK_QUOTA_ALERT_PERCENT", "90")
+    )
+    DISK_SESSIONS_ALERT_MB = int(os.environ.get("EZYPANEL_DISK_SESSIONS_ALERT_MB", "512"))
+    DISK_SESSIONS_ALERT_FILES = int(
+        os.environ.get("EZYPANEL_DISK_SESSIONS_ALERT_FILES", "100000")
+    )
+    DISK_TMP_ALERT_MB = int(os.environ.get("EZYPANEL_DISK_TMP_ALERT_MB", "1024"))
+
+    LOG_ROTATE_MAX_MB = int(os.environ.get("EZYPANEL_LOG_ROTATE_MAX_MB", "100"))
+    LOG_ROTATE_INTERVAL_HOURS = int(
+        os.environ.get("EZYPANEL_LOG_ROTATE_INTERVAL_HOURS", "24")
+    )
+    LOG_ROTATE_KEEP = int(os.environ.get("EZYPANEL_LOG_ROTATE_KEEP", "7"))
+    LOG_ROTATE_WORKERS = int(os.environ.get("EZYPANEL_LOG_ROTATE_WORKERS", "2"))
+    LOG_ROTATE_COMPRESS_DELAY = float(
+        os.environ.get("EZYPANEL_LOG_ROTATE_COMPRESS_DELAY", "5")
+    )
+
+    NGINX_EXTRA_DIRECTIVES = os.environ.get("EZYPANEL_NGINX_EXTRA_DIRECTIVES", "")
+
+    TRAFFIC_RATE_LIMIT_RPS = int(os.environ.get("EZYPANEL_TRAFFIC_RATE_LIMIT_RPS", "0"))
+    TRAFFIC_RATE_LIMIT_BURST = int(os.environ.get("EZYPANEL_TRAFFIC_RATE_LIMIT_BURST", "40"))
+    TRAFFIC_CONN_LIMIT_PER_IP = int(os.environ.get("EZYPANEL_TRAFFIC_CONN_LIMIT_PER_IP", "0"))
+    TRAFFIC_CONN_LIMIT_TOTAL = int(os.environ.get("EZYPANEL_TRAFFIC_CONN_LIMIT_TOTAL", "0"))
+    TRAFFIC_ZONE_SIZE = os.environ.get("EZYPANEL_TRAFFIC_ZONE_SIZE", "10m")
+
+    PHP_FPM_PING_PATH = os.environ.get("EZYPANEL_PHP_FPM_PING_PATH", "/ping")
+    PHP_FPM_PING_RESPONSE = os.environ.get("EZYPANEL_PHP_FPM_PING_RESPONSE", "pong")
+    PHP_MIGRATION_READY_TIMEOUT = float(
+        os.environ.get("EZYPANEL_PHP_MIGRATION_READY_TIMEOUT", "15")
+    )
+    PHP_MIGRATION_DRAIN_SECONDS = float(
+        os.environ.get("EZYPANEL_PHP_MIGRATION_DRAIN_SECONDS", "30")
+    )
+    PHP_FPM_STATUS_PATH = os.environ.get("EZYPANEL_PHP_FPM_STATUS_PATH", "/fpm-status")
+    PHP_FPM_SLOWLOG_TIMEOUT = int(os.environ.get("EZYPANEL_PHP_FPM_SLOWLOG_TIMEOUT", "5"))
+    PHP_FPM_SLOWLOG_DEPTH = int(os.environ.get("EZYPANEL_PHP_FPM_SLOWLOG_DEPTH", "20"))
+    FPM_STATUS_FILE = Path(
+        os.environ.get("EZYPANEL_FPM_STATUS_FILE", DATA_DIR / "index" / "fpm-status.json")
+    )
+    FPM_STATUS_INTERVAL = float(os.environ.get("EZYPANEL_FPM_STATUS_INTERVAL", "5"))
+    FPM_STATUS_SAMPLES = int(os.environ.get("EZYPANEL_FPM_STATUS_SAMPLES", "720"))
+    FPM_STATUS_WINDOW = int(os.environ.get("EZYPANEL_FPM_STATUS_WINDOW", "60"))
+    FPM_STATUS_TIMEOUT = float(os.environ.get("EZYPANEL_FPM_STATUS_TIMEOUT", "1"))
+    FPM_SLOWLOG_TAIL_KB = int(os.environ.get("EZYPANEL_FPM_SLOWLOG_TAIL_KB", "512"))
+    HEALTH_PROBE_TIMEOUT = float(os.environ.get("EZYPANEL_HEALTH_PROBE_TIMEOUT", "0.5"))
+    HEALTH_PROBE_BATCH = int(os.environ.get("EZYPANEL_HEALTH_PROBE_BATCH", "512"))
+    HEALTH_CACHE_SECONDS = float(os.environ.get("EZYPANEL_HEALTH_CACHE_SECONDS", "2"))
+
+    LOCK_DIR = Path(os.environ.get("EZYPANEL_LOCK_DIR", DATA_DIR / "locks"))
+    LOCK_TIMEOUT = float(os.environ.get("EZYPANEL_LOCK_TIMEOUT", "30"))
+    LOCK_SLOW_MS = float(os.environ.get("EZYPANEL_LOCK_SLOW_MS", "100"))
+
+    # External commands: per-command timeout, output kept per stream, and a
+    # host-wide cap on concurrently running commands (0 = no cap).
+    COMMAND_TIMEOUT = float(os.environ.get("EZYPANEL_COMMAND_TIMEOUT", "30"))
+    COMMAND_MAX_OUTPUT_KB = int(os.environ.get("EZYPANEL_COMMAND_MAX_OUTPUT_KB", "256"))
+    COMMAND_CONCURRENCY = int(os.environ.get("EZYPANEL_COMMAND_CONCURRENCY", "8"))
+    COMMAND_QUEUE_TIMEOUT = float(os.environ.get("EZYPANEL_COMMAND_QUEUE_TIMEOUT", "30"))
+    COMMAND_KILL_GRACE = float(os.environ.get("EZYPANEL_COMMAND_KILL_GRACE", "2"))
+    # "popen" or "posix_spawn"
+    COMMAND_SPAWN = os.environ.get("EZYPANEL_COMMAND_SPAWN", "popen")
+    CHOWN_TIMEOUT = float(os.environ.get("EZYPANEL_CHOWN_TIMEOUT", "300"))
+
+    TLS_DIR = Path(os.environ.get("EZYPANEL_TLS_DIR", DATA_DIR / "tls"))
+    OPENSSL_BIN = os.environ.get("EZYPANEL_OPENSSL_BIN", "openssl")
+    # "listen" (listen 443 ssl http2), "directive" (http2 on; nginx >= 1.25.1) or "off"
+    TLS_HTTP2 = os.environ.get("EZYPANEL_TLS_HTTP2", "listen")
+    TLS_SESSION_CACHE_SIZE = os.environ.get("EZYPANEL_TLS_SESSION_CACHE_SIZE", "20m")
+    TLS_SESSION_TIMEOUT = os.environ.get("EZYPANEL_TLS_SESSION_TIMEOUT", "1d")
+    TLS_TICKET_KEYS = int(os.environ.get("EZYPANEL_TLS_TICKET_KEYS", "3"))
+    TLS_TICKET_ROTATE_HOURS = float(os.environ.get("EZYPANEL_TLS_TICKET_ROTATE_HOURS", "12"))
+    # OCSP stapling is only enabled with a resolver; none by default so no
+    # lookups leave the host unless configured.
+    TLS_RESOLVER = os.environ.get("EZYPANEL_TLS_RESOLVER", "")
+    TLS_WATCH_INTERVAL = float(os.environ.get("EZYPANEL_TLS_WATCH_INTERVAL", "3600"))
+    TLS_SELF_SIGNED_DAYS = int(os.environ.get("EZYPANEL_TLS_SELF_SIGNED_DAYS", "365"))
+    TLS_EXPIRY_WARN_DAYS = int(os.environ.get("EZYPANEL_TLS_EXPIRY_WARN_DAYS", "21"))
+
+    SNAPSHOT_DIR = Path(
+        os.environ.get("EZYPANEL_SNAPSHOT_DIR", DATA_DIR / "snapshots")
+    )
+    SNAPSHOT_KEEP = int(os.environ.get("EZYPANEL_SNAPSHOT_KEEP", "10"))
+    SNAPSHOT_MAX_AGE_DAYS = int(os.environ.get("EZYPANEL_SNAPSHOT_MAX_AGE_DAYS", "30"))
+
+    SESSION_BACKEND = os.environ.get("EZYPANEL_SESSION_BACKEND", "files")
+    SESSION_SHARD_DEPTH = int(os.environ.get("EZYPANEL_SESSION_SHARD_DEPTH", "2"))
+    SESSION_GC_INTERVAL = float(os.environ.get("EZYPANEL_SESSION_GC_INTERVAL", "600"))
+    SESSION_TMPFS_DIR = Path(
+        os.environ.get("EZYPANEL_SESSION_TMPFS_DIR", "/dev/shm/ezypanel-sessions")
+    )
+    SESSION_REDIS_SOCKET = os.environ.get(
+        "EZYPANEL_SESSION_REDIS_SOCKET", "/run/redis/redis.sock"
+    )
+    SESSION_MEMCACHED_SOCKET = os.environ.get(
+        "EZYPANEL_SESSION_MEMCACHED_SOCKET", "/run/memcached/memcached.sock"
+    )
+
+    CGROUP_MOUNT = Path(os.environ.get("EZYPANEL_CGROUP_MOUNT", "/sys/fs/cgroup"))
+    CGROUP_PARENT = os.environ.get("EZYPANEL_CGROUP_PARENT", "ezypanel")
+    CGROUP_CPU_PERIOD_US = int(os.environ.get("EZYPANEL_CGROUP_CPU_PERIOD_US", "100000"))
+    # Leaf the namespace root's own processes move to so controllers can be enabled.
+    CGROUP_LEAF = os.environ.get("EZYPANEL_CGROUP_LEAF", "panel")
+    CGROUP_SYNC_INTERVAL = float(os.environ.get("EZYPANEL_CGROUP_SYNC_INTERVAL", "10"))
+
     SIMULATE_SERVER_COMMANDS = os.environ.get(
         "SIMULATE_SERVER_COMMANDS", "true"
     ).lower() in {"1", "true", "yes"}
@@ -77,6 +202,7 @@ class Config:
             cls.DOCUMENT_ROOT_BASE,
             cls.NGINX_AVAILABLE_DIR,
             cls.NGINX_ENABLED_DIR,
+            cls.NGINX_HTTP_INCLUDE_DIR,
             cls.PHP_FPM_BASE_DIR,
             cls.PHP_SOCKET_BASE_DIR,
         ]:
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from .extensions import db
+from .models import DiskUsage, Domain
+from .services import _config_value, domain_paths
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+MB = 1024 * 1024
+
+
+@dataclass
+class TreeTotals:
+    bytes: int = 0
+    files: int = 0
+    rescanned_dirs: int = 0
+    cached_dirs: int = 0
+    entries: dict[str, dict] = field(default_factory=dict)
+
+
+def _entry_bytes(stat_result: os.stat_result) -> int:
+    # Match `du`: count allocated blocks where the platform reports them.
+    blocks = getattr(stat_result, "st_blocks", None)
+    if blocks is None:  # pragma: no cover - non-POSIX
+        return stat_result.st_size
+    return blocks * 512
+
+
+def _scan_directory(path: str) -> dict:
+    direct_bytes = 0
+    direct_files = 0
+    subdirs: list[str] = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    direct_bytes += _entry_bytes(entry.stat(follow_symlinks=False))
+                    direct_files += 1
+            except FileNotFoundError:
+                continue
+    return {"bytes": direct_bytes, "files": direct_files, "subdirs": sorted(subdirs)}
+
+
+def scan_tree(root: Path, previous: dict[str, dict], force: bool = False) -> TreeTotals:
+    """Total a directory tree, re-listing only directories whose mtime changed.
+
+    A directory's mtime changes whenever entries are added, removed or renamed
+    in it, so unchanged directories reuse their cached direct-file totals and
+    child list; only one ``stat`` per directory is needed to confirm that.
+    In-place growth of an existing file does not touch the directory mtime;
+    that is picked up by the periodic full rescan (``force=True``).
+    """
+
+    totals = TreeTotals()
+    stack = [str(root)]
+    while stack:
+        current = stack.pop()
+        try:
+            stat_result = os.stat(current, follow_symlinks=False)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+        cached = previous.get(current)
+        if not force and cached and cached.get("mtime_ns") == stat_result.st_mtime_ns:
+            entry = cached
+            totals.cached_dirs += 1
+        else:
+            try:
+                entry = _scan_directory(current)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            except PermissionError as exc:
+                logger.warning("disk_scan_denied path=%s error=%s", current, exc)
+                continue
+            entry["mtime_ns"] = stat_result.st_mtime_ns
+            totals.rescanned_dirs += 1
+
+        totals.entries[current] = entry
+        totals.bytes += entry["bytes"] + _entry_bytes(stat_result)
+        totals.files += entry["files"]
+        stack.extend(os.path.join(current, name) for name in entry["subdirs"])
+    return totals
+
+
+def _index_path(hostname: str) -> Path:
+    return Path(_config_value("DISK_USAGE_INDEX_DIR")) / f"{hostname}.json"
+
+
+def _load_index(hostname: str) -> dict[str, dict]:
+    path = _index_path(hostname)
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return {}
+    if data.get("version") != INDEX_VERSION:
+        return {}
+    return data.get("dirs", {})
+
+
+def _store_index(hostname: str, entries: dict[str, dict]) -> None:
+    # The index is derived data, so skip the .bak copy atomic_write keeps.
+    path = _index_path(hostname)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    payload = {"version": INDEX_VERSION, "dirs": entries}
+    tmp_path.write_text(json.dumps(payload, separators=(",", ":")), encoding="utf-8")
+    tmp_path.replace(path)
+
+
+def remove_index(hostname: str) -> None:
+    _index_path(hostname).unlink(missing_ok=True)
+
+
+def _needs_full_scan(usage: DiskUsage | None) -> bool:
+    if usage is None or usage.full_scan_at is None:
+        return True
+    interval = int(_config_value("DISK_USAGE_FULL_RESCAN_SECONDS", 86400))
+    return datetime.utcnow() - usage.full_scan_at >= timedelta(seconds=interval)
+
+
+def disk_alerts(domain: Domain, usage: DiskUsage) -> list[str]:
+    alerts: list[str] = []
+    if domain.disk_quota_mb:
+        quota_bytes = domain.disk_quota_mb * MB
+        percent = usage.total_bytes * 100 / quota_bytes
+        threshold = int(_config_value("DISK_QUOTA_ALERT_PERCENT", 90))
+        if usage.total_bytes > quota_bytes:
+            alerts.append(
+                f"Over quota: {usage.total_mb} MB of {domain.disk_quota_mb} MB"
+            )
+        elif percent >= threshold:
+            alerts.append(f"Quota {percent:.0f}% used ({domain.disk_quota_mb} MB)")
+
+    sessions_mb = int(_config_value("DISK_SESSIONS_ALERT_MB", 512))
+    sessions_files = int(_config_value("DISK_SESSIONS_ALERT_FILES", 100000))
+    if usage.sessions_bytes > sessions_mb * MB or usage.sessions_files > sessions_files:
+        alerts.append(
+            f"Runaway sessions directory: {usage.sessions_files} files, "
+            f"{usage.sessions_bytes // MB} MB"
+        )
+
+    tmp_mb = int(_config_value("DISK_TMP_ALERT_MB", 1024))
+    if usage.tmp_bytes > tmp_mb * MB:
+        alerts.append(f"Runaway tmp directory: {usage.tmp_bytes // MB} MB")
+    return alerts
+
+
+def refresh_disk_usage(domain: Domain, force: bool = False) -> DiskUsage:
+    usage = domain.disk_usage
+    full_scan = force or _needs_full_scan(usage)
+    previous = {} if full_scan else _load_index(domain.hostname)
+
+    paths = domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)
+
+    entries: dict[str, dict] = {}
+    site = scan_tree(paths["domain_dir"], previous, force=full_scan)
+    logs = scan_tree(paths["log_dir"], previous, force=full_scan)
+    entries.update(site.entries)
+    entries.update(logs.entries)
+
+    # Sessions and tmp live under domain_dir, so sum them from the entries
+    # just collected instead of walking those trees a second time.
+    def _subtree(root: Path) -> tuple[int, int]:
+        prefix = str(root)
+        total_bytes = total_files = 0
+        for key, entry in site.entries.items():
+            if key == prefix or key.startswith(prefix + os.sep):
+                total_bytes += entry["bytes"]
+                total_files += entry["files"]
+        return total_bytes, total_files
+
+    sessions_bytes, sessions_files = _subtree(paths["sessions"])
+    tmp_bytes, tmp_files = _subtree(paths["tmp"])
+
+    if usage is None:
+        usage = DiskUsage(domain=domain)
+        db.session.add(usage)
+
+    now = datetime.utcnow()
+    usage.total_bytes = site.bytes + logs.bytes
+    usage.sessions_bytes = sessions_bytes
+    usage.sessions_files = sessions_files
+    usage.tmp_bytes = tmp_bytes
+    usage.tmp_files = tmp_files
+    usage.logs_bytes = logs.bytes
+    usage.site_bytes = max(site.bytes - sessions_bytes - tmp_bytes, 0)
+    usage.scanned_at = now
+    if full_scan:
+        usage.full_scan_at = now
+    usage.alerts = disk_alerts(domain, usage)
+
+    _store_index(domain.hostname, entries)
+    db.session.commit()
+
+    logger.debug(
+        "refresh_disk_usage hostname=%s full=%s rescanned=%s cached=%s total=%s",
+        domain.hostname,
+        full_scan,
+        site.rescanned_dirs + logs.rescanned_dirs,
+        site.cached_dirs + logs.cached_dirs,
+        usage.total_bytes,
+    )
+    for alert in usage.alerts:
+        logger.warning("disk_alert hostname=%s %s", domain.hostname, alert)
+    return usage
+
+
+def refresh_all_disk_usage(force: bool = False) -> list[DiskUsage]:
+    results = []
+    for domain in Domain.query.order_by(Domain.hostname.asc()).all():
+        try:
+            results.append(refresh_disk_usage(domain, force=force))
+        except OSError as exc:  # pragma: no cover - depends on filesystem state
+            db.session.rollback()
+            logger.warning("refresh_disk_usage failed hostname=%s error=%s", domain.hostname, exc)
+    return results
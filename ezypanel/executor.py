@@ -0,0 +1,381 @@
+from __future__ import annotations
+
+import fcntl
+import logging
+import os
+import selectors
+import shutil
+import signal
+import subprocess
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Mapping, Sequence
+
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+_DEFAULTS = {
+    "COMMAND_TIMEOUT": 30.0,
+    "COMMAND_MAX_OUTPUT_KB": 256,
+    "COMMAND_CONCURRENCY": 8,
+    "COMMAND_QUEUE_TIMEOUT": 30.0,
+    "COMMAND_KILL_GRACE": 2.0,
+    "COMMAND_SPAWN": "popen",
+    "LOCK_DIR": None,
+}
+_READ_CHUNK = 65536
+
+
+@dataclass
+class CommandResult:
+    success: bool
+    stdout: str = ""
+    stderr: str = ""
+    returncode: int | None = None
+    # Signal that ended the command (ours after a timeout, or anyone's).
+    exit_signal: int | None = None
+    duration_ms: float = 0.0
+    timed_out: bool = False
+    truncated: bool = False
+
+    @property
+    def message(self) -> str:
+        return self.stdout if self.success else self.stderr or "Command failed"
+
+
+def _setting(key: str):
+    # Usable without an app context (scripts); the built-in defaults apply.
+    if has_app_context():
+        return current_app.config.get(key, _DEFAULTS[key])
+    return _DEFAULTS[key]
+
+
+def _slot_dir() -> Path | None:
+    lock_dir = _setting("LOCK_DIR")
+    if not lock_dir:
+        return None
+    directory = Path(lock_dir) / "exec"
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+def _acquire_slot(timeout: float) -> tuple[int | None, bool]:
+    """Take one of ``EZYPANEL_COMMAND_CONCURRENCY`` flock slots.
+
+    Returns ``(fd, ok)``; ``fd`` is None when slots are disabled (0) or there
+    is no usable lock directory. The slot files are shared by every gunicorn
+    worker and CLI process, so the limit holds host-wide. An unwritable lock
+    directory only costs the limit: the command still runs, without a slot.
+    """
+
+    slots = int(_setting("COMMAND_CONCURRENCY"))
+    try:
+        directory = _slot_dir() if slots > 0 else None
+    except OSError as exc:
+        logger.warning("command_slot_unavailable error=%s", exc)
+        return None, True
+    if directory is None:
+        return None, True
+
+    deadline = time.monotonic() + timeout
+    first = os.getpid() % slots
+    delay = 0.005
+    while True:
+        for offset in range(slots):
+            # Non-inheritable by default (PEP 446), so a child that outlives
+            # us can never keep a slot.
+            try:
+                fd = os.open(directory / f"slot-{(first + offset) % slots}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError as exc:
+                logger.warning("command_slot_unavailable error=%s", exc)
+                return None, True
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd, True
+            except BlockingIOError:
+                os.close(fd)
+        if time.monotonic() >= deadline:
+            return None, False
+        time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 2, 0.1)
+
+
+def _release_slot(fd: int | None) -> None:
+    if fd is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class _Child:
+    """A spawned process leading its own process group, with raw pipe fds."""
+
+    def __init__(self, pid: int, stdin: int | None, stdout: int, stderr: int, popen: subprocess.Popen | None = None):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.popen = popen
+        self.returncode: int | None = None
+
+    def poll(self) -> int | None:
+        if self.returncode is None:
+            if self.popen is not None:
+                self.returncode = self.popen.poll()
+            else:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+                if pid:
+                    self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self, timeout: float) -> int | None:
+        deadline = time.monotonic() + timeout
+        delay = 0.001
+        while self.poll() is None and time.monotonic() < deadline:
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 0.05)
+        return self.returncode
+
+    def kill_group(self, sig: int) -> bool:
+        """Signal the whole group; False once no member is left (ESRCH)."""
+
+        try:
+            os.killpg(self.pid, sig)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def terminate_group(self, grace: float) -> None:
+        """SIGTERM every member, SIGKILL whatever is left after ``grace``.
+
+        Also reaches children that outlived the leader and still hold our
+        pipes, which the leader's own exit status says nothing about.
+        """
+
+        self.kill_group(signal.SIGTERM)
+        deadline = time.monotonic() + grace
+        delay = 0.001
+        while time.monotonic() < deadline:
+            # Reap the leader first: a zombie still counts as a group member.
+            self.poll()
+            if not self.kill_group(0):
+                return
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 0.05)
+        self.kill_group(signal.SIGKILL)
+        self.wait(5)
+
+    def close_stdin(self) -> None:
+        if self.stdin is not None:
+            os.close(self.stdin)
+            self.stdin = None
+
+    def close(self) -> None:
+        self.close_stdin()
+        for fd in (self.stdout, self.stderr):
+            os.close(fd)
+
+
+def _spawn_popen(args: list[str], env: Mapping[str, str] | None, cwd: str | None, want_stdin: bool) -> _Child:
+    # CPython already vforks here when it can.
+    popen = subprocess.Popen(
+        args,
+        stdin=subprocess.PIPE if want_stdin else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+        cwd=cwd,
+        start_new_session=True,
+    )
+    # Work on plain fds like the posix_spawn path; the file objects go.
+    fds = []
+    for stream in (popen.stdin, popen.stdout, popen.stderr):
+        fds.append(os.dup(stream.fileno()) if stream is not None else None)
+        if stream is not None:
+            stream.close()
+    popen.stdin = popen.stdout = popen.stderr = None
+    return _Child(popen.pid, *fds, popen=popen)
+
+
+def _spawn_posix(args: list[str], env: Mapping[str, str] | None, want_stdin: bool) -> _Child:
+    executable = shutil.which(args[0])
+    if executable is None:
+        raise FileNotFoundError(f"No such file or directory: {args[0]!r}")
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    if want_stdin:
+        in_r, in_w = os.pipe()
+    else:
+        in_r, in_w = os.open(os.devnull, os.O_RDONLY), None
+    try:
+        # Pipe ends are close-on-exec; dup2 onto 0-2 clears it for the copies.
+        pid = os.posix_spawn(
+            executable,
+            args,
+            dict(os.environ if env is None else env),
+            file_actions=[
+                (os.POSIX_SPAWN_DUP2, in_r, 0),
+                (os.POSIX_SPAWN_DUP2, out_w, 1),
+                (os.POSIX_SPAWN_DUP2, err_w, 2),
+            ],
+            setsid=True,
+        )
+    except BaseException:
+        for fd in (out_r, err_r, in_w):
+            if fd is not None:
+                os.close(fd)
+        raise
+    finally:
+        for fd in (in_r, out_w, err_w):
+            os.close(fd)
+    return _Child(pid, in_w, out_r, err_r)
+
+
+def _spawn(args: list[str], env: Mapping[str, str] | None, cwd: str | None, want_stdin: bool) -> _Child:
+    # posix_spawn has no portable chdir action; those calls go through Popen.
+    if _setting("COMMAND_SPAWN") == "posix_spawn" and cwd is None:
+        return _spawn_posix(args, env, want_stdin)
+    return _spawn_popen(args, env, cwd, want_stdin)
+
+
+class _Capture:
+    """Keeps the first ``limit`` bytes of a stream and counts the rest."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.data = bytearray()
+        self.dropped = 0
+
+    def feed(self, chunk: bytes) -> None:
+        room = self.limit - len(self.data)
+        if room > 0:
+            self.data += chunk[:room]
+        self.dropped += max(len(chunk) - max(room, 0), 0)
+
+    def text(self) -> str:
+        text = self.data.decode(errors="replace").strip()
+        if self.dropped:
+            text += f"\n[... {self.dropped} more bytes not captured]"
+        return text
+
+
+def _communicate(child: _Child, payload: bytes, deadline: float, limit: int) -> tuple[_Capture, _Capture, bool]:
+    captures = {child.stdout: _Capture(limit), child.stderr: _Capture(limit)}
+    with selectors.DefaultSelector() as selector:
+        for fd in captures:
+            selector.register(fd, selectors.EVENT_READ)
+        if payload and child.stdin is not None:
+            os.set_blocking(child.stdin, False)
+            selector.register(child.stdin, selectors.EVENT_WRITE)
+        else:
+            child.close_stdin()
+
+        offset = 0
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return captures[child.stdout], captures[child.stderr], True
+            for key, _events in selector.select(remaining):
+                if key.fd == child.stdin:
+                    try:
+                        offset += os.write(key.fd, payload[offset : offset + _READ_CHUNK])
+                    except BlockingIOError:
+                        continue
+                    except BrokenPipeError:
+                        offset = len(payload)
+                    if offset >= len(payload):
+                        selector.unregister(key.fd)
+                        child.close_stdin()
+                    continue
+                chunk = os.read(key.fd, _READ_CHUNK)
+                if chunk:
+                    captures[key.fd].feed(chunk)
+                else:
+                    selector.unregister(key.fd)
+    return captures[child.stdout], captures[child.stderr], False
+
+
+def run(
+    args: Sequence[str],
+    *,
+    timeout: float | None = None,
+    input: str | bytes | None = None,
+    env: Mapping[str, str] | None = None,
+    cwd: str | os.PathLike | None = None,
+    max_output_kb: int | None = None,
+) -> CommandResult:
+    """Run an external command with a timeout, output cap and concurrency slot.
+
+    The command leads its own process group; on timeout the whole group gets
+    SIGTERM, then SIGKILL after ``EZYPANEL_COMMAND_KILL_GRACE`` seconds. That
+    includes children still holding the output pipes after the command itself
+    exited; the command's own exit status is reported for those. Each
+    of stdout/stderr is read as it arrives and only the first
+    ``max_output_kb`` (``EZYPANEL_COMMAND_MAX_OUTPUT_KB``) are kept. Never
+    raises for a failing command; the failure is in the result.
+    """
+
+    args = [str(arg) for arg in args]
+    timeout = float(_setting("COMMAND_TIMEOUT") if timeout is None else timeout)
+    limit = int(_setting("COMMAND_MAX_OUTPUT_KB") if max_output_kb is None else max_output_kb) * 1024
+    payload = input.encode() if isinstance(input, str) else (input or b"")
+
+    started = time.monotonic()
+    slot, ok = _acquire_slot(float(_setting("COMMAND_QUEUE_TIMEOUT")))
+    if not ok:
+        logger.warning("command_queue_timeout args=%s", args)
+        return CommandResult(False, stderr=f"Too many commands running; {args[0]} was not started.")
+    queued_ms = (time.monotonic() - started) * 1000
+
+    try:
+        try:
+            child = _spawn(args, env, str(cwd) if cwd is not None else None, input is not None)
+        except OSError as exc:
+            return CommandResult(False, stderr=str(exc), duration_ms=round((time.monotonic() - started) * 1000, 1))
+
+        pipes_open = True
+        exited = None
+        try:
+            stdout, stderr, pipes_open = _communicate(child, payload, started + timeout, limit)
+            exited = child.wait(max(started + timeout - time.monotonic(), 0))
+        finally:
+            if pipes_open or exited is None:
+                # Past the deadline: the leader is still running, or it exited
+                # and left children holding stdout/stderr open.
+                child.terminate_group(float(_setting("COMMAND_KILL_GRACE")))
+            child.close()
+    finally:
+        _release_slot(slot)
+
+    timed_out = exited is None
+    returncode = child.returncode
+    exit_signal = -returncode if returncode is not None and returncode < 0 else None
+    result = CommandResult(
+        returncode == 0 and not timed_out,
+        stdout=stdout.text(),
+        stderr=stderr.text(),
+        returncode=returncode,
+        exit_signal=exit_signal,
+        duration_ms=round((time.monotonic() - started) * 1000, 1),
+        timed_out=timed_out,
+        truncated=bool(stdout.dropped or stderr.dropped),
+    )
+    if not result.success and not result.stderr:
+        # supervisorctl and friends report errors on stdout.
+        result.stderr = result.stdout
+    if timed_out:
+        result.stderr = f"{Path(args[0]).name} timed out after {timeout:g}s" + (f": {result.stderr}" if result.stderr else "")
+        logger.warning("command_timeout args=%s timeout=%s signal=%s", args, timeout, exit_signal)
+    elif pipes_open:
+        logger.warning("command_stray_children_killed args=%s returncode=%s", args, returncode)
+    logger.debug(
+        "command args=%s returncode=%s signal=%s duration_ms=%s queued_ms=%.1f truncated=%s",
+        args,
+        returncode,
+        exit_signal,
+        result.duration_ms,
+        queued_ms,
+        result.truncated,
+    )
+    return result
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import logging
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from .extensions import db
+from .locks import domain_key, locked, pool_key
+from .models import Domain
+from .services import (
+    CommandResult,
+    _config_value,
+    _run_command,
+    _simulate,
+    atomic_write,
+    detect_php_versions,
+    domain_fpm_shard,
+    domain_paths,
+    fpm_lock_key,
+    fpm_shard_count,
+    php_fpm_service_name,
+    php_pool_dir,
+    reload_php_fpm,
+)
+
+logger = logging.getLogger(__name__)
+
+SUPERVISOR_FILE = "php-fpm-shards.conf"
+
+
+@dataclass
+class ShardMove:
+    domain: Domain
+    source: Path
+    target: Path
+    source_shard: int | None
+    target_shard: int | None
+
+
+def shard_master_config(version: str, shard: int) -> str:
+    """Render the php-fpm.conf for one shard master.
+
+    Each shard gets a tiny ondemand placeholder pool so the master can start
+    while its ``pool.d`` is still empty.
+    """
+
+    run_dir = Path(_config_value("PHP_SOCKET_BASE_DIR"))
+    name = php_fpm_service_name(version, shard)
+    return (
+        "[global]\n"
+        f"pid = {run_dir / (name + '.pid')}\n"
+        "error_log = /proc/self/fd/2\n"
+        "daemonize = no\n"
+        "\n"
+        f"[{name}-placeholder]\n"
+        f"user = {_config_value('WEB_USER')}\n"
+        f"group = {_config_value('WEB_GROUP')}\n"
+        f"listen = {run_dir / (name + '-placeholder.sock')}\n"
+        "pm = ondemand\n"
+        "pm.max_children = 1\n"
+        "\n"
+        f"include = {php_pool_dir(version, shard)}/*.conf\n"
+    )
+
+
+def supervisor_programs(versions: list[str]) -> str:
+    fpm_bin_template = _config_value("PHP_FPM_BIN_TEMPLATE")
+    blocks = []
+    for version in versions:
+        for shard in range(fpm_shard_count()):
+            master_conf = php_pool_dir(version, shard).parent / "php-fpm.conf"
+            blocks.append(
+                f"[program:{php_fpm_service_name(version, shard)}]\n"
+                f"command={fpm_bin_template.format(version=version)} -F -R -y {master_conf}\n"
+                "stdout_logfile=/dev/stdout\n"
+                "stdout_logfile_maxbytes=0\n"
+                "stderr_logfile=/dev/stderr\n"
+                "stderr_logfile_maxbytes=0\n"
+                "autorestart=true\n"
+                "startretries=0\n"
+                "priority=200\n"
+            )
+    return "\n".join(blocks)
+
+
+def render_shards() -> CommandResult:
+    """Write every shard's master config and the supervisor program entries."""
+
+    if fpm_shard_count() <= 1:
+        return CommandResult(False, stderr="Sharding is disabled (EZYPANEL_PHP_FPM_SHARDS <= 1).")
+
+    versions = detect_php_versions()
+    for version in versions:
+        for shard in range(fpm_shard_count()):
+            pool_dir = php_pool_dir(version, shard)
+            pool_dir.mkdir(parents=True, exist_ok=True)
+            atomic_write(pool_dir.parent / "php-fpm.conf", shard_master_config(version, shard))
+
+    include_dir = Path(_config_value("SUPERVISOR_INCLUDE_DIR"))
+    atomic_write(include_dir / SUPERVISOR_FILE, supervisor_programs(versions))
+
+    supervisorctl = _config_value("SUPERVISOR_CTL")
+    reread = _run_command([supervisorctl, "reread"])
+    if not reread.success:
+        return reread
+    update = _run_command([supervisorctl, "update"])
+    if not update.success:
+        return update
+    return CommandResult(
+        True, stdout=f"Rendered {fpm_shard_count()} shard(s) for PHP {', '.join(versions)}."
+    )
+
+
+def _master_key(master: tuple[str, int | None]) -> tuple[str, int]:
+    version, shard = master
+    return version, -1 if shard is None else shard
+
+
+def planned_moves() -> list[ShardMove]:
+    moves = []
+    for domain in Domain.query.order_by(Domain.hostname.asc()).all():
+        source = Path(domain.php_fpm_pool_path)
+        target = domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)["php_pool"]
+        if source == target:
+            continue
+        source_shard = None
+        if source.parent.parent.name.startswith("shard-"):
+            source_shard = int(source.parent.parent.name[len("shard-"):])
+        moves.append(ShardMove(domain, source, target, source_shard, domain_fpm_shard(domain)))
+    return moves
+
+
+def rebalance(dry_run: bool = False) -> CommandResult:
+    """Move pool files to the shard each domain should live on.
+
+    Target shards are reloaded first so a moved pool is serving before its
+    old shard drops it; only the masters involved in a move are reloaded.
+    """
+
+    moves = planned_moves()
+    if dry_run or not moves:
+        lines = [f"{m.domain.hostname}: {m.source} -> {m.target}" for m in moves]
+        return CommandResult(True, stdout="\n".join(lines) or "All pools are on their shard.")
+
+    # Domain keys too: a PHP version migration holds only the domain lock
+    # while its green pool starts, and the move rewrites the same rows.
+    keys = {domain_key(m.domain.hostname) for m in moves}
+    keys |= {pool_key(m.domain.hostname) for m in moves}
+    for move in moves:
+        keys.add(fpm_lock_key(move.domain.php_version, move.source_shard))
+        keys.add(fpm_lock_key(move.domain.php_version, move.target_shard))
+    with locked(*keys):
+        return _apply_moves(moves)
+
+
+def _apply_moves(moves: list[ShardMove]) -> CommandResult:
+    for move in moves:
+        content = move.source.read_text(encoding="utf-8") if move.source.exists() else ""
+        atomic_write(move.target, content)
+
+    errors: list[str] = []
+    failed: set[tuple[str, int | None]] = set()
+    targets = {(m.domain.php_version, m.target_shard) for m in moves}
+    for version, shard in sorted(targets, key=_master_key):
+        result = reload_php_fpm(version, shard)
+        if not result.success:
+            errors.append(result.message)
+            failed.add((version, shard))
+
+    # Pools whose new master did not take them stay where they are; their
+    # old master still serves them, so nothing is reloaded for them.
+    moved = []
+    for move in moves:
+        if (move.domain.php_version, move.target_shard) in failed:
+            move.target.unlink(missing_ok=True)
+            logger.warning("fpm_rebalance rolled_back hostname=%s target=%s", move.domain.hostname, move.target)
+        else:
+            move.domain.php_fpm_pool_path = str(move.target)
+            moved.append(move)
+    db.session.commit()
+
+    for move in moved:
+        move.source.unlink(missing_ok=True)
+        move.source.with_suffix(move.source.suffix + ".bak").unlink(missing_ok=True)
+    sources = {(m.domain.php_version, m.source_shard) for m in moved}
+    for version, shard in sorted(sources, key=_master_key):
+        result = reload_php_fpm(version, shard)
+        if not result.success:
+            errors.append(result.message)
+
+    # A master dropping a pool may unlink its socket path on the way out;
+    # re-reload the new owner of any socket that went missing.
+    if not _simulate():
+        time.sleep(0.5)
+        missing = {
+            (m.domain.php_version, m.target_shard)
+            for m in moved
+            if not Path(m.domain.php_socket_path).exists()
+        }
+        for version, shard in missing:
+            reload_php_fpm(version, shard)
+
+    logger.info("fpm_rebalance moved=%s rolled_back=%s errors=%s", len(moved), len(moves) - len(moved), len(errors))
+    if errors:
+        return CommandResult(
+            False,
+            stderr=f"Moved {len(moved)} of {len(moves)} pool(s); the rest stay on their shard: " + "; ".join(errors),
+        )
+    return CommandResult(True, stdout=f"Moved {len(moves)} pool(s).")
+
+
+def place_domain(domain: Domain, shard: int | None) -> CommandResult:
+    if shard is not None and not 0 <= shard < fpm_shard_count():
+        return CommandResult(False, stderr=f"Shard must be between 0 and {fpm_shard_count() - 1}.")
+    previous = domain.fpm_shard
+    domain.fpm_shard = shard
+    db.session.commit()
+    result = rebalance()
+    if not result.success and domain_paths(domain.hostname, domain.php_version, shard)["php_pool"] != Path(
+        domain.php_fpm_pool_path
+    ):
+        # The move was rolled back; keep the placement matching the pool file.
+        domain.fpm_shard = previous
+        db.session.commit()
+    return result
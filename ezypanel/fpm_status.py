@@ -0,0 +1,434 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .extensions import db
+from .health import fcgi_get_request, request_pools
+from .locks import domain_key, locked, pool_key
+from .logrotate import php_slow_log_path
+from .models import Domain
+from .services import (
+    CommandResult,
+    _config_value,
+    _simulate,
+    atomic_write,
+    domain_fpm_shard,
+    fpm_lock_key,
+    read_file,
+    reload_php_fpm,
+)
+
+logger = logging.getLogger(__name__)
+
+# Pool keys owned by the monitoring block; rewritten as one block.
+MONITOR_KEYS = (
+    "pm.status_path",
+    "pm.status_listen",
+    "slowlog",
+    "request_slowlog_timeout",
+    "request_slowlog_trace_depth",
+)
+# Sample columns as stored in the ring buffer file.
+FIELDS = ("t", "ok", "active", "idle", "total", "listen_queue", "max_children_reached", "slow_requests")
+SPARK = "▁▂▃▄▅▆▇█"
+
+_POOL_LINE = re.compile(r"^\s*([A-Za-z_.]+)\s*=")
+_SLOW_HEADER = re.compile(r"^\[([^\]]+)\]\s+\[pool ([^\]]+)\]\s+pid (\d+)")
+_SLOW_FRAME = re.compile(r"^\[0x[0-9a-fA-F]+\]\s+(.+?)\s+(\S+:\d+)$")
+
+
+@dataclass
+class SlowEntry:
+    when: str
+    pid: int
+    script: str = ""
+    frames: list[tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def top(self) -> str:
+        return " ".join(self.frames[0]) if self.frames else "-"
+
+
+@dataclass
+class Saturation:
+    hostname: str
+    ok: bool = False
+    active: int = 0
+    idle: int = 0
+    total: int = 0
+    listen_queue: int = 0
+    max_listen_queue: int = 0
+    max_children_reached: int = 0
+    slow_requests: int = 0
+    samples: int = 0
+    spark: str = ""
+
+    @property
+    def saturated(self) -> bool:
+        return self.listen_queue > 0 or self.max_children_reached > 0 or (self.ok and self.total > 0 and self.idle == 0)
+
+
+def _supports_status_listen(php_version: str) -> bool:
+    try:
+        return tuple(int(part) for part in php_version.split(".")[:2]) >= (8, 0)
+    except ValueError:
+        return True
+
+
+def status_socket(domain: Domain) -> str:
+    """Socket answering the status page.
+
+    PHP >= 8.0 serves it from a separate ``pm.status_listen`` socket so a
+    saturated pool still reports instead of queueing the status request.
+    """
+
+    if _supports_status_listen(domain.php_version) and domain.php_socket_path:
+        return re.sub(r"\.sock$", "", domain.php_socket_path) + "-status.sock"
+    return domain.php_socket_path
+
+
+def slowlog_timeout(domain: Domain) -> int:
+    if domain.slowlog_timeout_s is not None:
+        return domain.slowlog_timeout_s
+    return int(_config_value("PHP_FPM_SLOWLOG_TIMEOUT", 5))
+
+
+def monitoring_directives(domain: Domain) -> list[str]:
+    lines = [f"pm.status_path = {_config_value('PHP_FPM_STATUS_PATH', '/fpm-status')}"]
+    if status_socket(domain) != domain.php_socket_path:
+        lines.append(f"pm.status_listen = {status_socket(domain)}")
+    lines += [
+        f"slowlog = {php_slow_log_path(domain.hostname)}",
+        f"request_slowlog_timeout = {slowlog_timeout(domain)}s",
+        f"request_slowlog_trace_depth = {int(_config_value('PHP_FPM_SLOWLOG_DEPTH', 20))}",
+    ]
+    return lines
+
+
+def ensure_slowlog_dir(domain: Domain) -> None:
+    """Create the slowlog directory; FPM refuses to start when it is missing.
+
+    Called wherever a pool carrying the monitoring block is written.
+    """
+
+    php_slow_log_path(domain.hostname).parent.mkdir(parents=True, exist_ok=True)
+
+
+def rewrite_pool(content: str, domain: Domain) -> str:
+    """Replace the status/slowlog block of a pool config, keeping every other line.
+
+    The block goes where the first old directive was, or after ``ping.response``.
+    """
+
+    lines: list[str] = []
+    insert_at: int | None = None
+    anchor: int | None = None
+    for line in content.splitlines():
+        match = _POOL_LINE.match(line)
+        key = match.group(1) if match else None
+        if key in MONITOR_KEYS:
+            if insert_at is None:
+                insert_at = len(lines)
+            continue
+        lines.append(line)
+        if key in ("ping.response", "ping.path"):
+            anchor = len(lines)
+
+    if insert_at is None:
+        insert_at = anchor if anchor is not None else len(lines)
+    lines[insert_at:insert_at] = monitoring_directives(domain)
+    return "\n".join(lines).strip() + "\n"
+
+
+def _pool_locks(domains: list[Domain]) -> list[str]:
+    keys = []
+    for domain in domains:
+        keys += [
+            domain_key(domain.hostname),
+            pool_key(domain.hostname),
+            fpm_lock_key(domain.php_version, domain_fpm_shard(domain)),
+        ]
+    return keys
+
+
+def update_slowlog_timeout(domain: Domain, timeout: int | None) -> CommandResult:
+    with locked(*_pool_locks([domain])):
+        return _update_slowlog_timeout(domain, timeout)
+
+
+def _update_slowlog_timeout(domain: Domain, timeout: int | None) -> CommandResult:
+    pool_path = Path(domain.php_fpm_pool_path)
+    original = read_file(pool_path)
+    domain.slowlog_timeout_s = timeout
+    ensure_slowlog_dir(domain)
+    atomic_write(pool_path, rewrite_pool(original, domain))
+
+    shard = domain_fpm_shard(domain)
+    reload_result = reload_php_fpm(domain.php_version, shard)
+    if not reload_result.success:
+        atomic_write(pool_path, original)
+        reload_php_fpm(domain.php_version, shard)
+        db.session.rollback()
+        return CommandResult(False, stderr=f"PHP-FPM reload failed:\n{reload_result.stderr}")
+
+    db.session.commit()
+    effective = slowlog_timeout(domain)
+    if not effective:
+        return CommandResult(True, stdout="Slow request logging turned off.")
+    return CommandResult(True, stdout=f"Requests slower than {effective}s are now traced.")
+
+
+def sync_pools() -> CommandResult:
+    """Add or refresh the status/slowlog block in every pool.
+
+    Each affected FPM master is reloaded once.
+    """
+
+    domains = Domain.query.order_by(Domain.hostname.asc()).all()
+    with locked(*_pool_locks(domains)):
+        masters: dict[tuple[str, int | None], list[tuple[Path, str]]] = {}
+        for domain in domains:
+            pool_path = Path(domain.php_fpm_pool_path)
+            content = read_file(pool_path)
+            if not content:
+                continue
+            updated = rewrite_pool(content, domain)
+            if updated != content:
+                ensure_slowlog_dir(domain)
+                atomic_write(pool_path, updated)
+                masters.setdefault((domain.php_version, domain_fpm_shard(domain)), []).append((pool_path, content))
+
+        errors = []
+        for (version, shard), originals in sorted(masters.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+            result = reload_php_fpm(version, shard)
+            if not result.success:
+                for pool_path, content in originals:
+                    atomic_write(pool_path, content)
+                reload_php_fpm(version, shard)
+                errors.append(f"PHP {version}: {result.stderr}")
+    if errors:
+        return CommandResult(False, stderr="PHP-FPM reload failed:\n" + "\n".join(errors))
+    rewritten = sum(len(originals) for originals in masters.values())
+    return CommandResult(True, stdout=f"{rewritten} pool(s) updated, {len(masters)} master(s) reloaded.")
+
+
+def _parse_status(body: bytes) -> dict | None:
+    _, _, payload = body.partition(b"\r\n\r\n")
+    try:
+        return json.loads(payload or body)
+    except ValueError:
+        return None
+
+
+def poll_pools() -> dict[str, list]:
+    """Fetch every pool's status page concurrently; one sample row per hostname."""
+
+    if _simulate():
+        return {}
+    rows = db.session.query(Domain.hostname, Domain.php_version, Domain.php_socket_path).all()
+    now = round(time.time(), 1)
+
+    sockets = {row.hostname: status_socket(row) for row in rows}
+    probes = request_pools(
+        list(sockets.values()),
+        fcgi_get_request(_config_value("PHP_FPM_STATUS_PATH", "/fpm-status"), "json"),
+        timeout=float(_config_value("FPM_STATUS_TIMEOUT", 1.0)),
+        batch_size=int(_config_value("HEALTH_PROBE_BATCH", 512)),
+    )
+    samples: dict[str, list] = {}
+    for hostname, socket_path in sockets.items():
+        probe = probes.get(socket_path)
+        status = _parse_status(probe.body) if probe is not None and probe.ok else None
+        if status is None:
+            samples[hostname] = [now, 0, 0, 0, 0, 0, 0, 0]
+            continue
+        samples[hostname] = [
+            now,
+            1,
+            int(status.get("active processes", 0)),
+            int(status.get("idle processes", 0)),
+            int(status.get("total processes", 0)),
+            int(status.get("listen queue", 0)),
+            int(status.get("max children reached", 0)),
+            int(status.get("slow requests", 0)),
+        ]
+    return samples
+
+
+def samples_path() -> Path:
+    return Path(_config_value("FPM_STATUS_FILE"))
+
+
+class SampleRing:
+    """Fixed-size per-pool history of status samples."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.pools: dict[str, deque] = {}
+
+    def add(self, samples: dict[str, list]) -> None:
+        for hostname in list(self.pools):
+            if hostname not in samples:
+                del self.pools[hostname]
+        for hostname, sample in samples.items():
+            self.pools.setdefault(hostname, deque(maxlen=self.size)).append(sample)
+
+    @classmethod
+    def load(cls, size: int) -> SampleRing:
+        ring = cls(size)
+        data = read_samples()
+        for hostname, rows in data.get("pools", {}).items():
+            ring.pools[hostname] = deque(rows, maxlen=size)
+        return ring
+
+    def save(self, interval: float) -> None:
+        path = samples_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        payload = {
+            "interval": interval,
+            "updated_at": time.time(),
+            "fields": FIELDS,
+            "pools": {hostname: list(rows) for hostname, rows in self.pools.items()},
+        }
+        fd, name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(payload, handle, separators=(",", ":"))
+        os.replace(name, path)
+
+
+def watch(iterations: int | None = None) -> None:
+    """Poll all pools every ``EZYPANEL_FPM_STATUS_INTERVAL`` seconds.
+
+    Samples go to a ring buffer that is written to ``EZYPANEL_FPM_STATUS_FILE``
+    after each round, so every panel worker reads the same history.
+    """
+
+    interval = float(_config_value("FPM_STATUS_INTERVAL", 5))
+    ring = SampleRing.load(int(_config_value("FPM_STATUS_SAMPLES", 720)))
+    count = 0
+    while iterations is None or count < iterations:
+        started = time.monotonic()
+        try:
+            ring.add(poll_pools())
+            ring.save(interval)
+        finally:
+            # End the read transaction so new domains show up next round.
+            db.session.remove()
+        count += 1
+        logger.debug("fpm_status_poll pools=%s duration_ms=%.1f", len(ring.pools), (time.monotonic() - started) * 1000)
+        if iterations is None or count < iterations:
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+_read_cache: dict[str, tuple[int, dict]] = {}
+_read_lock = threading.Lock()
+
+
+def read_samples() -> dict:
+    path = samples_path()
+    try:
+        mtime = path.stat().st_mtime_ns
+    except OSError:
+        return {}
+    with _read_lock:
+        cached = _read_cache.get(str(path))
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return {}
+        _read_cache[str(path)] = (mtime, data)
+    return data
+
+
+def _spark(values: list[int], scale: int) -> str:
+    if not values or scale <= 0:
+        return ""
+    return "".join(SPARK[min(value * (len(SPARK) - 1) // scale, len(SPARK) - 1)] for value in values)
+
+
+def saturation(hostnames: list[str], window: int | None = None) -> dict[str, Saturation]:
+    """Summarise each pool's ring buffer over the last ``window`` samples.
+
+    Counters from the status page are cumulative; their increase over the
+    window is reported (a reload resets them, so a drop starts over).
+    """
+
+    window = window or int(_config_value("FPM_STATUS_WINDOW", 60))
+    pools = read_samples().get("pools", {})
+    result: dict[str, Saturation] = {}
+    for hostname in hostnames:
+        summary = Saturation(hostname)
+        rows = [dict(zip(FIELDS, row)) for row in pools.get(hostname, [])[-window:]]
+        result[hostname] = summary
+        if not rows:
+            continue
+        latest = rows[-1]
+        summary.ok = bool(latest["ok"])
+        summary.samples = len(rows)
+        summary.active = latest["active"]
+        summary.idle = latest["idle"]
+        summary.total = latest["total"]
+        summary.listen_queue = latest["listen_queue"]
+        summary.max_listen_queue = max(row["listen_queue"] for row in rows)
+        up = [row for row in rows if row["ok"]]
+        for counter in ("max_children_reached", "slow_requests"):
+            increase = 0
+            for before, after in zip(up, up[1:]):
+                delta = after[counter] - before[counter]
+                increase += delta if delta >= 0 else after[counter]
+            setattr(summary, counter, increase)
+        summary.spark = _spark([row["active"] for row in rows], max(row["total"] for row in rows))
+    return result
+
+
+def read_slowlog(hostname: str, limit: int = 50) -> list[SlowEntry]:
+    """Parse the newest entries of a pool's slowlog, newest first.
+
+    Only the tail of the file (``EZYPANEL_FPM_SLOWLOG_TAIL_KB``) is read.
+    """
+
+    path = php_slow_log_path(hostname)
+    tail = int(_config_value("FPM_SLOWLOG_TAIL_KB", 512)) * 1024
+    try:
+        with open(path, "rb") as handle:
+            size = handle.seek(0, os.SEEK_END)
+            handle.seek(max(size - tail, 0))
+            text = handle.read().decode(errors="replace")
+    except OSError:
+        return []
+
+    entries: list[SlowEntry] = []
+    current: SlowEntry | None = None
+    for line in text.splitlines():
+        line = line.strip()
+        header = _SLOW_HEADER.match(line)
+        if header:
+            current = SlowEntry(when=header.group(1), pid=int(header.group(3)))
+            entries.append(current)
+        elif current is None:
+            # Partial entry cut off by the tail read.
+            continue
+        elif line.startswith("script_filename"):
+            current.script = line.partition("=")[2].strip()
+        else:
+            frame = _SLOW_FRAME.match(line)
+            if frame:
+                current.frames.append((frame.group(1), frame.group(2)))
+    return list(reversed(entries))[:limit]
+
+
+def hot_frames(entries: list[SlowEntry], top: int = 10) -> list[tuple[str, int]]:
+    """Most common innermost frames: where slow requests were caught running."""
+
+    return Counter(entry.top for entry in entries if entry.frames).most_common(top)
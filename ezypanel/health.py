@@ -0,0 +1,344 @@
+from __future__ import annotations
+
+import errno
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from .extensions import db
+from .models import Domain
+from .services import _config_value, _simulate
+
+logger = logging.getLogger(__name__)
+
+FCGI_VERSION = 1
+FCGI_BEGIN_REQUEST = 1
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_RESPONDER = 1
+
+_cache: dict[str, tuple[float, object]] = {}
+_cache_lock = threading.Lock()
+
+
+@dataclass
+class PoolProbe:
+    socket_path: str
+    ok: bool = False
+    error: str = ""
+    latency_ms: float = 0.0
+    body: bytes = field(default=b"", repr=False)
+
+
+@dataclass
+class DomainHealth:
+    id: int
+    hostname: str
+    enabled: bool
+    pool: str = "unknown"
+    vhost: str = "unknown"
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        data["ok"] = self.ok
+        return data
+
+
+def _fcgi_record(record_type: int, content: bytes, request_id: int = 1) -> bytes:
+    padding = -len(content) % 8
+    header = struct.pack(
+        "!BBHHBx", FCGI_VERSION, record_type, request_id, len(content), padding
+    )
+    return header + content + b"\x00" * padding
+
+
+def _fcgi_pair(name: str, value: str) -> bytes:
+    encoded = b""
+    for item in (name.encode(), value.encode()):
+        size = len(item)
+        encoded += bytes([size]) if size < 128 else struct.pack("!I", size | 0x80000000)
+    return encoded + name.encode() + value.encode()
+
+
+def fcgi_get_request(path: str, query: str = "") -> bytes:
+    """Build a complete FastCGI GET request for a pool-internal path."""
+
+    params = b"".join(
+        _fcgi_pair(name, value)
+        for name, value in (
+            ("GATEWAY_INTERFACE", "CGI/1.1"),
+            ("REQUEST_METHOD", "GET"),
+            ("SCRIPT_NAME", path),
+            ("SCRIPT_FILENAME", path),
+            ("REQUEST_URI", f"{path}?{query}" if query else path),
+            ("QUERY_STRING", query),
+        )
+    )
+    return (
+        _fcgi_record(FCGI_BEGIN_REQUEST, struct.pack("!HB5x", FCGI_RESPONDER, 0))
+        + _fcgi_record(FCGI_PARAMS, params)
+        + _fcgi_record(FCGI_PARAMS, b"")
+        + _fcgi_record(FCGI_STDIN, b"")
+    )
+
+
+def fcgi_ping_request(ping_path: str) -> bytes:
+    """Build a complete FastCGI GET request for the pool's ``ping.path``."""
+
+    return fcgi_get_request(ping_path)
+
+
+def parse_fcgi_stdout(buffer: bytes) -> tuple[bytes, bool]:
+    """Return ``(stdout, finished)`` from the FastCGI records read so far."""
+
+    stdout = b""
+    offset = 0
+    while len(buffer) - offset >= 8:
+        _, record_type, _, length, padding = struct.unpack_from("!BBHHBx", buffer, offset)
+        end = offset + 8 + length + padding
+        if end > len(buffer):
+            break
+        if record_type == FCGI_STDOUT:
+            stdout += buffer[offset + 8 : offset + 8 + length]
+        elif record_type == FCGI_END_REQUEST:
+            return stdout, True
+        offset = end
+    return stdout, False
+
+
+class _Probe:
+    def __init__(self, socket_path: str, request: bytes) -> None:
+        self.result = PoolProbe(socket_path)
+        self.outgoing = request
+        self.incoming = b""
+        self.started = time.monotonic()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+
+    def finish(self, ok: bool, error: str = "") -> None:
+        self.result.ok = ok
+        self.result.error = error
+        self.result.latency_ms = round((time.monotonic() - self.started) * 1000, 2)
+        self.sock.close()
+
+
+def probe_pools(
+    socket_paths: list[str],
+    timeout: float,
+    ping_path: str,
+    expected: str,
+    batch_size: int = 512,
+) -> dict[str, PoolProbe]:
+    """Ping every FPM socket concurrently from a single selector loop.
+
+    Each probe is a non-blocking connect followed by one FastCGI request for
+    ``ping.path``; all probes in a batch share one ``timeout`` deadline, so the
+    cost is bounded by the slowest pool rather than the sum of all pools.
+    ``batch_size`` caps how many descriptors are open at once.
+    """
+
+    return request_pools(socket_paths, fcgi_ping_request(ping_path), timeout, expected.encode(), batch_size)
+
+
+def request_pools(
+    socket_paths: list[str],
+    request: bytes,
+    timeout: float,
+    expected: bytes | None = None,
+    batch_size: int = 512,
+) -> dict[str, PoolProbe]:
+    """Send one FastCGI ``request`` to every socket from a single selector loop.
+
+    A probe is ok once the pool answered (and its output contains
+    ``expected``, when given); the output is kept in ``PoolProbe.body``.
+    """
+
+    unique = list(dict.fromkeys(socket_paths))
+    results: dict[str, PoolProbe] = {}
+    for start in range(0, len(unique), max(batch_size, 1)):
+        batch = unique[start : start + max(batch_size, 1)]
+        results.update(_probe_batch(batch, request, expected, timeout))
+    return results
+
+
+def _probe_batch(paths: list[str], request: bytes, expected_bytes: bytes | None, timeout: float) -> dict[str, PoolProbe]:
+    results: dict[str, PoolProbe] = {}
+    selector = selectors.DefaultSelector()
+    opened: list[_Probe] = []
+    pending = 0
+
+    try:
+        for path in paths:
+            try:
+                probe = _Probe(path, request)
+            except OSError as exc:
+                # Out of descriptors: report it rather than lose the batch.
+                results[path] = PoolProbe(path, error=exc.strerror or str(exc))
+                continue
+            opened.append(probe)
+            results[path] = probe.result
+            try:
+                # AF_UNIX paths longer than sun_path (108 bytes) raise here.
+                code = probe.sock.connect_ex(path)
+            except OSError as exc:
+                probe.finish(False, exc.strerror or str(exc))
+                continue
+            if code not in (0, errno.EINPROGRESS, errno.EAGAIN):
+                probe.finish(False, os.strerror(code))
+                continue
+            selector.register(probe.sock, selectors.EVENT_WRITE, probe)
+            pending += 1
+
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, events in selector.select(remaining):
+                probe: _Probe = key.data
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        error = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        if error:
+                            raise OSError(error, os.strerror(error))
+                        sent = probe.sock.send(probe.outgoing)
+                        probe.outgoing = probe.outgoing[sent:]
+                        if not probe.outgoing:
+                            selector.modify(probe.sock, selectors.EVENT_READ, probe)
+                        continue
+
+                    chunk = probe.sock.recv(4096)
+                    probe.incoming += chunk
+                    stdout, finished = parse_fcgi_stdout(probe.incoming)
+                    if not (finished or not chunk):
+                        continue
+                    selector.unregister(probe.sock)
+                    pending -= 1
+                    probe.result.body = stdout
+                    if expected_bytes is None or expected_bytes in stdout:
+                        probe.finish(True)
+                    else:
+                        probe.finish(False, "unexpected ping response")
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError as exc:
+                    selector.unregister(probe.sock)
+                    pending -= 1
+                    probe.finish(False, exc.strerror or str(exc))
+
+        for key in list(selector.get_map().values()):
+            selector.unregister(key.fileobj)
+            key.data.finish(False, "timeout")
+    finally:
+        selector.close()
+        for probe in opened:
+            probe.sock.close()
+    return results
+
+
+def _vhost_status(hostname: str, nginx_config_path: str) -> str:
+    enabled_link = Path(_config_value("NGINX_ENABLED_DIR")) / f"{hostname}.conf"
+    if not enabled_link.is_symlink() and not enabled_link.exists():
+        return "missing sites-enabled link"
+    if not enabled_link.exists():
+        return "dangling sites-enabled link"
+    if enabled_link.is_symlink() and os.path.realpath(enabled_link) != os.path.realpath(nginx_config_path):
+        return "sites-enabled link points elsewhere"
+    return "ok"
+
+
+def _check_all() -> dict:
+    started = time.monotonic()
+    rows = db.session.query(
+        Domain.id,
+        Domain.hostname,
+        Domain.enabled,
+        Domain.php_socket_path,
+        Domain.nginx_config_path,
+    ).all()
+
+    simulate = _simulate()
+    probes: dict[str, PoolProbe] = {}
+    if not simulate:
+        probes = probe_pools(
+            [row.php_socket_path for row in rows],
+            timeout=float(_config_value("HEALTH_PROBE_TIMEOUT", 0.5)),
+            ping_path=_config_value("PHP_FPM_PING_PATH", "/ping"),
+            expected=_config_value("PHP_FPM_PING_RESPONSE", "pong"),
+            batch_size=int(_config_value("HEALTH_PROBE_BATCH", 512)),
+        )
+
+    domains: dict[int, DomainHealth] = {}
+    for row in rows:
+        health = DomainHealth(row.id, row.hostname, bool(row.enabled))
+        probe = probes.get(row.php_socket_path)
+        if simulate:
+            health.pool = "simulated"
+        elif probe is not None:
+            health.pool = "ok" if probe.ok else probe.error
+            if not probe.ok:
+                health.errors.append(f"pool: {probe.error}")
+        if row.enabled:
+            health.vhost = _vhost_status(row.hostname, row.nginx_config_path)
+            if health.vhost != "ok":
+                health.errors.append(f"vhost: {health.vhost}")
+        else:
+            health.vhost = "disabled"
+        domains[row.id] = health
+
+    failing = [health for health in domains.values() if not health.ok]
+    return {
+        "status": "ok" if not failing else "degraded",
+        "checked_at": time.time(),
+        "duration_ms": round((time.monotonic() - started) * 1000, 2),
+        "simulated": simulate,
+        "domains_total": len(domains),
+        "domains_failing": len(failing),
+        "failures": [health.as_dict() for health in failing],
+        "_domains": domains,
+    }
+
+
+def health_report() -> dict:
+    """Return the cached health report, re-probing at most once per TTL.
+
+    The lock also collapses concurrent requests in a threaded worker into a
+    single probe round.
+    """
+
+    ttl = float(_config_value("HEALTH_CACHE_SECONDS", 2))
+    with _cache_lock:
+        cached = _cache.get("report")
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        report = _check_all()
+        _cache["report"] = (time.monotonic(), report)
+    logger.debug(
+        "health_report status=%s domains=%s failing=%s duration_ms=%s",
+        report["status"],
+        report["domains_total"],
+        report["domains_failing"],
+        report["duration_ms"],
+    )
+    return report
+
+
+def domain_health(domain_id: int) -> DomainHealth | None:
+    return health_report()["_domains"].get(domain_id)
+
+
+def public_report(report: dict) -> dict:
+    return {key: value for key, value in report.items() if not key.startswith("_")}
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import fcntl
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterator
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+# Resource keys. Every operation takes all of its keys up front, in sorted
+# order, so two operations can never wait on each other in a cycle.
+NGINX = "nginx"  # global nginx -t / reload
+
+
+def domain_key(hostname: str) -> str:
+    return f"domain:{hostname}"
+
+
+def vhost_key(hostname: str) -> str:
+    return f"vhost:{hostname}"
+
+
+def pool_key(hostname: str) -> str:
+    return f"pool:{hostname}"
+
+
+def fpm_key(service_name: str) -> str:
+    return f"fpm:{service_name}"
+
+
+class LockTimeout(RuntimeError):
+    def __init__(self, key: str, timeout: float) -> None:
+        super().__init__(
+            f"Another operation is still holding {key} (waited {timeout:g}s); try again shortly."
+        )
+        self.key = key
+
+
+@dataclass
+class LockStats:
+    acquired: int = 0
+    contended: int = 0
+    timeouts: int = 0
+    wait_ms_total: float = 0.0
+    wait_ms_max: float = 0.0
+
+
+_held = threading.local()
+_stats: dict[str, LockStats] = {}
+_stats_lock = threading.Lock()
+_SAFE = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def _held_locks() -> dict[str, int]:
+    """Per-thread map of key -> locked fd, so nested calls are reentrant."""
+
+    if not hasattr(_held, "locks"):
+        _held.locks = {}
+    return _held.locks
+
+
+def _lock_path(key: str) -> Path:
+    directory = Path(current_app.config["LOCK_DIR"])
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory / (_SAFE.sub("_", key) + ".lock")
+
+
+def _record(key: str, waited_ms: float, timed_out: bool = False) -> None:
+    kind = key.split(":", 1)[0]
+    with _stats_lock:
+        stats = _stats.setdefault(kind, LockStats())
+        if timed_out:
+            stats.timeouts += 1
+            return
+        stats.acquired += 1
+        stats.wait_ms_total += waited_ms
+        stats.wait_ms_max = max(stats.wait_ms_max, waited_ms)
+        if waited_ms >= 1:
+            stats.contended += 1
+
+
+def _acquire(key: str, deadline: float, timeout: float) -> int:
+    fd = os.open(_lock_path(key), os.O_RDWR | os.O_CREAT, 0o644)
+    started = time.monotonic()
+    delay = 0.005
+    while True:
+        try:
+            # flock locks belong to the open file description, so they also
+            # exclude other threads of this process that opened the file.
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                os.close(fd)
+                _record(key, 0, timed_out=True)
+                logger.warning("lock_timeout key=%s timeout=%s", key, timeout)
+                raise LockTimeout(key, timeout) from None
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 0.1)
+
+    waited_ms = (time.monotonic() - started) * 1000
+    _record(key, waited_ms)
+    if waited_ms >= float(current_app.config.get("LOCK_SLOW_MS", 100)):
+        logger.info("lock_wait key=%s wait_ms=%.1f", key, waited_ms)
+    return fd
+
+
+@contextmanager
+def locked(*keys: str, timeout: float | None = None) -> Iterator[None]:
+    """Hold exclusive cross-process locks on ``keys`` for the block.
+
+    Keys already held by this thread are skipped (reentrant), the rest are
+    taken in sorted order. ``LockTimeout`` is raised if any key cannot be had
+    within ``timeout`` seconds (``EZYPANEL_LOCK_TIMEOUT`` by default); keys
+    taken so far are released first.
+    """
+
+    if timeout is None:
+        timeout = float(current_app.config.get("LOCK_TIMEOUT", 30))
+    held = _held_locks()
+    wanted = sorted({key for key in keys if key not in held})
+    if held and wanted and wanted[0] < max(held):
+        # Still safe thanks to the timeout, but it means a caller forgot to
+        # take this key up front.
+        logger.warning("lock_order nested=%s held=%s", wanted, sorted(held))
+
+    deadline = time.monotonic() + timeout
+    acquired: list[str] = []
+    try:
+        for key in wanted:
+            held[key] = _acquire(key, deadline, timeout)
+            acquired.append(key)
+        yield
+    finally:
+        for key in reversed(acquired):
+            fd = held.pop(key)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def lock_metrics() -> dict:
+    """Wait-time counters for this process, grouped by resource kind."""
+
+    with _stats_lock:
+        resources = {
+            kind: {
+                **asdict(stats),
+                "wait_ms_avg": round(stats.wait_ms_total / stats.acquired, 2) if stats.acquired else 0.0,
+                "wait_ms_total": round(stats.wait_ms_total, 2),
+                "wait_ms_max": round(stats.wait_ms_max, 2),
+            }
+            for kind, stats in sorted(_stats.items())
+        }
+    return {"pid": os.getpid(), "resources": resources}
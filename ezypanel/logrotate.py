@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import gzip
+import logging
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import current_app
+
+from .extensions import db
+from .models import Domain, RotatedLog
+from .services import (
+    CommandResult,
+    _config_value,
+    _remove_path,
+    domain_fpm_shard,
+    domain_paths,
+    signal_nginx,
+    signal_php_fpm,
+)
+
+logger = logging.getLogger(__name__)
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+@dataclass
+class PendingRotation:
+    domain: Domain
+    log_name: str
+    source: Path
+    target: Path
+    size_bytes: int
+    php: bool = False
+
+
+def php_error_log_path(hostname: str) -> Path:
+    # Matches php_admin_value[error_log] in config_templates/php-fpm.conf.tpl
+    return Path(_config_value("DATA_DIR")) / "logs" / "php" / f"{hostname}-error.log"
+
+
+def php_slow_log_path(hostname: str) -> Path:
+    # Matches the pool's ``slowlog`` written by fpm_status.monitoring_directives
+    return Path(_config_value("DATA_DIR")) / "logs" / "php" / f"{hostname}-slow.log"
+
+
+def domain_log_files(domain: Domain) -> list[tuple[str, Path, bool]]:
+    """Return ``(log_name, path, is_php_log)`` for every live log of a domain."""
+
+    log_dir = domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)["log_dir"]
+    files: list[tuple[str, Path, bool]] = []
+    if log_dir.is_dir():
+        for path in sorted(log_dir.glob("*.log")):
+            files.append((path.name, path, False))
+    files.append(("php-error.log", php_error_log_path(domain.hostname), True))
+    files.append(("php-slow.log", php_slow_log_path(domain.hostname), True))
+    return files
+
+
+def _setting(domain: Domain, attribute: str, config_key: str) -> int:
+    value = getattr(domain, attribute)
+    if value is None:
+        value = _config_value(config_key)
+    return int(value)
+
+
+def _last_rotation(domain: Domain, log_name: str) -> datetime:
+    latest = (
+        db.session.query(db.func.max(RotatedLog.rotated_at))
+        .filter(RotatedLog.domain_id == domain.id, RotatedLog.log_name == log_name)
+        .scalar()
+    )
+    return latest or domain.created_at
+
+
+def _due_rotations(domain: Domain, now: datetime, force: bool) -> list[PendingRotation]:
+    max_bytes = _setting(domain, "log_rotate_max_mb", "LOG_ROTATE_MAX_MB") * 1024 * 1024
+    interval = timedelta(
+        hours=_setting(domain, "log_rotate_interval_hours", "LOG_ROTATE_INTERVAL_HOURS")
+    )
+    stamp = now.strftime("%Y%m%dT%H%M%S")
+
+    pending: list[PendingRotation] = []
+    for log_name, path, is_php in domain_log_files(domain):
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            continue
+        if size == 0:
+            continue
+        # A 0 MB limit (EZYPANEL_LOG_ROTATE_MAX_MB=0) disables the size trigger.
+        due = force or (max_bytes > 0 and size >= max_bytes)
+        if not due and interval.total_seconds() > 0:
+            due = now - _last_rotation(domain, log_name) >= interval
+        if due:
+            target = path.with_name(f"{path.name}-{stamp}")
+            pending.append(PendingRotation(domain, log_name, path, target, size, is_php))
+    return pending
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(_config_value("LOG_ROTATE_WORKERS", 2))
+            _executor = ThreadPoolExecutor(
+                max_workers=max(workers, 1), thread_name_prefix="ezypanel-logrotate"
+            )
+    return _executor
+
+
+def _compress(app, rotated_id: int, source: Path, delay: float) -> None:
+    # Give nginx/FPM a moment to finish reopening before the old inode is read.
+    if delay > 0:
+        time.sleep(delay)
+
+    target = source.with_name(source.name + ".gz")
+    partial = target.with_name(target.name + ".tmp")
+    try:
+        with source.open("rb") as src, gzip.open(partial, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        partial.replace(target)
+        source.unlink()
+    except OSError as exc:
+        logger.warning("compress_log failed path=%s error=%s", source, exc)
+        partial.unlink(missing_ok=True)
+        return
+
+    with app.app_context():
+        rotated = db.session.get(RotatedLog, rotated_id)
+        if rotated is not None:
+            rotated.path = str(target)
+            rotated.size_bytes = target.stat().st_size
+            rotated.compressed = True
+            db.session.commit()
+    logger.debug("compress_log done path=%s", target)
+
+
+def _prune(domain: Domain, log_name: str) -> None:
+    keep = _setting(domain, "log_rotate_keep", "LOG_ROTATE_KEEP")
+    expired = (
+        RotatedLog.query.filter_by(domain_id=domain.id, log_name=log_name)
+        .order_by(RotatedLog.rotated_at.desc())
+        .offset(max(keep, 0))
+        .all()
+    )
+    for rotated in expired:
+        _remove_path(Path(rotated.path))
+        db.session.delete(rotated)
+
+
+def rotate_logs(domains: list[Domain] | None = None, force: bool = False) -> CommandResult:
+    """Rotate due logs for ``domains`` (all domains by default) in one batch.
+
+    Every due file is renamed first, then nginx and each affected PHP-FPM
+    master are signalled once to reopen their logs, and finally the renamed
+    files are compressed on a background thread pool.
+    """
+
+    if domains is None:
+        domains = Domain.query.order_by(Domain.hostname.asc()).all()
+
+    now = datetime.utcnow()
+    pending: list[PendingRotation] = []
+    for domain in domains:
+        pending.extend(_due_rotations(domain, now, force))
+
+    if not pending:
+        return CommandResult(True, stdout="No logs due for rotation.")
+
+    rotated: list[tuple[PendingRotation, RotatedLog]] = []
+    errors: list[str] = []
+    for item in pending:
+        try:
+            item.source.rename(item.target)
+        except OSError as exc:
+            errors.append(f"{item.source}: {exc}")
+            continue
+        record = RotatedLog(
+            domain=item.domain,
+            log_name=item.log_name,
+            path=str(item.target),
+            size_bytes=item.size_bytes,
+            rotated_at=now,
+        )
+        db.session.add(record)
+        rotated.append((item, record))
+
+    signals: list[CommandResult] = []
+    if any(not item.php for item, _ in rotated):
+        signals.append(signal_nginx("USR1"))
+    masters = {
+        (item.domain.php_version, domain_fpm_shard(item.domain)) for item, _ in rotated if item.php
+    }
+    for version, shard in sorted(masters, key=lambda master: (master[0], master[1] or 0)):
+        signals.append(signal_php_fpm(version, "USR1", shard))
+    errors.extend(result.stderr for result in signals if not result.success)
+
+    db.session.flush()
+    for domain, log_name in {(item.domain, item.log_name) for item, _ in rotated}:
+        _prune(domain, log_name)
+    db.session.commit()
+
+    app = current_app._get_current_object()
+    delay = float(_config_value("LOG_ROTATE_COMPRESS_DELAY", 5))
+    executor = _get_executor()
+    for item, record in rotated:
+        executor.submit(_compress, app, record.id, item.target, delay)
+
+    logger.info(
+        "rotate_logs rotated=%s signals=%s errors=%s", len(rotated), len(signals), len(errors)
+    )
+    if errors:
+        return CommandResult(False, stderr="; ".join(errors))
+    return CommandResult(True, stdout=f"Rotated {len(rotated)} log file(s).")
+
+
+def remove_rotated_logs(domain: Domain) -> None:
+    """Delete rotated files that live outside the domain's log directory."""
+
+    for rotated in domain.rotated_logs:
+        _remove_path(Path(rotated.path))
+    _remove_path(php_error_log_path(domain.hostname))
+    _remove_path(php_slow_log_path(domain.hostname))
+
+
+def wait_for_compression() -> None:
+    """Block until queued compressions finish (used by the CLI command)."""
+
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
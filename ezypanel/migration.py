@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import current_app
+
+from . import fpm_status, sessions
+from .extensions import db
+from .health import probe_pools
+from .locks import NGINX, LockTimeout, locked, pool_key, vhost_key
+from .models import Domain, PoolDrain
+from .services import (
+    CommandResult,
+    _config_value,
+    _remove_path,
+    _simulate,
+    atomic_write,
+    domain_fpm_shard,
+    domain_paths,
+    fpm_lock_key,
+    fpm_shard,
+    read_file,
+    reload_php_fpm,
+    signal_nginx,
+    test_nginx,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PoolSide:
+    version: str
+    pool_path: Path
+    socket_path: str
+    shard: int | None
+
+
+def wait_for_pool(socket_path: str, timeout: float) -> bool:
+    """Poll the pool's FPM ping until it answers or ``timeout`` expires."""
+
+    if _simulate():
+        return True
+
+    deadline = time.monotonic() + timeout
+    ping_path = _config_value("PHP_FPM_PING_PATH", "/ping")
+    expected = _config_value("PHP_FPM_PING_RESPONSE", "pong")
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        probe = probe_pools([socket_path], min(remaining, 0.5), ping_path, expected)[socket_path]
+        if probe.ok:
+            return True
+        time.sleep(min(0.2, max(deadline - time.monotonic(), 0)))
+
+
+def _green_locks(hostname: str, green: PoolSide) -> tuple[str, str]:
+    return pool_key(hostname), fpm_lock_key(green.version, green.shard)
+
+
+def _retire_green(hostname: str, green: PoolSide) -> None:
+    with locked(*_green_locks(hostname, green)):
+        _remove_path(green.pool_path)
+        reload_php_fpm(green.version, green.shard)
+
+
+def _finish_drain(drain: PoolDrain) -> CommandResult:
+    with locked(pool_key(drain.hostname), fpm_lock_key(drain.php_version, drain.fpm_shard)):
+        domain = Domain.query.filter_by(hostname=drain.hostname).first()
+        if domain is not None and domain.php_fpm_pool_path == drain.pool_path:
+            # Switched back to this version before the drain ran.
+            result = CommandResult(True, stdout=f"{drain.pool_path} is in use again; kept.")
+        else:
+            _remove_path(Path(drain.pool_path))
+            result = reload_php_fpm(drain.php_version, drain.fpm_shard)
+    if result.success:
+        db.session.delete(drain)
+        db.session.commit()
+    logger.info(
+        "migrate_php_version drained hostname=%s version=%s success=%s",
+        drain.hostname,
+        drain.php_version,
+        result.success,
+    )
+    return result
+
+
+def finish_due_drains() -> list[tuple[PoolDrain, CommandResult]]:
+    """Remove every blue pool whose drain period is over.
+
+    Picks up drains whose thread never ran to the end (worker restarted, lock
+    timeout, failed reload); called at startup and by ``panel php-drains``.
+    """
+
+    results = []
+    due = PoolDrain.query.filter(PoolDrain.due_at <= datetime.utcnow()).order_by(PoolDrain.due_at.asc()).all()
+    for drain in due:
+        try:
+            results.append((drain, _finish_drain(drain)))
+        except LockTimeout as exc:
+            logger.warning("migrate_php_version drain_skipped hostname=%s error=%s", drain.hostname, exc)
+            results.append((drain, CommandResult(False, stderr=str(exc))))
+    return results
+
+
+def _drain_blue(app, drain_id: int, delay: float) -> None:
+    # nginx workers that still hold requests on the old socket finish them
+    # during this window; FPM's own graceful reload covers the remainder.
+    # The thread is only the fast path: the PoolDrain row outlives it.
+    time.sleep(delay)
+    with app.app_context():
+        try:
+            drain = db.session.get(PoolDrain, drain_id)
+            if drain is not None:
+                _finish_drain(drain)
+        except LockTimeout as exc:
+            logger.warning("migrate_php_version drain_skipped drain_id=%s error=%s", drain_id, exc)
+        finally:
+            db.session.remove()
+
+
+def _green_pool_content(domain: Domain, content: str, blue: PoolSide, green: PoolSide) -> str:
+    """Retarget a pool config at the green side.
+
+    The status socket and session block are derived from the PHP version and
+    socket, so they are re-rendered rather than string-replaced; otherwise
+    both masters would bind the same status socket.
+    """
+
+    target = Domain(
+        hostname=domain.hostname,
+        php_version=green.version,
+        php_fpm_pool_path=str(green.pool_path),
+        php_socket_path=green.socket_path,
+        fpm_shard=domain.fpm_shard,
+        slowlog_timeout_s=domain.slowlog_timeout_s,
+        session_backend=domain.session_backend,
+    )
+    content = content.replace(blue.socket_path, green.socket_path)
+    content = fpm_status.rewrite_pool(content, target)
+    content = sessions.rewrite_pool(content, target, sessions.session_backend(target))
+    fpm_status.ensure_slowlog_dir(target)
+    return content
+
+
+def migrate_php_version(domain: Domain, content: str, php_version: str) -> CommandResult:
+    """Move a domain to another PHP version without a window of 502s.
+
+    1. Write the new-version ("green") pool and reload its master.
+    2. Wait until the green socket answers an FPM ping.
+    3. Point ``fastcgi_pass`` at the green socket and gracefully reload nginx.
+    4. After a drain period, remove the old ("blue") pool and reload its master.
+
+    If the green pool never becomes healthy, or nginx rejects the switched
+    config, everything is rolled back and the domain keeps serving from blue.
+
+    The caller holds the domain lock. The pool/FPM locks are only taken while
+    the green pool is written and the nginx lock only for the vhost swap, so
+    other domains are not held up while the green pool starts.
+    """
+
+    blue = PoolSide(
+        domain.php_version,
+        Path(domain.php_fpm_pool_path),
+        domain.php_socket_path,
+        domain_fpm_shard(domain),
+    )
+    paths = domain_paths(domain.hostname, php_version, domain.fpm_shard)
+    green = PoolSide(
+        php_version,
+        paths["php_pool"],
+        str(paths["php_socket"]),
+        fpm_shard(domain.hostname, domain.fpm_shard),
+    )
+    logger.info(
+        "migrate_php_version hostname=%s from=%s to=%s", domain.hostname, blue.version, green.version
+    )
+
+    with locked(*_green_locks(domain.hostname, green)):
+        atomic_write(green.pool_path, _green_pool_content(domain, content, blue, green))
+        started = reload_php_fpm(green.version, green.shard)
+        if not started.success:
+            _retire_green(domain.hostname, green)
+            return CommandResult(False, stderr=f"PHP-FPM {green.version} reload failed:\n{started.stderr}")
+
+    timeout = float(_config_value("PHP_MIGRATION_READY_TIMEOUT", 15))
+    if not wait_for_pool(green.socket_path, timeout):
+        logger.warning("migrate_php_version green_unhealthy hostname=%s socket=%s", domain.hostname, green.socket_path)
+        _retire_green(domain.hostname, green)
+        return CommandResult(
+            False,
+            stderr=(
+                f"PHP {green.version} pool did not answer its health check within "
+                f"{timeout:g}s; rolled back to PHP {blue.version}."
+            ),
+        )
+
+    nginx_path = Path(domain.nginx_config_path)
+    with locked(vhost_key(domain.hostname), NGINX):
+        blue_nginx = read_file(nginx_path)
+        atomic_write(nginx_path, blue_nginx.replace(blue.socket_path, green.socket_path))
+        nginx_test = test_nginx()
+        switched = signal_nginx("HUP") if nginx_test.success else nginx_test
+        if not switched.success:
+            atomic_write(nginx_path, blue_nginx)
+    if not switched.success:
+        logger.warning("migrate_php_version nginx_switch_failed hostname=%s error=%s", domain.hostname, switched.stderr)
+        _retire_green(domain.hostname, green)
+        return CommandResult(
+            False,
+            stderr=f"Nginx switch failed; rolled back to PHP {blue.version}:\n{switched.stderr}",
+        )
+
+    delay = float(_config_value("PHP_MIGRATION_DRAIN_SECONDS", 30))
+    domain.php_version = green.version
+    domain.php_fpm_pool_path = str(green.pool_path)
+    domain.php_socket_path = green.socket_path
+    drain = PoolDrain(
+        hostname=domain.hostname,
+        php_version=blue.version,
+        fpm_shard=blue.shard,
+        pool_path=str(blue.pool_path),
+        due_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(drain)
+    db.session.commit()
+
+    threading.Thread(
+        target=_drain_blue,
+        args=(current_app._get_current_object(), drain.id, delay),
+        name=f"ezypanel-drain-{domain.hostname}",
+        daemon=True,
+    ).start()
+
+    return CommandResult(
+        True,
+        stdout=(
+            f"Switched to PHP {green.version}; the PHP {blue.version} pool is removed "
+            f"after a {delay:g}s drain."
+        ),
+    )
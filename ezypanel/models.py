@@ -21,14 +21,61 @@ class Domain(db.Model):
     nginx_config_path = db.Column(db.String(512), nullable=False)
     php_fpm_pool_path = db.Column(db.String(512), nullable=False)
     php_socket_path = db.Column(db.String(512), nullable=False)
+    fpm_shard = db.Column(db.Integer)
 
     notes = db.Column(db.Text)
 
+    disk_quota_mb = db.Column(db.Integer)
+    session_backend = db.Column(db.String(32))
+
+    log_rotate_max_mb = db.Column(db.Integer)
+    log_rotate_interval_hours = db.Column(db.Integer)
+    log_rotate_keep = db.Column(db.Integer)
+    snapshot_keep = db.Column(db.Integer)
+
+    cpu_weight = db.Column(db.Integer)
+    cpu_max_percent = db.Column(db.Integer)
+    memory_high_mb = db.Column(db.Integer)
+    memory_max_mb = db.Column(db.Integer)
+    pids_max = db.Column(db.Integer)
+
+    rate_limit_rps = db.Column(db.Integer)
+    rate_limit_burst = db.Column(db.Integer)
+    conn_limit_per_ip = db.Column(db.Integer)
+    conn_limit_total = db.Column(db.Integer)
+    client_max_body_mb = db.Column(db.Integer)
+    slowlog_timeout_s = db.Column(db.Integer)
+
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(
         db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
     )
 
+    disk_usage = db.relationship(
+        "DiskUsage",
+        uselist=False,
+        back_populates="domain",
+        cascade="all, delete-orphan",
+    )
+    rotated_logs = db.relationship(
+        "RotatedLog",
+        back_populates="domain",
+        cascade="all, delete-orphan",
+        order_by="RotatedLog.rotated_at.desc()",
+    )
+    snapshots = db.relationship(
+        "Snapshot",
+        back_populates="domain",
+        cascade="all, delete-orphan",
+        order_by="Snapshot.created_at.desc()",
+    )
+    certificate = db.relationship(
+        "Certificate",
+        uselist=False,
+        back_populates="domain",
+        cascade="all, delete-orphan",
+    )
+
     def __repr__(self) -> str:  # pragma: no cover - debug helper
         return f"<Domain {self.hostname} ({'enabled' if self.enabled else 'disabled'})>"
 
@@ -49,3 +96,167 @@ class Domain(db.Model):
     @property
     def updated_label(self) -> str:
         return self.updated_at.strftime("%Y-%m-%d %H:%M") if self.updated_at else "-"
+
+
+class DiskUsage(db.Model):
+    """Last known disk usage for a domain, refreshed by the disk accounting job.
+
+    Kept apart from ``Domain`` so refreshing usage does not bump
+    ``Domain.updated_at``.
+    """
+
+    __tablename__ = "disk_usage"
+
+    id = db.Column(db.Integer, primary_key=True)
+    domain_id = db.Column(
+        db.Integer, db.ForeignKey("domains.id"), unique=True, nullable=False
+    )
+    total_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    site_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    sessions_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    sessions_files = db.Column(db.Integer, default=0, nullable=False)
+    tmp_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    tmp_files = db.Column(db.Integer, default=0, nullable=False)
+    logs_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    alerts = db.Column(db.JSON, default=list)
+
+    scanned_at = db.Column(db.DateTime)
+    full_scan_at = db.Column(db.DateTime)
+
+    domain = db.relationship("Domain", back_populates="disk_usage")
+
+    @property
+    def total_mb(self) -> float:
+        return round((self.total_bytes or 0) / (1024 * 1024), 1)
+
+    @property
+    def scanned_label(self) -> str:
+        return self.scanned_at.strftime("%Y-%m-%d %H:%M") if self.scanned_at else "-"
+
+
+class RotatedLog(db.Model):
+    """Index of rotated log files so they can be listed without scanning."""
+
+    __tablename__ = "rotated_logs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    domain_id = db.Column(db.Integer, db.ForeignKey("domains.id"), nullable=False, index=True)
+    log_name = db.Column(db.String(255), nullable=False)
+    path = db.Column(db.String(512), nullable=False)
+    size_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    compressed = db.Column(db.Boolean, default=False, nullable=False)
+    rotated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    domain = db.relationship("Domain", back_populates="rotated_logs")
+
+    @property
+    def filename(self) -> str:
+        return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def rotated_label(self) -> str:
+        return self.rotated_at.strftime("%Y-%m-%d %H:%M") if self.rotated_at else "-"
+
+
+class Snapshot(db.Model):
+    """A point-in-time manifest of a domain's document root and configs.
+
+    File contents live once in the content-addressed store; the manifest only
+    maps paths to hashes.
+    """
+
+    __tablename__ = "snapshots"
+
+    id = db.Column(db.Integer, primary_key=True)
+    domain_id = db.Column(db.Integer, db.ForeignKey("domains.id"), nullable=False, index=True)
+    label = db.Column(db.String(255))
+    manifest_path = db.Column(db.String(512), nullable=False)
+    php_version = db.Column(db.String(32), nullable=False)
+    file_count = db.Column(db.Integer, default=0, nullable=False)
+    total_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    stored_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    hashed_files = db.Column(db.Integer, default=0, nullable=False)
+    duration_ms = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    domain = db.relationship("Domain", back_populates="snapshots")
+
+    @property
+    def total_mb(self) -> float:
+        return round((self.total_bytes or 0) / (1024 * 1024), 1)
+
+    @property
+    def stored_mb(self) -> float:
+        return round((self.stored_bytes or 0) / (1024 * 1024), 1)
+
+    @property
+    def created_label(self) -> str:
+        return self.created_at.strftime("%Y-%m-%d %H:%M:%S") if self.created_at else "-"
+
+
+class SnapshotObject(db.Model):
+    """How many snapshot manifests reference a stored object.
+
+    Rows at zero are the only sweep candidates, so pruning never has to read
+    every manifest to find out what is still in use.
+    """
+
+    __tablename__ = "snapshot_objects"
+
+    digest = db.Column(db.String(64), primary_key=True)
+    refcount = db.Column(db.Integer, default=0, nullable=False, index=True)
+
+
+class Certificate(db.Model):
+    """The TLS certificate installed for a domain.
+
+    Doubles as the expiry index: the details are read from the PEM once, when
+    it is installed or re-checked, so listing expiry never parses certificates.
+    """
+
+    __tablename__ = "certificates"
+
+    id = db.Column(db.Integer, primary_key=True)
+    domain_id = db.Column(
+        db.Integer, db.ForeignKey("domains.id"), unique=True, nullable=False
+    )
+    source = db.Column(db.String(32), nullable=False)
+    subject = db.Column(db.String(512))
+    issuer = db.Column(db.String(512))
+    names = db.Column(db.JSON, default=list)
+    fingerprint = db.Column(db.String(128))
+    has_chain = db.Column(db.Boolean, default=False, nullable=False)
+    not_before = db.Column(db.DateTime)
+    not_after = db.Column(db.DateTime, index=True)
+    installed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    checked_at = db.Column(db.DateTime)
+
+    domain = db.relationship("Domain", back_populates="certificate")
+
+    @property
+    def days_left(self) -> int | None:
+        if self.not_after is None:
+            return None
+        return (self.not_after - datetime.utcnow()).days
+
+    @property
+    def expires_label(self) -> str:
+        return self.not_after.strftime("%Y-%m-%d") if self.not_after else "-"
+
+
+class PoolDrain(db.Model):
+    """An old ("blue") PHP-FPM pool waiting to be removed after a version switch.
+
+    Recorded before the drain starts, so a drain cut short by a lock timeout or
+    a worker restart is still finished by the next sweep.
+    """
+
+    __tablename__ = "pool_drains"
+
+    id = db.Column(db.Integer, primary_key=True)
+    hostname = db.Column(db.String(255), nullable=False)
+    php_version = db.Column(db.String(32), nullable=False)
+    fpm_shard = db.Column(db.Integer)
+    pool_path = db.Column(db.String(512), nullable=False)
+    due_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -0,0 +1,409 @@
+from __future__ import annotations
+
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from flask import current_app
+
+from .models import Domain
+
+logger = logging.getLogger(__name__)
+
+# Directives accepted by the pre-validator. This is the stock nginx set used
+# by typical PHP vhosts plus the modules shipped with nginx-extras; add site
+# specific ones through EZYPANEL_NGINX_EXTRA_DIRECTIVES.
+KNOWN_DIRECTIVES = frozenset(
+    """
+    absolute_redirect access_log add_after_body add_before_body add_header
+    add_trailer addition_types aio alias allow ancient_browser auth_basic
+    auth_basic_user_file auth_request auth_request_set autoindex
+    autoindex_exact_size autoindex_format autoindex_localtime break charset
+    charset_types chunked_transfer_encoding client_body_buffer_size
+    client_body_in_file_only client_body_in_single_buffer client_body_temp_path
+    client_body_timeout client_header_buffer_size client_header_timeout
+    client_max_body_size connection_pool_size create_full_put_path
+    default_type deny directio directio_alignment disable_symlinks
+    empty_gif error_log error_page etag expires fastcgi_buffer_size
+    fastcgi_buffering fastcgi_buffers fastcgi_busy_buffers_size fastcgi_cache
+    fastcgi_cache_bypass fastcgi_cache_key fastcgi_cache_lock
+    fastcgi_cache_methods fastcgi_cache_min_uses fastcgi_cache_path
+    fastcgi_cache_revalidate fastcgi_cache_use_stale fastcgi_cache_valid
+    fastcgi_connect_timeout fastcgi_hide_header fastcgi_ignore_client_abort
+    fastcgi_ignore_headers fastcgi_index fastcgi_intercept_errors
+    fastcgi_keep_conn fastcgi_max_temp_file_size fastcgi_no_cache
+    fastcgi_param fastcgi_pass fastcgi_pass_header fastcgi_pass_request_body
+    fastcgi_pass_request_headers fastcgi_read_timeout fastcgi_request_buffering
+    fastcgi_send_timeout fastcgi_split_path_info fastcgi_temp_path geo gzip
+    gzip_buffers gzip_comp_level gzip_disable gzip_http_version
+    gzip_min_length gzip_proxied gzip_static gzip_types gzip_vary hash
+    http2 http2_push_preload if if_modified_since ignore_invalid_headers include
+    index internal ip_hash keepalive keepalive_disable keepalive_requests
+    keepalive_timeout large_client_header_buffers least_conn limit_conn
+    limit_conn_log_level
+    limit_conn_status limit_conn_zone limit_except limit_rate
+    limit_rate_after limit_req limit_req_log_level limit_req_status
+    limit_req_zone lingering_close lingering_time lingering_timeout listen
+    location log_not_found log_subrequest map max_ranges merge_slashes
+    more_clear_headers more_set_headers msie_padding msie_refresh open_file_cache
+    open_file_cache_errors open_file_cache_min_uses open_file_cache_valid
+    output_buffers port_in_redirect postpone_output proxy_buffer_size
+    proxy_buffering proxy_buffers proxy_busy_buffers_size proxy_cache
+    proxy_cache_bypass proxy_cache_key proxy_cache_valid proxy_connect_timeout
+    proxy_cookie_domain proxy_cookie_path proxy_hide_header proxy_http_version
+    proxy_ignore_headers proxy_intercept_errors proxy_next_upstream
+    proxy_pass proxy_pass_header proxy_read_timeout proxy_redirect
+    proxy_request_buffering proxy_send_timeout proxy_set_header
+    proxy_ssl_server_name proxy_ssl_verify read_ahead real_ip_header
+    real_ip_recursive recursive_error_pages referer_hash_bucket_size
+    referer_hash_max_size request_pool_size reset_timedout_connection resolver
+    resolver_timeout return rewrite rewrite_log root satisfy
+    send_lowat send_timeout sendfile sendfile_max_chunk server server_name
+    server_name_in_redirect server_tokens set set_real_ip_from split_clients
+    ssi ssi_types ssl ssl_buffer_size ssl_certificate ssl_certificate_key
+    ssl_ciphers ssl_client_certificate ssl_conf_command ssl_dhparam
+    ssl_early_data ssl_ecdh_curve ssl_password_file ssl_prefer_server_ciphers
+    ssl_protocols ssl_session_cache ssl_session_ticket_key ssl_session_tickets
+    ssl_session_timeout ssl_stapling ssl_stapling_file ssl_stapling_responder
+    ssl_stapling_verify ssl_trusted_certificate ssl_verify_client
+    ssl_verify_depth sub_filter sub_filter_once sub_filter_types
+    subrequest_output_buffer_size tcp_nodelay tcp_nopush try_files types
+    types_hash_bucket_size types_hash_max_size underscores_in_headers
+    uninitialized_variable_warn upstream userid valid_referers
+    variables_hash_bucket_size variables_hash_max_size zone
+    """.split()
+)
+
+# Directives that are only valid with a block.
+BLOCK_DIRECTIVES = frozenset(
+    {"server", "location", "if", "limit_except", "map", "geo", "types", "upstream", "split_clients"}
+)
+
+# Blocks whose bodies are key/value tables rather than directives.
+PARAMETER_BLOCKS = frozenset({"map", "types", "geo", "split_clients"})
+
+# Block directives that are simple directives inside the given parent.
+SIMPLE_IN_PARENT = {"server": frozenset({"upstream"})}
+
+SOCKET_LISTEN_RE = re.compile(r"^\s*listen\s*=\s*(\S+)", re.MULTILINE)
+
+
+class NginxSyntaxError(ValueError):
+    def __init__(self, message: str, line: int) -> None:
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+
+
+@dataclass
+class Token:
+    value: str
+    line: int
+    quoted: bool = False
+
+
+@dataclass
+class Directive:
+    name: str
+    args: list[str]
+    line: int
+    block: list["Directive"] | None = None
+
+
+@dataclass
+class ValidationResult:
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def tokenize(text: str) -> Iterator[Token]:
+    """Split nginx config text into words, ``{``, ``}`` and ``;`` tokens."""
+
+    line = 1
+    index = 0
+    length = len(text)
+    while index < length:
+        char = text[index]
+        if char == "\n":
+            line += 1
+            index += 1
+        elif char.isspace():
+            index += 1
+        elif char == "#":
+            while index < length and text[index] != "\n":
+                index += 1
+        elif char in "{};":
+            yield Token(char, line)
+            index += 1
+        elif char in "\"'":
+            start_line = line
+            quote = char
+            index += 1
+            value = []
+            while True:
+                if index >= length:
+                    raise NginxSyntaxError(f"unterminated {quote} quote", start_line)
+                current = text[index]
+                if current == "\\" and index + 1 < length:
+                    value.append(text[index : index + 2])
+                    index += 2
+                    continue
+                if current == quote:
+                    index += 1
+                    break
+                if current == "\n":
+                    line += 1
+                value.append(current)
+                index += 1
+            yield Token("".join(value), start_line, quoted=True)
+        else:
+            start = index
+            while index < length:
+                current = text[index]
+                if current.isspace() or current in ";\"'":
+                    break
+                if current == "{" and not (index > start and text[index - 1] == "$"):
+                    break
+                if current == "}" and "${" not in text[start:index]:
+                    break
+                if current == "\\" and index + 1 < length:
+                    index += 2
+                    continue
+                index += 1
+            yield Token(text[start:index], line)
+
+
+def parse(text: str) -> list[Directive]:
+    """Parse config text into a directive tree, checking brace balance."""
+
+    root: list[Directive] = []
+    stack: list[tuple[list[Directive], int]] = [(root, 0)]
+    words: list[Token] = []
+
+    for token in tokenize(text):
+        if token.quoted or token.value not in ("{", "}", ";"):
+            words.append(token)
+            continue
+
+        if token.value == ";":
+            if not words:
+                raise NginxSyntaxError("unexpected ';'", token.line)
+            stack[-1][0].append(
+                Directive(words[0].value, [word.value for word in words[1:]], words[0].line)
+            )
+            words = []
+        elif token.value == "{":
+            if not words:
+                raise NginxSyntaxError("unexpected '{'", token.line)
+            directive = Directive(
+                words[0].value, [word.value for word in words[1:]], words[0].line, block=[]
+            )
+            stack[-1][0].append(directive)
+            stack.append((directive.block, token.line))
+            words = []
+        else:
+            if words:
+                raise NginxSyntaxError(
+                    f"directive '{words[0].value}' is not terminated by ';'", words[0].line
+                )
+            if len(stack) == 1:
+                raise NginxSyntaxError("unexpected '}'", token.line)
+            stack.pop()
+
+    if words:
+        raise NginxSyntaxError(
+            f"directive '{words[0].value}' is not terminated by ';'", words[0].line
+        )
+    if len(stack) > 1:
+        raise NginxSyntaxError("unexpected end of file, expecting '}'", stack[-1][1])
+    return root
+
+
+def walk(directives: Iterable[Directive]) -> Iterator[Directive]:
+    for directive in directives:
+        yield directive
+        if directive.block:
+            yield from walk(directive.block)
+
+
+def server_names(directives: Iterable[Directive]) -> set[str]:
+    names: set[str] = set()
+    for directive in walk(directives):
+        if directive.name != "server_name":
+            continue
+        for name in directive.args:
+            # Regex names and the catch-all cannot be compared literally.
+            if not name or name == "_" or name.startswith("~"):
+                continue
+            names.add(name.lower())
+    return names
+
+
+class _FileIndex:
+    """Per-process cache of values extracted from files, keyed by mtime/size.
+
+    Each lookup costs one ``stat``; files are only re-read when they change.
+    """
+
+    def __init__(self, extract) -> None:
+        self._extract = extract
+        self._entries: dict[str, tuple[int, int, frozenset[str]]] = {}
+
+    def get(self, path: str) -> frozenset[str]:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            self._entries.pop(path, None)
+            return frozenset()
+        cached = self._entries.get(path)
+        if cached and cached[0] == stat_result.st_mtime_ns and cached[1] == stat_result.st_size:
+            return cached[2]
+        try:
+            text = Path(path).read_text(encoding="utf-8", errors="replace")
+            values = frozenset(self._extract(text))
+        except (OSError, NginxSyntaxError):
+            values = frozenset()
+        self._entries[path] = (stat_result.st_mtime_ns, stat_result.st_size, values)
+        return values
+
+
+_server_name_index = _FileIndex(lambda text: server_names(parse(text)))
+_pool_socket_index = _FileIndex(lambda text: SOCKET_LISTEN_RE.findall(text))
+
+
+class _ServerNameMap:
+    """Per-process map of ``server_name`` to the domains whose vhost claims it.
+
+    Vhosts are replaced by rename (``atomic_write``), which bumps their
+    directory's mtime in every process, so the map is only rebuilt when a
+    vhost directory or the domain list changed: one ``stat`` per directory
+    instead of one per vhost on every save.
+    """
+
+    def __init__(self) -> None:
+        self._key: tuple | None = None
+        self._owners: dict[str, list[tuple[int, str]]] = {}
+
+    def invalidate(self) -> None:
+        self._key = None
+
+    def owners(self) -> dict[str, list[tuple[int, str]]]:
+        rows = tuple(
+            tuple(row)
+            for row in Domain.query.with_entities(Domain.id, Domain.hostname, Domain.nginx_config_path)
+            .order_by(Domain.id.asc())
+            .all()
+        )
+        stamps = []
+        for directory in sorted({os.path.dirname(path) for _, _, path in rows}):
+            try:
+                stamps.append((directory, os.stat(directory).st_mtime_ns))
+            except OSError:
+                stamps.append((directory, None))
+        key = (tuple(stamps), rows)
+        if key != self._key:
+            owners: dict[str, list[tuple[int, str]]] = {}
+            for domain_id, hostname, path in rows:
+                for name in _server_name_index.get(path):
+                    owners.setdefault(name, []).append((domain_id, hostname))
+            self._owners = owners
+            self._key = key
+            logger.debug("server_name_map rebuilt vhosts=%s names=%s", len(rows), len(owners))
+        return self._owners
+
+
+_server_name_map = _ServerNameMap()
+
+
+def invalidate_server_names() -> None:
+    """Drop this process's ``server_name`` map after writing a vhost."""
+
+    _server_name_map.invalidate()
+
+
+def _known_directives() -> frozenset[str]:
+    extra = current_app.config.get("NGINX_EXTRA_DIRECTIVES") or ""
+    return KNOWN_DIRECTIVES | {item.strip() for item in extra.split(",") if item.strip()}
+
+
+def _pool_sockets() -> set[str]:
+    sockets = {
+        row.php_socket_path
+        for row in Domain.query.with_entities(Domain.php_socket_path).all()
+        if row.php_socket_path
+    }
+    base_dir = Path(current_app.config["PHP_FPM_BASE_DIR"])
+    for pattern in ("*/pool.d/*.conf", "*/shard-*/pool.d/*.conf"):
+        for pool_file in base_dir.glob(pattern):
+            sockets.update(_pool_socket_index.get(str(pool_file)))
+    return {os.path.normpath(socket) for socket in sockets}
+
+
+def _check_directives(
+    directives: list[Directive], parent: str | None, known: frozenset[str], errors: list[str]
+) -> None:
+    for directive in directives:
+        if directive.name not in known:
+            errors.append(f"line {directive.line}: unknown directive '{directive.name}'")
+        elif (
+            directive.name in BLOCK_DIRECTIVES
+            and directive.block is None
+            and parent not in SIMPLE_IN_PARENT.get(directive.name, ())
+        ):
+            errors.append(f"line {directive.line}: '{directive.name}' requires a block")
+        if directive.block and directive.name not in PARAMETER_BLOCKS:
+            _check_directives(directive.block, directive.name, known, errors)
+
+
+def validate_vhost(content: str, domain: Domain | None = None) -> ValidationResult:
+    """Check a single vhost before it is written and handed to ``nginx -t``.
+
+    Catches unbalanced braces/quotes, unknown directives, ``server_name``
+    values already served by another domain and unix ``fastcgi_pass`` targets
+    that no PHP-FPM pool listens on.
+    """
+
+    result = ValidationResult()
+    try:
+        tree = parse(content)
+    except NginxSyntaxError as exc:
+        result.errors.append(str(exc))
+        return result
+
+    _check_directives(tree, None, _known_directives(), result.errors)
+
+    names = server_names(tree)
+    if names:
+        own_id = domain.id if domain is not None else None
+        owners = _server_name_map.owners()
+        for name in sorted(names):
+            for domain_id, hostname in owners.get(name, ()):
+                if domain_id != own_id:
+                    result.errors.append(f"server_name '{name}' is already used by {hostname}")
+
+    pool_sockets: set[str] | None = None
+    for directive in walk(tree):
+        if directive.name != "fastcgi_pass" or not directive.args:
+            continue
+        target = directive.args[0]
+        if not target.startswith("unix:") or "$" in target:
+            continue
+        if pool_sockets is None:
+            pool_sockets = _pool_sockets()
+        socket_path = os.path.normpath(target[len("unix:"):])
+        if socket_path not in pool_sockets:
+            result.errors.append(
+                f"line {directive.line}: fastcgi_pass {target} matches no PHP-FPM pool"
+            )
+
+    logger.debug(
+        "validate_vhost hostname=%s errors=%s",
+        domain.hostname if domain is not None else "-",
+        len(result.errors),
+    )
+    return result
@@ -1,20 +1,41 @@
 from __future__ import annotations
 
 import logging
+import os
 import re
+import time
 from typing import Iterable
 
-from flask import Blueprint, flash, redirect, render_template, request, url_for
+from flask import Blueprint, abort, current_app, flash, jsonify, redirect, render_template, request, send_file, url_for
+from sqlalchemy.orm import joinedload
 
+from .cgroups import apply_limits, read_usage, remove_cgroup
+from .disk_usage import disk_alerts, refresh_disk_usage, remove_index
 from .extensions import db
-from .models import Domain
+from .fpm_status import hot_frames, read_slowlog, read_samples, saturation, slowlog_timeout, update_slowlog_timeout
+from .health import domain_health, health_report, public_report
+from .locks import LockTimeout
+from .logrotate import domain_log_files, remove_rotated_logs, rotate_logs
+from .models import Domain, RotatedLog, Snapshot
+from .snapshots import (
+    create_snapshot,
+    discard_snapshot,
+    prune_snapshots,
+    remove_snapshots,
+    restore_snapshot,
+    sweep_objects,
+)
+from .sessions import BACKENDS as SESSION_BACKENDS
+from .sessions import migrate_sessions, remove_session_store, session_backend
+from .tls import SOURCES as TLS_SOURCES
+from .tls import import_certificate, remove_certificate, remove_certificate_files, self_signed_certificate
+from .traffic import SETTINGS as TRAFFIC_SETTINGS
+from .traffic import pool_body_limit_mb, rejection_counts, update_traffic_limits
 from .services import (
     COMMON_PHP_EXTENSIONS,
     CommandResult,
-    available_extensions,
     default_php_version,
     detect_php_versions,
-    detect_pool_enabled_extensions,
     disable_domain,
     domain_paths,
     delete_domain_artifacts,
@@ -51,6 +72,12 @@ def _is_valid_hostname(hostname: str) -> bool:
     return True
 
 
+@panel_bp.errorhandler(LockTimeout)
+def lock_timeout(error: LockTimeout):
+    flash(str(error), "warning")
+    return redirect(request.referrer or url_for("panel.dashboard"))
+
+
 def handle_result(result: CommandResult) -> None:
     if result.success:
         flash(result.message or "Operation completed", "success")
@@ -61,15 +88,33 @@ def handle_result(result: CommandResult) -> None:
 @panel_bp.route("/")
 def dashboard():
     logger.debug("dashboard")
-    domains = Domain.query.order_by(Domain.hostname.asc()).all()
+    # Usage comes from the last accounting run; never scan disks per page view.
+    domains = (
+        Domain.query.options(joinedload(Domain.disk_usage), joinedload(Domain.certificate))
+        .order_by(Domain.hostname.asc())
+        .all()
+    )
     php_versions = detect_php_versions()
     return render_template(
         "dashboard.html",
         domains=domains,
         php_versions=php_versions,
+        rejections=rejection_counts(domains),
     )
 
 
+@panel_bp.route("/health/live")
+def health_live():
+    return jsonify(status="ok")
+
+
+@panel_bp.route("/health")
+def health():
+    report = health_report()
+    status_code = 200 if report["status"] == "ok" else 503
+    return jsonify(public_report(report)), status_code
+
+
 @panel_bp.route("/domains/add", methods=["POST"])
 def add_domain():
     hostname = request.form.get("hostname", "").strip().lower()
@@ -100,8 +145,6 @@ def add_domain():
         php_fpm_pool_path=str(paths["php_pool"]),
         php_socket_path=str(paths["php_socket"]),
         notes=notes,
-        sessions=str(paths["sessions"]),
-        tmp=str(paths["tmp"]),
     )
     db.session.add(domain)
     db.session.commit()
@@ -118,19 +161,34 @@ def domain_detail(domain_id: int):
     nginx_config = read_file(domain.nginx_config_path)
     php_config = read_file(domain.php_fpm_pool_path)
     php_versions = detect_php_versions()
-    extensions = available_extensions(domain.php_version)
-    enabled_extensions = detect_pool_enabled_extensions(domain.php_socket_path)
+    # Extensions need `php -m` and a FastCGI round trip; the page fetches
+    # them from the API after it has rendered.
     return render_template(
         "domain_detail.html",
         domain=domain,
         nginx_config=nginx_config,
         php_config=php_config,
         php_versions=php_versions,
-        extensions=extensions,
-        enabled_extensions=enabled_extensions,
+        cgroup_usage=read_usage(domain),
+        session_backends=SESSION_BACKENDS,
+        current_session_backend=session_backend(domain),
+        traffic_defaults={
+            field: current_app.config.get(key) for field, key in TRAFFIC_SETTINGS.items() if key
+        },
+        pool_body_mb=pool_body_limit_mb(domain),
+        rejections=rejection_counts([domain])[domain.id],
+        tls_sources=TLS_SOURCES,
     )
 
 
+@panel_bp.route("/domains/<int:domain_id>/health")
+def domain_health_view(domain_id: int):
+    result = domain_health(domain_id)
+    if result is None:
+        abort(404)
+    return jsonify(result.as_dict()), 200 if result.ok else 503
+
+
 @panel_bp.route("/domains/<int:domain_id>/toggle", methods=["POST"])
 def toggle_domain(domain_id: int):
     domain = Domain.query.get_or_404(domain_id)
@@ -151,6 +209,11 @@ def delete_domain(domain_id: int):
             handle_result(result)
             return redirect(url_for("panel.dashboard"))
 
+    remove_rotated_logs(domain)
+    remove_cgroup(domain)
+    remove_session_store(domain)
+    remove_snapshots(domain)
+    remove_certificate_files(domain)
     cleanup_result = delete_domain_artifacts(domain)
     if not cleanup_result.success:
         handle_result(cleanup_result)
@@ -159,10 +222,285 @@ def delete_domain(domain_id: int):
     hostname = domain.hostname
     db.session.delete(domain)
     db.session.commit()
+    remove_index(hostname)
+    sweep_objects()
     flash(f"Domain {hostname} deleted and all artifacts removed.", "success")
     return redirect(url_for("panel.dashboard"))
 
 
+@panel_bp.route("/domains/<int:domain_id>/disk", methods=["POST"])
+def refresh_disk(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    force = request.form.get("force") == "1"
+    logger.debug("refresh_disk domain_id=%s hostname=%s force=%s", domain_id, domain.hostname, force)
+    usage = refresh_disk_usage(domain, force=force)
+    if usage.alerts:
+        flash("; ".join(usage.alerts), "warning")
+    else:
+        flash(f"Disk usage refreshed: {usage.total_mb} MB", "success")
+    return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/quota", methods=["POST"])
+def update_quota(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    raw = request.form.get("disk_quota_mb", "").strip()
+    if raw and not raw.isdigit():
+        flash("Quota must be a whole number of MB", "danger")
+        return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+    domain.disk_quota_mb = int(raw) if raw and int(raw) > 0 else None
+    if domain.disk_usage is not None:
+        domain.disk_usage.alerts = disk_alerts(domain, domain.disk_usage)
+    db.session.commit()
+    logger.debug("update_quota domain_id=%s hostname=%s quota_mb=%s", domain_id, domain.hostname, domain.disk_quota_mb)
+    flash("Disk quota updated", "success")
+    return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/logs")
+def domain_logs(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    logger.debug("domain_logs domain_id=%s hostname=%s", domain_id, domain.hostname)
+    live_logs = []
+    for log_name, path, _ in domain_log_files(domain):
+        if path.exists():
+            live_logs.append({"name": log_name, "path": str(path), "size_bytes": path.stat().st_size})
+    return render_template("domain_logs.html", domain=domain, live_logs=live_logs)
+
+
+@panel_bp.route("/domains/<int:domain_id>/logs/<int:log_id>")
+def download_log(domain_id: int, log_id: int):
+    rotated = RotatedLog.query.filter_by(id=log_id, domain_id=domain_id).first_or_404()
+    if not os.path.exists(rotated.path):
+        abort(404)
+    return send_file(rotated.path, as_attachment=True, download_name=rotated.filename)
+
+
+@panel_bp.route("/domains/<int:domain_id>/logs/rotate", methods=["POST"])
+def rotate_domain_logs(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    logger.debug("rotate_domain_logs domain_id=%s hostname=%s", domain_id, domain.hostname)
+    handle_result(rotate_logs([domain], force=True))
+    return redirect(url_for("panel.domain_logs", domain_id=domain.id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/logs/settings", methods=["POST"])
+def update_log_settings(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    values = {}
+    for field in ("log_rotate_max_mb", "log_rotate_interval_hours", "log_rotate_keep"):
+        raw = request.form.get(field, "").strip()
+        if raw and not raw.isdigit():
+            flash("Log rotation settings must be whole numbers", "danger")
+            return redirect(url_for("panel.domain_logs", domain_id=domain.id))
+        values[field] = int(raw) if raw else None
+    if values["log_rotate_max_mb"] == 0:
+        # Every non-empty log would be "over" a 0 MB limit on every run.
+        flash("Maximum log size must be at least 1 MB", "danger")
+        return redirect(url_for("panel.domain_logs", domain_id=domain.id))
+
+    for field, value in values.items():
+        setattr(domain, field, value)
+    db.session.commit()
+    logger.debug("update_log_settings domain_id=%s hostname=%s values=%s", domain_id, domain.hostname, values)
+    flash("Log rotation settings updated", "success")
+    return redirect(url_for("panel.domain_logs", domain_id=domain.id))
+
+
+@panel_bp.route("/saturation")
+def saturation_view():
+    domains = Domain.query.order_by(Domain.hostname.asc()).all()
+    pools = saturation([domain.hostname for domain in domains])
+    updated_at = read_samples().get("updated_at")
+    return render_template(
+        "saturation.html",
+        domains=domains,
+        pools=pools,
+        updated_ago=int(time.time() - updated_at) if updated_at else None,
+    )
+
+
+@panel_bp.route("/domains/<int:domain_id>/slowlog")
+def domain_slowlog(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    entries = read_slowlog(domain.hostname)
+    return render_template(
+        "domain_slowlog.html",
+        domain=domain,
+        entries=entries,
+        hot=hot_frames(entries),
+        pool=saturation([domain.hostname])[domain.hostname],
+        timeout=slowlog_timeout(domain),
+    )
+
+
+@panel_bp.route("/domains/<int:domain_id>/slowlog/settings", methods=["POST"])
+def update_slowlog_settings(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    raw = request.form.get("slowlog_timeout_s", "").strip()
+    if raw and (not raw.isdigit() or int(raw) > 3600):
+        flash("Slow request threshold must be a whole number of seconds in 0-3600", "danger")
+        return redirect(url_for("panel.domain_slowlog", domain_id=domain.id))
+    logger.debug("update_slowlog_settings domain_id=%s hostname=%s timeout=%s", domain_id, domain.hostname, raw)
+    handle_result(update_slowlog_timeout(domain, int(raw) if raw else None))
+    return redirect(url_for("panel.domain_slowlog", domain_id=domain.id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/snapshots")
+def domain_snapshots(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    logger.debug("domain_snapshots domain_id=%s hostname=%s", domain_id, domain.hostname)
+    return render_template("domain_snapshots.html", domain=domain)
+
+
+@panel_bp.route("/domains/<int:domain_id>/snapshots", methods=["POST"])
+def take_snapshot(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    label = request.form.get("label", "").strip()[:255]
+    logger.debug("take_snapshot domain_id=%s hostname=%s label=%s", domain_id, domain.hostname, label)
+    handle_result(create_snapshot(domain, label))
+    return redirect(url_for("panel.domain_snapshots", domain_id=domain.id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/snapshots/<int:snapshot_id>/restore", methods=["POST"])
+def restore_domain_snapshot(domain_id: int, snapshot_id: int):
+    snapshot = Snapshot.query.filter_by(id=snapshot_id, domain_id=domain_id).first_or_404()
+    logger.info("restore_snapshot domain_id=%s snapshot_id=%s", domain_id, snapshot_id)
+    handle_result(restore_snapshot(snapshot))
+    return redirect(url_for("panel.domain_snapshots", domain_id=domain_id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/snapshots/<int:snapshot_id>/delete", methods=["POST"])
+def delete_snapshot(domain_id: int, snapshot_id: int):
+    snapshot = Snapshot.query.filter_by(id=snapshot_id, domain_id=domain_id).first_or_404()
+    logger.debug("delete_snapshot domain_id=%s snapshot_id=%s", domain_id, snapshot_id)
+    discard_snapshot(snapshot)
+    flash("Snapshot deleted", "success")
+    return redirect(url_for("panel.domain_snapshots", domain_id=domain_id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/snapshots/settings", methods=["POST"])
+def update_snapshot_settings(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    raw = request.form.get("snapshot_keep", "").strip()
+    if raw and not raw.isdigit():
+        flash("Snapshots to keep must be a whole number", "danger")
+        return redirect(url_for("panel.domain_snapshots", domain_id=domain.id))
+    domain.snapshot_keep = int(raw) if raw else None
+    db.session.commit()
+    removed = prune_snapshots(domain)
+    logger.debug("update_snapshot_settings domain_id=%s keep=%s pruned=%s", domain_id, domain.snapshot_keep, removed)
+    flash("Snapshot retention updated", "success")
+    return redirect(url_for("panel.domain_snapshots", domain_id=domain.id))
+
+
+LIMIT_RANGES = {
+    "cpu_weight": (1, 10000),
+    "cpu_max_percent": (1, 100 * (os.cpu_count() or 1)),
+    "memory_high_mb": (16, None),
+    "memory_max_mb": (16, None),
+    "pids_max": (1, None),
+}
+
+
+@panel_bp.route("/domains/<int:domain_id>/limits", methods=["POST"])
+def update_limits(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    values = {}
+    for field, (low, high) in LIMIT_RANGES.items():
+        raw = request.form.get(field, "").strip()
+        if not raw:
+            values[field] = None
+            continue
+        if not raw.isdigit() or int(raw) < low or (high is not None and int(raw) > high):
+            upper = f"-{high}" if high is not None else "+"
+            flash(f"{field.replace('_', ' ').capitalize()} must be a whole number in {low}{upper}", "danger")
+            return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+        values[field] = int(raw)
+    if values["memory_high_mb"] and values["memory_max_mb"] and values["memory_high_mb"] > values["memory_max_mb"]:
+        flash("Memory high must not exceed memory max", "danger")
+        return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+    for field, value in values.items():
+        setattr(domain, field, value)
+    db.session.commit()
+    logger.debug("update_limits domain_id=%s hostname=%s values=%s", domain_id, domain.hostname, values)
+    handle_result(apply_limits(domain))
+    return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+
+TRAFFIC_RANGES = {
+    "rate_limit_rps": (0, 100000),
+    "rate_limit_burst": (0, 100000),
+    "conn_limit_per_ip": (0, 100000),
+    "conn_limit_total": (0, 1000000),
+    "client_max_body_mb": (0, 100000),
+}
+
+
+@panel_bp.route("/domains/<int:domain_id>/traffic", methods=["POST"])
+def update_traffic(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    values = {}
+    for field, (low, high) in TRAFFIC_RANGES.items():
+        raw = request.form.get(field, "").strip()
+        if not raw:
+            values[field] = None
+            continue
+        if not raw.isdigit() or not low <= int(raw) <= high:
+            flash(f"{field.replace('_', ' ').capitalize()} must be a whole number in {low}-{high}", "danger")
+            return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+        values[field] = int(raw)
+
+    logger.debug("update_traffic domain_id=%s hostname=%s values=%s", domain_id, domain.hostname, values)
+    handle_result(update_traffic_limits(domain, values))
+    return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/tls/import", methods=["POST"])
+def import_tls_certificate(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    certificate_pem = request.form.get("certificate", "")
+    key_pem = request.form.get("private_key", "")
+    chain_pem = request.form.get("chain", "")
+    if not certificate_pem.strip() or not key_pem.strip():
+        flash("Paste both the certificate and its private key", "danger")
+        return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+    logger.debug("import_tls_certificate domain_id=%s hostname=%s", domain_id, domain.hostname)
+    handle_result(import_certificate(domain, certificate_pem, key_pem, chain_pem))
+    return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/tls/self-signed", methods=["POST"])
+def create_self_signed_certificate(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    raw_days = request.form.get("days", "").strip()
+    if raw_days and (not raw_days.isdigit() or not 1 <= int(raw_days) <= 3650):
+        flash("Validity must be a whole number of days in 1-3650", "danger")
+        return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+    logger.debug("create_self_signed_certificate domain_id=%s hostname=%s days=%s", domain_id, domain.hostname, raw_days)
+    handle_result(self_signed_certificate(domain, int(raw_days) if raw_days else None))
+    return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/tls/remove", methods=["POST"])
+def remove_tls_certificate(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    logger.debug("remove_tls_certificate domain_id=%s hostname=%s", domain_id, domain.hostname)
+    handle_result(remove_certificate(domain))
+    return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+
+@panel_bp.route("/domains/<int:domain_id>/sessions", methods=["POST"])
+def update_sessions(domain_id: int):
+    domain = Domain.query.get_or_404(domain_id)
+    backend = request.form.get("session_backend", "")
+    logger.debug("update_sessions domain_id=%s hostname=%s backend=%s", domain_id, domain.hostname, backend)
+    handle_result(migrate_sessions(domain, backend))
+    return redirect(url_for("panel.domain_detail", domain_id=domain.id))
+
+
 @panel_bp.route("/domains/<int:domain_id>/nginx", methods=["POST"])
 def update_nginx(domain_id: int):
     domain = Domain.query.get_or_404(domain_id)
@@ -3,31 +3,23 @@ from __future__ import annotations
 import json
 import logging
 import shutil
-import subprocess
 import os, signal
-from dataclasses import dataclass
+import re
+import tempfile
+import zlib
 from pathlib import Path
-from this import d
 from typing import Iterable, Sequence
 
 from flask import current_app
 
+from .executor import CommandResult, run
 from .extensions import db
+from .locks import NGINX, domain_key, fpm_key, locked, pool_key, vhost_key
 from .models import Domain
+from .nginx_parser import invalidate_server_names, validate_vhost
 
 logger = logging.getLogger(__name__)
 
-@dataclass
-class CommandResult:
-    success: bool
-    stdout: str = ""
-    stderr: str = ""
-
-    @property
-    def message(self) -> str:
-        return self.stdout if self.success else self.stderr or "Command failed"
-
-
 def _config_value(key: str, default=None):
     return current_app.config.get(key, default)
 
@@ -35,32 +27,22 @@ def _config_value(key: str, default=None):
 def _simulate() -> bool:
     return bool(_config_value("SIMULATE_SERVER_COMMANDS", True))
 
-def _run_command(args: Sequence[str]) -> CommandResult:
+def _run_command(args: Sequence[str], timeout: float | None = None) -> CommandResult:
     logger.debug("run_command args=%s simulate=%s", list(args), _simulate())
     if _simulate():
         return CommandResult(True, stdout=f"Simulated: {' '.join(args)}")
 
-    try:
-        completed = subprocess.run(
-            list(args),
-            check=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-    except FileNotFoundError as exc:  # pragma: no cover - depends on system
-        return CommandResult(False, stderr=str(exc))
-
-    success = completed.returncode == 0
-    if success:
-        logger.debug("command_success returncode=%s stdout_len=%s", completed.returncode, len((completed.stdout or "").strip()))
+    result = run(args, timeout=timeout)
+    if result.success:
+        logger.debug("command_success returncode=%s stdout_len=%s duration_ms=%s", result.returncode, len(result.stdout), result.duration_ms)
     else:
         logger.warning(
-            "command_failed returncode=%s stderr=%s",
-            completed.returncode,
-            (completed.stderr or "").strip(),
+            "command_failed returncode=%s signal=%s stderr=%s",
+            result.returncode,
+            result.exit_signal,
+            result.stderr,
         )
-    return CommandResult(success, stdout=completed.stdout.strip(), stderr=completed.stderr.strip())
+    return result
 
 
 COMMON_PHP_EXTENSIONS = [
@@ -102,19 +84,8 @@ def _system_default_php_version() -> str | None:
     if not php_bin:
         return None
 
-    try:
-        completed = subprocess.run(
-            [php_bin, "-r", "echo PHP_MAJOR_VERSION . '.' . PHP_MINOR_VERSION;"],
-            check=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-    except (OSError, ValueError):  # pragma: no cover - depends on system
-        return None
-
-    version = completed.stdout.strip()
-    return version or None
+    result = run([php_bin, "-r", "echo PHP_MAJOR_VERSION . '.' . PHP_MINOR_VERSION;"], timeout=10)
+    return (result.stdout or None) if result.success else None
 
 
 def _system_php_extensions(version: str) -> list[str]:
@@ -124,19 +95,12 @@ def _system_php_extensions(version: str) -> list[str]:
     if not php_path:
         return []
 
-    try:
-        completed = subprocess.run(
-            [php_path, "-m"],
-            check=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-    except OSError:  # pragma: no cover - depends on system
+    result = run([php_path, "-m"], timeout=10)
+    if result.returncode is None:  # pragma: no cover - depends on system
         return []
 
     modules = []
-    for line in completed.stdout.splitlines():
+    for line in result.stdout.splitlines():
         name = line.strip()
         if not name or name.startswith("["):
             continue
@@ -145,7 +109,15 @@ def _system_php_extensions(version: str) -> list[str]:
     return sorted(set(modules))
 
 def _change_ownership(path: Path, user: str, group: str) -> None:
-    subprocess.run(["chown", "-R", f"{user}:{group}", str(path)], check=False)
+    result = run(["chown", "-R", f"{user}:{group}", str(path)], timeout=float(_config_value("CHOWN_TIMEOUT", 300)))
+    if not result.success:
+        logger.warning(
+            "change_ownership_failed path=%s returncode=%s timed_out=%s error=%s",
+            path,
+            result.returncode,
+            result.timed_out,
+            result.stderr,
+        )
 
 def detect_php_versions() -> list[str]:
     if not _simulate():
@@ -192,21 +164,17 @@ def detect_pool_enabled_extensions(socket: str) -> list[str]:
     # Run cgi-fcgi and pass PHP code via STDIN
     try:
         logger.debug("detect_pool_enabled_extensions socket=%s", socket)
-        result = subprocess.run(
+        result = run(
             ["cgi-fcgi", "-bind", "-connect", socket],
-            input=php_code.encode("utf-8"),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            input=php_code,
             env=env,
             timeout=5,
         )
 
-        if result.returncode != 0:
-            raise RuntimeError(
-                f"cgi-fcgi error: {result.stderr.decode('utf-8', errors='ignore')}"
-            )
+        if not result.success:
+            raise RuntimeError(f"cgi-fcgi error: {result.stderr}")
 
-        output = result.stdout.decode("utf-8", errors="ignore")
+        output = result.stdout
 
         # Extract JSON block safely
         # FastCGI outputs headers first, then PHP output
@@ -261,11 +229,99 @@ def _render_template(template: str, context: dict[str, str]) -> str:
     return rendered
 
 
-def domain_paths(hostname: str, php_version: str) -> dict[str, Path]:
+def managed_block(name: str, lines: list[str]) -> list[str]:
+    """Wrap panel-managed config lines in ``# ezypanel:<name>`` markers."""
+
+    return [f"# ezypanel:{name} begin", *lines, f"# ezypanel:{name} end"]
+
+
+def rewrite_managed_block(content: str, name: str, lines: list[str], anchor: re.Pattern[str]) -> str:
+    """Replace a managed block in ``content``, keeping every other line.
+
+    Files without the block (older domains, custom templates) get it right
+    after the first line matching ``anchor``, at that line's indentation.
+    """
+
+    rows = content.splitlines()
+    block = managed_block(name, lines)
+    begin = next((i for i, row in enumerate(rows) if row.strip() == block[0]), None)
+    if begin is not None:
+        end = next((i for i in range(begin, len(rows)) if rows[i].strip() == block[-1]), begin)
+        indent = rows[begin][: len(rows[begin]) - len(rows[begin].lstrip())]
+        rows[begin : end + 1] = [indent + row for row in block]
+        return "\n".join(rows).strip() + "\n"
+
+    for index, row in enumerate(rows):
+        if anchor.match(row):
+            indent = row[: len(row) - len(row.lstrip())]
+            rows[index + 1 : index + 1] = [indent + item for item in block]
+            break
+    return "\n".join(rows).strip() + "\n"
+
+
+def http_include_path(name: str) -> Path:
+    return Path(_config_value("NGINX_HTTP_INCLUDE_DIR")) / name
+
+
+def write_http_include(name: str, content: str) -> bool:
+    """Write a generated http-level nginx include; True when it changed."""
+
+    path = http_include_path(name)
+    if read_file(path) == content:
+        return False
+    atomic_write(path, content)
+    return True
+
+
+def fpm_shard_count() -> int:
+    return max(int(_config_value("PHP_FPM_SHARDS", 1) or 1), 1)
+
+
+def fpm_shard(hostname: str, explicit: int | None = None) -> int | None:
+    """Return the FPM master shard serving ``hostname``, or None when unsharded.
+
+    An explicit placement wins; otherwise the hostname is hashed so the
+    assignment is stable across processes and restarts.
+    """
+
+    count = fpm_shard_count()
+    if count <= 1:
+        return None
+    if explicit is not None:
+        return explicit % count
+    return zlib.crc32(hostname.encode("utf-8")) % count
+
+
+def domain_fpm_shard(domain: Domain) -> int | None:
+    return fpm_shard(domain.hostname, domain.fpm_shard)
+
+
+def php_pool_dir(php_version: str, shard: int | None = None) -> Path:
+    version_dir = Path(_config_value("PHP_FPM_BASE_DIR")) / php_version
+    if shard is None:
+        return version_dir / "pool.d"
+    return version_dir / f"shard-{shard}" / "pool.d"
+
+
+def php_fpm_service_name(php_version: str, shard: int | None = None) -> str:
+    if shard is None:
+        tmpl = _config_value("PHP_FPM_SERVICE_TEMPLATE")
+    else:
+        tmpl = _config_value("PHP_FPM_SHARD_SERVICE_TEMPLATE")
+    return tmpl.format(version=php_version, shard=shard)
+
+
+def domain_paths(hostname: str, php_version: str, shard: int | None = None) -> dict[str, Path]:
+    """Filesystem layout of a domain.
+
+    Pass ``Domain.fpm_shard`` for existing domains: ``None`` falls back to the
+    hash placement and would miss a pool moved by ``place_domain``/rebalance.
+    """
+
     domain_dir = Path(_config_value("DOCUMENT_ROOT_BASE")) / hostname
     doc_root = domain_dir / "public"
     nginx_config = Path(_config_value("NGINX_AVAILABLE_DIR")) / f"{hostname}.conf"
-    php_pool = Path(_config_value("PHP_FPM_BASE_DIR")) / php_version / "pool.d" / f"{hostname}.conf"
+    php_pool = php_pool_dir(php_version, fpm_shard(hostname, shard)) / f"{hostname}.conf"
     php_socket = Path(_config_value("PHP_SOCKET_BASE_DIR")) / f"{hostname}-{php_version}.sock"
     enabled_link = Path(_config_value("NGINX_ENABLED_DIR")) / f"{hostname}.conf"
     log_dir = Path(_config_value("DATA_DIR")) / "logs" / hostname
@@ -350,6 +406,11 @@ def write_default_index(hostname: str, doc_root: Path) -> None:
 
 
 def delete_domain_artifacts(domain: Domain) -> CommandResult:
+    with locked(domain_key(domain.hostname), vhost_key(domain.hostname), pool_key(domain.hostname)):
+        return _delete_domain_artifacts(domain)
+
+
+def _delete_domain_artifacts(domain: Domain) -> CommandResult:
     errors: list[str] = []
 
     def _remove(target: Path, label: str) -> None:
@@ -370,7 +431,7 @@ def delete_domain_artifacts(domain: Domain) -> CommandResult:
     _remove(Path(domain.php_fpm_pool_path), "php-fpm pool config")
     _remove(Path(domain.php_socket_path), "php socket")
 
-    paths = domain_paths(domain.hostname, domain.php_version)
+    paths = domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)
     _remove(paths["enabled_link"], "nginx enabled symlink")
     _remove(paths["log_dir"], "log directory")
 
@@ -388,11 +449,16 @@ def _logs_for_domain(domain: Domain) -> tuple[Path, Path]:
 
 
 def nginx_template(domain: Domain) -> str:
+    from .tls import rewrite_vhost as rewrite_tls
+    from .traffic import rewrite_vhost
+
     access_log, error_log = _logs_for_domain(domain)
     default_template = (
         "server {\n"
         "    listen 80;\n"
+        "    {{TLS}}\n"
         "    server_name {{HOSTNAME}};\n"
+        "    {{TRAFFIC_LIMITS}}\n"
         "    root {{DOCUMENT_ROOT}};\n"
         "    index index.php index.html;\n"
         "\n"
@@ -417,11 +483,19 @@ def nginx_template(domain: Domain) -> str:
         "PHP_SOCKET": domain.php_socket_path,
         "ACCESS_LOG": str(access_log),
         "ERROR_LOG": str(error_log),
+        # Filled in (and re-indented) by the rewrite_vhost helpers, which
+        # also add the blocks to templates without the placeholders.
+        "TRAFFIC_LIMITS": "\n".join(managed_block("traffic", [])),
+        "TLS": "\n".join(managed_block("tls", [])),
     }
-    return _render_template(template, context).strip()
+    return rewrite_tls(rewrite_vhost(_render_template(template, context), domain), domain).strip()
 
 
 def php_fpm_template(domain: Domain) -> str:
+    from .fpm_status import monitoring_directives
+    from .fpm_status import rewrite_pool as rewrite_monitoring
+    from .sessions import rewrite_pool, session_backend, session_directives
+
     user = _config_value("WEB_USER")
     group = _config_value("WEB_GROUP")
     default_template = (
@@ -437,8 +511,12 @@ def php_fpm_template(domain: Domain) -> str:
         "pm.start_servers = 2\n"
         "pm.min_spare_servers = 1\n"
         "pm.max_spare_servers = 3\n"
+        "ping.path = {{PING_PATH}}\n"
+        "ping.response = {{PING_RESPONSE}}\n"
+        "{{MONITORING_DIRECTIVES}}\n"
         "php_admin_value[memory_limit] = 256M\n"
         "php_admin_value[upload_max_filesize] = 50M\n"
+        "{{SESSION_DIRECTIVES}}\n"
     )
     template = _template_text("PHP_FPM_TEMPLATE_PATH", default_template)
     context = {
@@ -446,22 +524,47 @@ def php_fpm_template(domain: Domain) -> str:
         "PHP_SOCKET": domain.php_socket_path,
         "WEB_USER": user,
         "WEB_GROUP": group,
+        "PING_PATH": _config_value("PHP_FPM_PING_PATH", "/ping"),
+        "PING_RESPONSE": _config_value("PHP_FPM_PING_RESPONSE", "pong"),
+        "SESSION_DIRECTIVES": "\n".join(session_directives(domain)),
+        "MONITORING_DIRECTIVES": "\n".join(monitoring_directives(domain)),
     }
-    return _render_template(template, context).strip()
+    # rewrite_pool also fixes open_basedir and templates that still hardcode
+    # their session settings; rewrite_monitoring adds status/slowlog to
+    # templates without the placeholder.
+    content = rewrite_pool(_render_template(template, context), domain, session_backend(domain))
+    return rewrite_monitoring(content, domain).strip()
+
+
+def _unique_tmp(path: Path) -> Path:
+    # Unique per writer so concurrent saves never share a temp file; the
+    # ".tmp" suffix keeps it out of nginx/FPM "*.conf" includes.
+    fd, name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    os.close(fd)
+    return Path(name)
 
 
 def atomic_write(path: Path, content: str) -> None:
     path = Path(path)
     path.parent.mkdir(parents=True, exist_ok=True)
-    tmp_path = path.with_suffix(path.suffix + ".tmp")
     backup_path = path.with_suffix(path.suffix + ".bak")
 
+    mode = 0o644
     if path.exists():
-        shutil.copy2(path, backup_path)
+        mode = path.stat().st_mode & 0o7777
+        backup_tmp = _unique_tmp(path)
+        shutil.copy2(path, backup_tmp)
+        backup_tmp.replace(backup_path)
 
     normalized = content.replace("\r\n", "\n").replace("\r", "\n")
-    tmp_path.write_text(normalized, encoding="utf-8")
-    tmp_path.replace(path)
+    tmp_path = _unique_tmp(path)
+    try:
+        tmp_path.write_text(normalized, encoding="utf-8")
+        os.chmod(tmp_path, mode)
+        tmp_path.replace(path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
 
 
 def read_file(path: str | Path) -> str:
@@ -478,13 +581,32 @@ def test_nginx() -> CommandResult:
 def reload_nginx() -> CommandResult:
     nginx_bin = _config_value("NGINX_BIN")
     supervisorctl = _config_value("SUPERVISOR_CTL")
-    return _run_command([supervisorctl, "restart", nginx_bin])
+    with locked(NGINX):
+        return _run_command([supervisorctl, "restart", Path(nginx_bin).name])
+
+def fpm_lock_key(version: str, shard: int | None = None) -> str:
+    return fpm_key(php_fpm_service_name(version, shard))
+
+def reload_php_fpm(version: str, shard: int | None = None) -> CommandResult:
+    """Gracefully reload one FPM master (USR2) so it re-reads its pools.
+
+    ``supervisorctl reload`` takes no program name (it restarts supervisord
+    itself), so the signal is sent through ``supervisorctl signal``.
+    """
 
-def reload_php_fpm(version: str) -> CommandResult:
-    tmpl = _config_value("PHP_FPM_SERVICE_TEMPLATE")
-    service_name = tmpl.format(version=version)
+    return signal_php_fpm(version, "USR2", shard)
+
+def signal_nginx(sig: str) -> CommandResult:
+    nginx_bin = _config_value("NGINX_BIN")
+    supervisorctl = _config_value("SUPERVISOR_CTL")
+    with locked(NGINX):
+        return _run_command([supervisorctl, "signal", sig, Path(nginx_bin).name])
+
+def signal_php_fpm(version: str, sig: str, shard: int | None = None) -> CommandResult:
+    service_name = php_fpm_service_name(version, shard)
     supervisorctl = _config_value("SUPERVISOR_CTL")
-    return _run_command([supervisorctl, "reload", service_name])
+    with locked(fpm_key(service_name)):
+        return _run_command([supervisorctl, "signal", sig, service_name])
 
 def _create_symlink(source: Path, link: Path) -> None:
     if link.exists() or link.is_symlink():
@@ -496,8 +618,13 @@ def _create_symlink(source: Path, link: Path) -> None:
 
 
 def enable_domain(domain: Domain) -> CommandResult:
+    with locked(domain_key(domain.hostname), vhost_key(domain.hostname), NGINX):
+        return _enable_domain(domain)
+
+
+def _enable_domain(domain: Domain) -> CommandResult:
     logger.info("enable_domain hostname=%s php_version=%s", domain.hostname, domain.php_version)
-    paths = domain_paths(domain.hostname, domain.php_version)
+    paths = domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)
     available = paths["nginx_config"]
     enabled = paths["enabled_link"]
     if not available.exists():
@@ -524,8 +651,13 @@ def enable_domain(domain: Domain) -> CommandResult:
 
 
 def disable_domain(domain: Domain) -> CommandResult:
+    with locked(domain_key(domain.hostname), vhost_key(domain.hostname), NGINX):
+        return _disable_domain(domain)
+
+
+def _disable_domain(domain: Domain) -> CommandResult:
     logger.info("disable_domain hostname=%s php_version=%s", domain.hostname, domain.php_version)
-    paths = domain_paths(domain.hostname, domain.php_version)
+    paths = domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)
     enabled = paths["enabled_link"]
     if enabled.exists() or enabled.is_symlink():
         enabled.unlink()
@@ -544,9 +676,18 @@ def disable_domain(domain: Domain) -> CommandResult:
 
 
 def provision_domain(domain: Domain) -> None:
-    paths = domain_paths(domain.hostname, domain.php_version)
+    hostname = domain.hostname
+    with locked(domain_key(hostname), vhost_key(hostname), pool_key(hostname), NGINX):
+        _provision_domain(domain)
+
+
+def _provision_domain(domain: Domain) -> None:
+    paths = domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)
     ensure_domain_layout(paths)
 
+    from .sessions import ensure_session_layout
+
+    ensure_session_layout(domain)
     _change_ownership(paths["domain_dir"], "www-data", "www-data")
 
     domain.document_root = str(paths["document_root"])
@@ -558,14 +699,33 @@ def provision_domain(domain: Domain) -> None:
 
     write_default_index(domain.hostname, paths["document_root"])
     atomic_write(paths["nginx_config"], nginx_template(domain))
+
+    from .fpm_status import ensure_slowlog_dir
+
+    ensure_slowlog_dir(domain)
     atomic_write(paths["php_pool"], php_fpm_template(domain))
 
+    from .traffic import write_include
+
+    # The vhost may reference a rate zone no other domain uses yet.
+    write_include()
     enable_domain(domain)
 
 
 def save_nginx_config(domain: Domain, content: str) -> CommandResult:
+    with locked(domain_key(domain.hostname), vhost_key(domain.hostname), NGINX):
+        return _save_nginx_config(domain, content)
+
+
+def _save_nginx_config(domain: Domain, content: str) -> CommandResult:
     logger.debug("save_nginx_config hostname=%s path=%s content_len=%s", domain.hostname, domain.nginx_config_path, len(content))
+    # Reject obvious mistakes before the live file is replaced.
+    validation = validate_vhost(content, domain)
+    if not validation.ok:
+        logger.warning("save_nginx_config validation_failed hostname=%s errors=%s", domain.hostname, validation.errors)
+        return CommandResult(False, stderr="Config not saved: " + "; ".join(validation.errors))
     atomic_write(Path(domain.nginx_config_path), content)
+    invalidate_server_names()
     test_result = test_nginx()
     if not test_result.success:
         return CommandResult(False, stderr=f"nginx -t failed: {test_result.stderr}")
@@ -573,75 +733,48 @@ def save_nginx_config(domain: Domain, content: str) -> CommandResult:
 
 
 def save_php_config(domain: Domain, content: str, php_version: str) -> CommandResult:
-    original_version = domain.php_version
-    original_socket = domain.php_socket_path
-    original_pool_path = domain.php_fpm_pool_path
+    hostname = domain.hostname
+    if php_version != domain.php_version:
+        # The migration takes the pool, FPM and nginx locks per step; holding
+        # them while the green pool starts would stall every other domain.
+        keys = [domain_key(hostname)]
+    else:
+        keys = [
+            domain_key(hostname),
+            pool_key(hostname),
+            fpm_lock_key(domain.php_version, domain_fpm_shard(domain)),
+        ]
+    with locked(*keys):
+        return _save_php_config(domain, content, php_version)
 
+
+def _save_php_config(domain: Domain, content: str, php_version: str) -> CommandResult:
     logger.debug(
         "save_php_config hostname=%s from_version=%s to_version=%s content_len=%s",
         domain.hostname,
-        original_version,
+        domain.php_version,
         php_version,
         len(content),
     )
 
     #
-    # 1. Handle version change
+    # 1. Version changes go through the blue/green migration
     #
-    if php_version != original_version:
-        paths = domain_paths(domain.hostname, php_version)
-
-        domain.php_version = php_version
-        domain.php_fpm_pool_path = str(paths["php_pool"])
-        domain.php_socket_path = str(paths["php_socket"])
-        content = content.replace(original_socket, domain.php_socket_path)
+    if php_version != domain.php_version:
+        from .migration import migrate_php_version
 
-        # nginx config path stays the same
-    else:
-        paths = {
-            "php_pool": Path(domain.php_fpm_pool_path),
-            "php_socket": Path(domain.php_socket_path),
-        }
+        return migrate_php_version(domain, content, php_version)
 
     #
     # 2. Write updated PHP-FPM pool config
     #
     atomic_write(Path(domain.php_fpm_pool_path), content)
-    # Remove previous pool file
-    _remove_path(original_pool_path)
-
-    #
-    # 3. If version changed, update nginx socket reference
-    #
-    if php_version != original_version:
-        nginx_path = Path(domain.nginx_config_path)
-        nginx_content = read_file(nginx_path)
-        nginx_content = nginx_content.replace(original_socket, domain.php_socket_path)
-        atomic_write(nginx_path, nginx_content)
-
     db.session.commit()
 
     #
-    # 4. Test Nginx safely (avoid pid lock)
-    #
-    nginx_test = test_nginx()
-
-    if not nginx_test.success:
-        logger.warning("save_php_config nginx_test_failed hostname=%s error=%s", domain.hostname, nginx_test.stderr)
-        return CommandResult(
-            False,
-            stderr=f"Nginx configuration test failed:\n{nginx_test.stderr}",
-        )
-
-    #
-    # 5. Reload nginx normally
-    #
-    reload_nginx()
-
-    #
-    # 6. Reload only this PHP-FPM
+    # 3. Reload only this PHP-FPM
     #
-    reload_result = reload_php_fpm(domain.php_version)
+    reload_result = reload_php_fpm(domain.php_version, domain_fpm_shard(domain))
 
     if not reload_result.success:
         logger.warning("save_php_config php_fpm_reload_failed hostname=%s error=%s", domain.hostname, reload_result.stderr)
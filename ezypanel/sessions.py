@@ -0,0 +1,421 @@
+from __future__ import annotations
+
+import logging
+import os
+import re
+import shutil
+import socket
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+from .extensions import db
+from .locks import domain_key, locked, pool_key
+from .models import Domain
+from .services import (
+    CommandResult,
+    _change_ownership,
+    _config_value,
+    _remove_path,
+    _simulate,
+    atomic_write,
+    domain_fpm_shard,
+    domain_paths,
+    fpm_lock_key,
+    read_file,
+    reload_php_fpm,
+)
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = {
+    "files": "Files",
+    "files-sharded": "Files (sharded directories)",
+    "tmpfs": "Files on tmpfs",
+    "redis": "Redis (unix socket)",
+    "memcached": "Memcached (unix socket)",
+}
+FILE_BACKENDS = ("files", "files-sharded", "tmpfs")
+
+# Pool keys owned by the session backend; rewritten as one block.
+SESSION_KEYS = (
+    "session.save_handler",
+    "session.save_path",
+    "session.gc_probability",
+    "session.sid_bits_per_character",
+    "memcached.sess_prefix",
+)
+DEFAULT_GC_MAXLIFETIME = 1440
+SHARD_CHARS = "0123456789abcdef"
+
+_INI_LINE = re.compile(r"^\s*php(?:_admin)?_(?:value|flag)\[([^\]]+)\]\s*=\s*(.*?)\s*$")
+
+
+@dataclass
+class StoredSession:
+    session_id: str
+    path: Path
+    mtime: float
+
+
+def session_backend(domain: Domain) -> str:
+    return domain.session_backend or _config_value("SESSION_BACKEND", "files")
+
+
+def _shard_depth() -> int:
+    return max(int(_config_value("SESSION_SHARD_DEPTH", 2)), 1)
+
+
+def session_dir(domain: Domain, backend: str | None = None) -> Path | None:
+    """Directory holding session files, or ``None`` for socket backends."""
+
+    backend = backend or session_backend(domain)
+    if backend == "tmpfs":
+        return Path(_config_value("SESSION_TMPFS_DIR")) / domain.hostname
+    if backend in FILE_BACKENDS:
+        return domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)["sessions"]
+    return None
+
+
+def session_directives(domain: Domain, backend: str | None = None) -> list[str]:
+    backend = backend or session_backend(domain)
+    directory = session_dir(domain, backend)
+    values: list[tuple[str, str]]
+    if backend == "files":
+        values = [("session.save_handler", "files"), ("session.save_path", str(directory))]
+    elif backend == "files-sharded":
+        # PHP's own GC cannot walk N;path layouts; `panel sessions-gc` does it.
+        values = [
+            ("session.save_handler", "files"),
+            ("session.save_path", f"{_shard_depth()};{directory}"),
+            ("session.sid_bits_per_character", "4"),
+            ("session.gc_probability", "0"),
+        ]
+    elif backend == "tmpfs":
+        values = [
+            ("session.save_handler", "files"),
+            ("session.save_path", str(directory)),
+            ("session.gc_probability", "0"),
+        ]
+    elif backend == "redis":
+        redis_socket = _config_value("SESSION_REDIS_SOCKET")
+        values = [
+            ("session.save_handler", "redis"),
+            ("session.save_path", f"unix://{redis_socket}?prefix={_redis_prefix(domain)}"),
+            ("session.gc_probability", "0"),
+        ]
+    elif backend == "memcached":
+        values = [
+            ("session.save_handler", "memcached"),
+            ("session.save_path", _config_value("SESSION_MEMCACHED_SOCKET")),
+            ("memcached.sess_prefix", _memcached_prefix(domain)),
+            ("session.gc_probability", "0"),
+        ]
+    else:
+        raise ValueError(f"Unknown session backend {backend!r}")
+    return [f"php_admin_value[{key}] = {value}" for key, value in values]
+
+
+def _redis_prefix(domain: Domain) -> str:
+    return f"PHPREDIS_SESSION:{domain.hostname}:"
+
+
+def _memcached_prefix(domain: Domain) -> str:
+    return f"memc.sess.{domain.hostname}."
+
+
+def _open_basedir(value: str, domain: Domain, backend: str) -> str:
+    tmpfs_root = str(_config_value("SESSION_TMPFS_DIR"))
+    entries = [entry for entry in value.split(":") if entry and not entry.startswith(tmpfs_root)]
+    if backend == "tmpfs":
+        entries.append(f"{session_dir(domain, backend)}/")
+    return ":".join(entries)
+
+
+def rewrite_pool(content: str, domain: Domain, backend: str) -> str:
+    """Replace the session block of a pool config, keeping every other line.
+
+    The new block goes where the first old session directive was, and
+    ``open_basedir`` is widened to the tmpfs directory when needed.
+    """
+
+    lines: list[str] = []
+    insert_at: int | None = None
+    for line in content.splitlines():
+        match = _INI_LINE.match(line)
+        key = match.group(1) if match else None
+        if key in SESSION_KEYS:
+            if insert_at is None:
+                insert_at = len(lines)
+            continue
+        if key == "open_basedir":
+            prefix = line[: line.index("=") + 1]
+            line = f"{prefix} {_open_basedir(match.group(2), domain, backend)}"
+        lines.append(line)
+
+    block = session_directives(domain, backend)
+    if insert_at is None:
+        lines.extend(["", *block])
+    else:
+        lines[insert_at:insert_at] = block
+    return "\n".join(lines).strip() + "\n"
+
+
+def gc_maxlifetime(domain: Domain) -> int:
+    for line in read_file(domain.php_fpm_pool_path).splitlines():
+        match = _INI_LINE.match(line)
+        if match and match.group(1) == "session.gc_maxlifetime" and match.group(2).isdigit():
+            return int(match.group(2))
+    return DEFAULT_GC_MAXLIFETIME
+
+
+def ensure_session_layout(domain: Domain, backend: str | None = None) -> None:
+    """Create the directories a file backend expects (PHP never creates them)."""
+
+    backend = backend or session_backend(domain)
+    directory = session_dir(domain, backend)
+    if directory is None:
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    if backend == "files-sharded":
+        depth = _shard_depth()
+        level = [directory]
+        for _ in range(depth):
+            level = [parent / char for parent in level for char in SHARD_CHARS]
+            for path in level:
+                path.mkdir(exist_ok=True)
+    if not _simulate():
+        os.chmod(directory, 0o700)
+        _change_ownership(directory, _config_value("WEB_USER"), _config_value("WEB_GROUP"))
+
+
+def stored_sessions(domain: Domain, backend: str) -> Iterator[StoredSession]:
+    """Yield the session files of a file backend (sharded layouts recursively)."""
+
+    directory = session_dir(domain, backend)
+    if directory is None or not directory.is_dir():
+        return
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = list(os.scandir(current))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # Only the sharded layout nests session files.
+                if backend == "files-sharded":
+                    stack.append(Path(entry.path))
+            elif entry.name.startswith("sess_"):
+                try:
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                except OSError:
+                    continue
+                yield StoredSession(entry.name[len("sess_"):], Path(entry.path), mtime)
+
+
+def _file_target(domain: Domain, backend: str, session_id: str) -> Path:
+    directory = session_dir(domain, backend)
+    if backend == "files-sharded":
+        for char in session_id[: _shard_depth()]:
+            directory = directory / char
+    return directory / f"sess_{session_id}"
+
+
+class _SocketStore:
+    """Tiny unix-socket client for Redis (RESP) and Memcached (text protocol)."""
+
+    def __init__(self, backend: str, domain: Domain) -> None:
+        self.backend = backend
+        self.domain = domain
+        path = _config_value(
+            "SESSION_REDIS_SOCKET" if backend == "redis" else "SESSION_MEMCACHED_SOCKET"
+        )
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(5)
+        self.sock.connect(path)
+        self.reader = self.sock.makefile("rb")
+
+    def put(self, session_id: str, data: bytes, ttl: int) -> bool:
+        if self.backend == "redis":
+            key = (_redis_prefix(self.domain) + session_id).encode()
+            parts = [b"SETEX", key, str(ttl).encode(), data]
+            payload = b"*%d\r\n" % len(parts) + b"".join(
+                b"$%d\r\n%s\r\n" % (len(part), part) for part in parts
+            )
+            self.sock.sendall(payload)
+            return self.reader.readline().startswith(b"+OK")
+        key = (_memcached_prefix(self.domain) + session_id).encode()
+        self.sock.sendall(b"set %s 0 %d %d\r\n%s\r\n" % (key, ttl, len(data), data))
+        return self.reader.readline().startswith(b"STORED")
+
+    def close(self) -> None:
+        self.reader.close()
+        self.sock.close()
+
+
+def _transfer(domain: Domain, source: str, target: str, since: float | None) -> int:
+    """Copy sessions from a file backend into ``target``; returns the count.
+
+    Socket backends cannot be enumerated portably, so their sessions are not
+    carried over.
+    """
+
+    if source not in FILE_BACKENDS:
+        return 0
+    lifetime = gc_maxlifetime(domain)
+    now = time.time()
+    store = None if target in FILE_BACKENDS else _SocketStore(target, domain)
+    copied = 0
+    try:
+        for session in stored_sessions(domain, source):
+            if since is not None and session.mtime < since:
+                continue
+            remaining = int(lifetime - (now - session.mtime))
+            if remaining <= 0:
+                continue
+            if store is None:
+                destination = _file_target(domain, target, session.session_id)
+                if destination == session.path:
+                    continue
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(session.path, destination)
+                copied += 1
+            elif store.put(session.session_id, session.path.read_bytes(), remaining):
+                copied += 1
+    finally:
+        if store is not None:
+            store.close()
+    return copied
+
+
+def _clear_store(domain: Domain, backend: str) -> None:
+    if backend not in FILE_BACKENDS:
+        return
+    directory = session_dir(domain, backend)
+    if backend == "tmpfs":
+        _remove_path(directory)
+        return
+    if directory is None or not directory.is_dir():
+        return
+    for entry in directory.iterdir():
+        # files and files-sharded share a directory: top-level files belong to
+        # the flat layout, one-character subdirectories to the sharded one.
+        if backend == "files" and entry.name.startswith("sess_") and entry.is_file():
+            entry.unlink(missing_ok=True)
+        elif backend == "files-sharded" and entry.is_dir() and len(entry.name) == 1:
+            _remove_path(entry)
+
+
+def migrate_sessions(domain: Domain, backend: str) -> CommandResult:
+    """Switch a domain's session backend and carry live sessions across.
+
+    Sessions are copied once before the pool reload and once more afterwards
+    for anything written in between, so logged-in users stay logged in.
+    """
+
+    keys = (
+        domain_key(domain.hostname),
+        pool_key(domain.hostname),
+        fpm_lock_key(domain.php_version, domain_fpm_shard(domain)),
+    )
+    with locked(*keys):
+        return _migrate_sessions(domain, backend)
+
+
+def _migrate_sessions(domain: Domain, backend: str) -> CommandResult:
+    current = session_backend(domain)
+    if backend not in BACKENDS:
+        return CommandResult(False, stderr=f"Unknown session backend {backend}.")
+    if backend == current:
+        return CommandResult(True, stdout=f"Sessions already use {BACKENDS[backend]}.")
+
+    logger.info("migrate_sessions hostname=%s from=%s to=%s", domain.hostname, current, backend)
+    pool_path = Path(domain.php_fpm_pool_path)
+    original = read_file(pool_path)
+    shard = domain_fpm_shard(domain)
+
+    try:
+        ensure_session_layout(domain, backend)
+        started = time.time()
+        copied = _transfer(domain, current, backend, since=None)
+    except OSError as exc:
+        return CommandResult(False, stderr=f"Session store {backend} is not usable: {exc}")
+
+    atomic_write(pool_path, rewrite_pool(original, domain, backend))
+    reload_result = reload_php_fpm(domain.php_version, shard)
+    if not reload_result.success:
+        atomic_write(pool_path, original)
+        reload_php_fpm(domain.php_version, shard)
+        return CommandResult(False, stderr=f"PHP-FPM reload failed:\n{reload_result.stderr}")
+
+    try:
+        copied += _transfer(domain, current, backend, since=started)
+    except OSError as exc:
+        logger.warning("migrate_sessions catch_up_failed hostname=%s error=%s", domain.hostname, exc)
+    _clear_store(domain, current)
+
+    domain.session_backend = backend
+    db.session.commit()
+
+    message = f"Sessions now use {BACKENDS[backend]}; {copied} session(s) carried over."
+    if current not in FILE_BACKENDS:
+        message = f"Sessions now use {BACKENDS[backend]}; existing {current} sessions were not carried over."
+    return CommandResult(True, stdout=message)
+
+
+def collect_garbage(domain: Domain) -> int:
+    """Delete expired session files for a file backend; returns the count."""
+
+    backend = session_backend(domain)
+    if backend not in FILE_BACKENDS:
+        return 0
+    # tmpfs directories disappear on reboot; recreate them before PHP needs
+    # them. Existing directories are left alone: permissions and ownership
+    # belong to provisioning and backend switches, not to every GC round.
+    if backend == "tmpfs" and not session_dir(domain, backend).is_dir():
+        ensure_session_layout(domain, backend)
+    cutoff = time.time() - gc_maxlifetime(domain)
+    removed = 0
+    for session in stored_sessions(domain, backend):
+        if session.mtime < cutoff:
+            session.path.unlink(missing_ok=True)
+            removed += 1
+    logger.debug("session_gc hostname=%s backend=%s removed=%s", domain.hostname, backend, removed)
+    return removed
+
+
+def collect_all_garbage() -> list[tuple[Domain, int]]:
+    domains = Domain.query.order_by(Domain.hostname.asc()).all()
+    return [(domain, collect_garbage(domain)) for domain in domains]
+
+
+def watch(iterations: int | None = None) -> None:
+    """Run :func:`collect_all_garbage` every ``EZYPANEL_SESSION_GC_INTERVAL`` seconds.
+
+    The backends that turn PHP's own GC off rely on this loop alone.
+    """
+
+    interval = float(_config_value("SESSION_GC_INTERVAL", 600))
+    count = 0
+    while iterations is None or count < iterations:
+        started = time.monotonic()
+        try:
+            removed = sum(removed for _domain, removed in collect_all_garbage())
+            logger.debug("session_gc_round removed=%s", removed)
+        except OSError as exc:
+            logger.warning("session_gc_round failed error=%s", exc)
+        finally:
+            db.session.remove()
+        count += 1
+        if iterations is None or count < iterations:
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+def remove_session_store(domain: Domain) -> None:
+    """Remove session data kept outside the domain directory."""
+
+    if session_backend(domain) == "tmpfs":
+        _remove_path(session_dir(domain, "tmpfs"))
@@ -0,0 +1,591 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import bindparam
+
+from .extensions import db
+from .locks import NGINX, domain_key, locked, pool_key, vhost_key
+from .models import Domain, Snapshot, SnapshotObject
+from .services import (
+    CommandResult,
+    _change_ownership,
+    _config_value,
+    _remove_path,
+    _simulate,
+    atomic_write,
+    domain_fpm_shard,
+    fpm_lock_key,
+    read_file,
+    reload_php_fpm,
+    signal_nginx,
+    test_nginx,
+)
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# Objects younger than this are never swept, so a snapshot that is still
+# being written cannot lose content it has just stored or re-referenced.
+SWEEP_GRACE_SECONDS = 3600
+TEMP_PREFIX = ".ezsnap-"
+# Digests per query when updating reference counts (SQLite's bound-parameter limit).
+REF_BATCH = 500
+
+
+@dataclass
+class ScanStats:
+    file_count: int = 0
+    total_bytes: int = 0
+    stored_bytes: int = 0
+    hashed_files: int = 0
+    # Files deleted between listing and reading them; they are left out.
+    vanished_files: int = 0
+    # Paths that could not be read (permissions); left out and kept on restore.
+    unreadable: list[str] = field(default_factory=list)
+    # Every object written or touched, so a failed snapshot can release them.
+    digests: set[str] = field(default_factory=set)
+
+
+@dataclass
+class Tree:
+    files: dict[str, list] = field(default_factory=dict)
+    dirs: list[str] = field(default_factory=list)
+    symlinks: dict[str, str] = field(default_factory=dict)
+
+
+def _store_root() -> Path:
+    return Path(_config_value("SNAPSHOT_DIR"))
+
+
+def object_path(digest: str) -> Path:
+    return _store_root() / "objects" / digest[:2] / digest[2:]
+
+
+def _ingest(path: Path, stats: ScanStats) -> str:
+    """Hash ``path`` while copying it into the store; returns the digest.
+
+    Hashing and copying happen in one pass so the object name always matches
+    what was stored, even if the source changes mid-read.
+    """
+
+    staging = _store_root() / "objects" / "tmp"
+    staging.mkdir(parents=True, exist_ok=True)
+    tmp_path = staging / f"{os.getpid()}-{time.monotonic_ns()}"
+    digest = hashlib.sha256()
+    with path.open("rb") as src:
+        try:
+            with tmp_path.open("wb") as dst:
+                while chunk := src.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    dst.write(chunk)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    name = digest.hexdigest()
+    target = object_path(name)
+    if target.exists():
+        tmp_path.unlink()
+        os.utime(target)
+    else:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(tmp_path, 0o444)
+        tmp_path.replace(target)
+        stats.stored_bytes += target.stat().st_size
+    stats.hashed_files += 1
+    stats.digests.add(name)
+    return name
+
+
+def _scan_tree(root: Path, previous: Tree | None, stats: ScanStats) -> Tree:
+    """Walk ``root``; files whose size and mtime match ``previous`` reuse its hash.
+
+    A live site keeps changing underneath the walk: entries that vanish are
+    counted and skipped, unreadable ones are recorded in ``stats``.
+    """
+
+    tree = Tree()
+    known = previous.files if previous else {}
+    stack = [""]
+    while stack:
+        relative = stack.pop()
+        try:
+            entries = list(os.scandir(root / relative if relative else root))
+        except FileNotFoundError:
+            continue
+        except PermissionError:
+            if not relative:
+                raise
+            stats.unreadable.append(relative)
+            continue
+        for entry in entries:
+            if entry.name.startswith(TEMP_PREFIX):
+                continue
+            rel = f"{relative}/{entry.name}" if relative else entry.name
+            try:
+                _scan_entry(entry, rel, known, tree, stack, stats)
+            except FileNotFoundError:
+                stats.vanished_files += 1
+            except PermissionError:
+                stats.unreadable.append(rel)
+    tree.dirs.sort()
+    return tree
+
+
+def _scan_entry(entry: os.DirEntry, rel: str, known: dict, tree: Tree, stack: list, stats: ScanStats) -> None:
+    info = entry.stat(follow_symlinks=False)
+    if entry.is_symlink():
+        tree.symlinks[rel] = os.readlink(entry.path)
+    elif entry.is_dir(follow_symlinks=False):
+        tree.dirs.append(rel)
+        stack.append(rel)
+    elif entry.is_file(follow_symlinks=False):
+        before = known.get(rel)
+        if before and before[1] == info.st_size and before[2] == info.st_mtime_ns:
+            digest = before[0]
+        else:
+            digest = _ingest(Path(entry.path), stats)
+        tree.files[rel] = [digest, info.st_size, info.st_mtime_ns, info.st_mode & 0o7777]
+        stats.file_count += 1
+        stats.total_bytes += info.st_size
+
+
+def _write_manifest(hostname: str, manifest: dict) -> Path:
+    directory = _store_root() / "manifests" / hostname
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}.json.gz"
+    tmp_path = path.with_name(path.name + ".tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as handle:
+        json.dump(manifest, handle, separators=(",", ":"))
+    tmp_path.replace(path)
+    return path
+
+
+def load_manifest(snapshot: Snapshot) -> dict:
+    with gzip.open(snapshot.manifest_path, "rt", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def _tree(manifest: dict) -> Tree:
+    return Tree(manifest["files"], manifest["dirs"], manifest["symlinks"])
+
+
+def _config_entry(path: str, stats: ScanStats) -> str | None:
+    config = Path(path)
+    if not config.is_file():
+        return None
+    return _ingest(config, stats)
+
+
+def create_snapshot(domain: Domain, label: str | None = None) -> CommandResult:
+    """Snapshot the document root, nginx vhost and PHP-FPM pool of ``domain``."""
+
+    # Configs must not change mid-snapshot; the document root is not locked.
+    with locked(domain_key(domain.hostname), vhost_key(domain.hostname), pool_key(domain.hostname)):
+        return _create_snapshot(domain, label)
+
+
+def _create_snapshot(domain: Domain, label: str | None) -> CommandResult:
+    started = time.monotonic()
+    latest = domain.snapshots[0] if domain.snapshots else None
+    previous = None
+    if latest is not None:
+        try:
+            previous = _tree(load_manifest(latest))
+        except (OSError, ValueError, KeyError):
+            logger.warning("snapshot previous_manifest_unreadable hostname=%s id=%s", domain.hostname, latest.id)
+
+    stats = ScanStats()
+    try:
+        tree = _scan_tree(Path(domain.document_root), previous, stats)
+        manifest = {
+            "version": 1,
+            "hostname": domain.hostname,
+            "document_root": domain.document_root,
+            "php_version": domain.php_version,
+            "php_socket": domain.php_socket_path,
+            "files": tree.files,
+            "dirs": tree.dirs,
+            "symlinks": tree.symlinks,
+            "unreadable": stats.unreadable,
+            "configs": {
+                "nginx": _config_entry(domain.nginx_config_path, stats),
+                "php": _config_entry(domain.php_fpm_pool_path, stats),
+            },
+        }
+        manifest_path = _write_manifest(domain.hostname, manifest)
+    except OSError as exc:
+        logger.warning("snapshot failed hostname=%s error=%s", domain.hostname, exc)
+        # Objects stored by the failed scan become sweep candidates.
+        _adjust_refs(stats.digests, 0)
+        db.session.commit()
+        return CommandResult(False, stderr=f"Snapshot failed: {exc}")
+
+    duration_ms = int((time.monotonic() - started) * 1000)
+    snapshot = Snapshot(
+        domain=domain,
+        label=label or None,
+        manifest_path=str(manifest_path),
+        php_version=domain.php_version,
+        file_count=stats.file_count,
+        total_bytes=stats.total_bytes,
+        stored_bytes=stats.stored_bytes,
+        hashed_files=stats.hashed_files,
+        duration_ms=duration_ms,
+    )
+    db.session.add(snapshot)
+    _adjust_refs(_manifest_digests(manifest), 1)
+    db.session.commit()
+    logger.info(
+        "snapshot hostname=%s files=%s hashed=%s stored_bytes=%s vanished=%s unreadable=%s duration_ms=%s",
+        domain.hostname,
+        stats.file_count,
+        stats.hashed_files,
+        stats.stored_bytes,
+        stats.vanished_files,
+        len(stats.unreadable),
+        duration_ms,
+    )
+    if stats.unreadable:
+        logger.warning(
+            "snapshot unreadable hostname=%s paths=%s", domain.hostname, ",".join(stats.unreadable[:20])
+        )
+    prune_snapshots(domain)
+    message = (
+        f"Snapshot of {stats.file_count} file(s) taken in {duration_ms / 1000:.1f}s; "
+        f"{stats.hashed_files} hashed, {stats.stored_bytes / 1048576:.1f} MB new."
+    )
+    if stats.vanished_files:
+        message += f" {stats.vanished_files} file(s) vanished during the scan."
+    if stats.unreadable:
+        message += f" Skipped {len(stats.unreadable)} unreadable path(s): {', '.join(stats.unreadable[:5])}."
+    return CommandResult(True, stdout=message)
+
+
+def _materialize(digest: str, target: Path, mode: int, mtime_ns: int) -> None:
+    # Objects are copied, not hardlinked: a site writing to a restored file in
+    # place would otherwise rewrite the shared object for every snapshot.
+    tmp_path = target.with_name(f"{TEMP_PREFIX}{target.name}")
+    shutil.copyfile(object_path(digest), tmp_path)
+    os.chmod(tmp_path, mode)
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    tmp_path.replace(target)
+
+
+def _restore_tree(root: Path, wanted: Tree, unreadable: list[str]) -> int:
+    """Bring ``root`` in line with ``wanted``; only differing files are written.
+
+    Paths the snapshot could not read (``unreadable``) are left as they are.
+    """
+
+    current = _scan_tree_stat(root)
+    skipped = tuple(unreadable)
+    skipped_dirs = tuple(f"{rel}/" for rel in unreadable)
+
+    def kept(rel: str) -> bool:
+        return rel in skipped or rel.startswith(skipped_dirs)
+
+    for rel in set(current.files) | set(current.symlinks):
+        if rel not in wanted.files and rel not in wanted.symlinks and not kept(rel):
+            (root / rel).unlink(missing_ok=True)
+    for rel in sorted(set(current.dirs) - set(wanted.dirs), reverse=True):
+        if not kept(rel):
+            _remove_path(root / rel)
+
+    root.mkdir(parents=True, exist_ok=True)
+    for rel in wanted.dirs:
+        (root / rel).mkdir(parents=True, exist_ok=True)
+
+    written = 0
+    for rel, (digest, size, mtime_ns, mode) in wanted.files.items():
+        have = current.files.get(rel)
+        if have and have[1] == size and have[2] == mtime_ns:
+            continue
+        target = root / rel
+        if target.is_dir() and not target.is_symlink():
+            _remove_path(target)
+        _materialize(digest, target, mode, mtime_ns)
+        written += 1
+    for rel, link in wanted.symlinks.items():
+        target = root / rel
+        if current.symlinks.get(rel) == link:
+            continue
+        _remove_path(target)
+        target.symlink_to(link)
+        written += 1
+    return written
+
+
+def _scan_tree_stat(root: Path) -> Tree:
+    """Like ``_scan_tree`` but without hashing: records size and mtime only."""
+
+    tree = Tree()
+    stack = [""]
+    while stack:
+        relative = stack.pop()
+        try:
+            entries = list(os.scandir(root / relative if relative else root))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            rel = f"{relative}/{entry.name}" if relative else entry.name
+            if entry.is_symlink():
+                tree.symlinks[rel] = os.readlink(entry.path)
+            elif entry.is_dir(follow_symlinks=False):
+                tree.dirs.append(rel)
+                stack.append(rel)
+            else:
+                info = entry.stat(follow_symlinks=False)
+                tree.files[rel] = [None, info.st_size, info.st_mtime_ns, info.st_mode & 0o7777]
+    return tree
+
+
+def _restore_config(path: str, digest: str | None, old_socket: str, new_socket: str) -> str | None:
+    """Write a config from the store; returns the previous content."""
+
+    if digest is None:
+        return None
+    previous = read_file(path)
+    content = object_path(digest).read_text(encoding="utf-8")
+    atomic_write(Path(path), content.replace(old_socket, new_socket))
+    return previous
+
+
+def restore_snapshot(snapshot: Snapshot) -> CommandResult:
+    """Restore files and configs from ``snapshot`` and reload the services.
+
+    Files whose size and mtime already match the snapshot are left alone, so
+    rolling back a small change only rewrites what changed.
+    """
+
+    domain = snapshot.domain
+    hostname = domain.hostname
+    keys = (
+        domain_key(hostname),
+        vhost_key(hostname),
+        pool_key(hostname),
+        fpm_lock_key(domain.php_version, domain_fpm_shard(domain)),
+        NGINX,
+    )
+    with locked(*keys):
+        return _restore_snapshot(snapshot)
+
+
+def _restore_snapshot(snapshot: Snapshot) -> CommandResult:
+    domain = snapshot.domain
+    started = time.monotonic()
+    try:
+        manifest = load_manifest(snapshot)
+        root = Path(domain.document_root)
+        written = _restore_tree(root, _tree(manifest), manifest.get("unreadable", []))
+        if not _simulate():
+            _change_ownership(root, _config_value("WEB_USER"), _config_value("WEB_GROUP"))
+
+        configs = manifest.get("configs", {})
+        old_socket = manifest.get("php_socket", domain.php_socket_path)
+        previous_nginx = _restore_config(
+            domain.nginx_config_path, configs.get("nginx"), old_socket, domain.php_socket_path
+        )
+        _restore_config(
+            domain.php_fpm_pool_path, configs.get("php"), old_socket, domain.php_socket_path
+        )
+    except (OSError, ValueError, KeyError) as exc:
+        logger.warning("snapshot_restore failed hostname=%s id=%s error=%s", domain.hostname, snapshot.id, exc)
+        return CommandResult(False, stderr=f"Restore failed: {exc}")
+
+    nginx_test = test_nginx()
+    if not nginx_test.success:
+        if previous_nginx is not None:
+            atomic_write(Path(domain.nginx_config_path), previous_nginx)
+        return CommandResult(
+            False,
+            stderr=f"Files restored, but the snapshot's nginx config failed validation and was not applied:\n{nginx_test.stderr}",
+        )
+
+    errors = [
+        result.stderr
+        for result in (
+            signal_nginx("HUP"),
+            reload_php_fpm(domain.php_version, domain_fpm_shard(domain)),
+        )
+        if not result.success
+    ]
+    duration_ms = int((time.monotonic() - started) * 1000)
+    logger.info(
+        "snapshot_restore hostname=%s id=%s written=%s duration_ms=%s",
+        domain.hostname,
+        snapshot.id,
+        written,
+        duration_ms,
+    )
+    if errors:
+        return CommandResult(False, stderr="; ".join(errors))
+    return CommandResult(
+        True,
+        stdout=f"Restored snapshot from {snapshot.created_label} ({written} file(s) rewritten in {duration_ms / 1000:.1f}s).",
+    )
+
+
+def _release_refs(snapshot: Snapshot) -> None:
+    try:
+        manifest = load_manifest(snapshot)
+    except (OSError, ValueError):
+        # Its objects stay referenced forever; leaking beats deleting live data.
+        logger.warning("snapshot_release skipped unreadable=%s", snapshot.manifest_path)
+        return
+    _adjust_refs(_manifest_digests(manifest), -1)
+
+
+def _delete_snapshot(snapshot: Snapshot) -> None:
+    _release_refs(snapshot)
+    _remove_path(Path(snapshot.manifest_path))
+    db.session.delete(snapshot)
+
+
+def discard_snapshot(snapshot: Snapshot) -> None:
+    # Reference counts only change under the domain lock, so a snapshot
+    # being taken cannot reuse a digest that is about to drop to zero.
+    with locked(domain_key(snapshot.domain.hostname)):
+        _delete_snapshot(snapshot)
+        db.session.commit()
+        sweep_objects()
+
+
+def prune_snapshots(domain: Domain) -> int:
+    """Apply the retention policy to ``domain``; the newest snapshot always stays."""
+
+    with locked(domain_key(domain.hostname)):
+        return _prune_snapshots(domain)
+
+
+def _prune_snapshots(domain: Domain) -> int:
+    keep = domain.snapshot_keep
+    if keep is None:
+        keep = int(_config_value("SNAPSHOT_KEEP", 10))
+    max_age_days = int(_config_value("SNAPSHOT_MAX_AGE_DAYS", 30))
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days) if max_age_days > 0 else None
+
+    expired = []
+    for index, snapshot in enumerate(domain.snapshots):
+        if index == 0:
+            continue
+        if index >= max(keep, 1) or (cutoff is not None and snapshot.created_at < cutoff):
+            expired.append(snapshot)
+    for snapshot in expired:
+        _delete_snapshot(snapshot)
+    db.session.commit()
+    if expired:
+        sweep_objects()
+    return len(expired)
+
+
+def remove_snapshots(domain: Domain) -> None:
+    """Drop the manifests of a domain being deleted; rows go with the domain."""
+
+    with locked(domain_key(domain.hostname)):
+        for snapshot in domain.snapshots:
+            _release_refs(snapshot)
+        _remove_path(_store_root() / "manifests" / domain.hostname)
+
+
+def _manifest_digests(manifest: dict) -> set[str]:
+    digests = {entry[0] for entry in manifest["files"].values()}
+    digests.update(digest for digest in manifest.get("configs", {}).values() if digest)
+    return digests
+
+
+def _adjust_refs(digests: set[str], delta: int) -> None:
+    """Add ``delta`` to the reference count of each digest; the caller commits.
+
+    Digests not yet indexed get a row, so ``delta=0`` registers objects that
+    nothing references as sweep candidates.
+    """
+
+    table = SnapshotObject.__table__
+    bump = (
+        table.update()
+        .where(table.c.digest == bindparam("ref_digest"))
+        .values(refcount=table.c.refcount + delta)
+    )
+    pending = sorted(digests)
+    for start in range(0, len(pending), REF_BATCH):
+        batch = pending[start : start + REF_BATCH]
+        indexed = {
+            digest
+            for (digest,) in db.session.query(SnapshotObject.digest).filter(SnapshotObject.digest.in_(batch))
+        }
+        if indexed and delta:
+            db.session.execute(bump, [{"ref_digest": digest} for digest in indexed])
+        missing = [digest for digest in batch if digest not in indexed]
+        if missing:
+            db.session.execute(
+                table.insert(), [{"digest": digest, "refcount": max(delta, 0)} for digest in missing]
+            )
+
+
+def rebuild_object_index() -> int:
+    """Recount references from every manifest and index unreferenced objects.
+
+    Run at startup while the index is empty, so stores written before it
+    existed are swept like new ones. Returns the number of indexed objects.
+    """
+
+    counts: dict[str, int] = {}
+    complete = True
+    for snapshot in Snapshot.query.all():
+        try:
+            manifest = load_manifest(snapshot)
+        except (OSError, ValueError):
+            logger.warning("snapshot_index skipped unreadable=%s", snapshot.manifest_path)
+            complete = False
+            continue
+        for digest in _manifest_digests(manifest):
+            counts[digest] = counts.get(digest, 0) + 1
+    if complete:
+        # Only safe when every manifest was read; otherwise an unread one may
+        # still need objects that look orphaned.
+        for bucket in (_store_root() / "objects").glob("??"):
+            for path in bucket.iterdir():
+                counts.setdefault(bucket.name + path.name, 0)
+    SnapshotObject.query.delete()
+    if counts:
+        db.session.execute(
+            SnapshotObject.__table__.insert(),
+            [{"digest": digest, "refcount": count} for digest, count in counts.items()],
+        )
+    db.session.commit()
+    logger.info("snapshot_index objects=%s complete=%s", len(counts), complete)
+    return len(counts)
+
+
+def sweep_objects() -> int:
+    """Delete stored objects whose reference count has dropped to zero."""
+
+    cutoff = time.time() - SWEEP_GRACE_SECONDS
+    removed = 0
+    candidates = [digest for (digest,) in db.session.query(SnapshotObject.digest).filter(SnapshotObject.refcount <= 0)]
+    for digest in candidates:
+        path = object_path(digest)
+        try:
+            if path.stat().st_mtime >= cutoff:
+                # Possibly being re-referenced by a snapshot in progress.
+                continue
+        except FileNotFoundError:
+            pass
+        # Drop the row first and only if it is still unreferenced.
+        if not SnapshotObject.query.filter_by(digest=digest).filter(SnapshotObject.refcount <= 0).delete():
+            continue
+        path.unlink(missing_ok=True)
+        removed += 1
+    db.session.commit()
+    logger.debug("snapshot_sweep removed=%s", removed)
+    return removed
@@ -0,0 +1,445 @@
+from __future__ import annotations
+
+import logging
+import os
+import re
+import ssl
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+
+from .executor import run
+from .extensions import db
+from .locks import NGINX, LockTimeout, domain_key, locked, vhost_key
+from .models import Certificate, Domain
+from .services import (
+    CommandResult,
+    _config_value,
+    _remove_path,
+    atomic_write,
+    http_include_path,
+    read_file,
+    rewrite_managed_block,
+    signal_nginx,
+    test_nginx,
+    write_http_include,
+)
+
+logger = logging.getLogger(__name__)
+
+SOURCES = {
+    "imported": "Imported",
+    "self-signed": "Self-signed",
+}
+INCLUDE_NAME = "tls.conf"
+CERT_FILE = "fullchain.pem"
+KEY_FILE = "privkey.pem"
+CHAIN_FILE = "chain.pem"
+# 80-byte keys give AES-256 tickets (nginx >= 1.11.8).
+TICKET_KEY_BYTES = 80
+
+_PEM_CERT_RE = re.compile(r"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----", re.S)
+_LISTEN_RE = re.compile(r"^\s*listen\b")
+_DNS_RE = re.compile(r"DNS:([^,\s]+)")
+
+
+@dataclass
+class CertificateInfo:
+    subject: str = ""
+    issuer: str = ""
+    names: list[str] = field(default_factory=list)
+    fingerprint: str = ""
+    not_before: datetime | None = None
+    not_after: datetime | None = None
+
+
+def _openssl(args: list[str], stdin: str | None = None) -> CommandResult:
+    # Local crypto only; runs even when server commands are simulated.
+    openssl = _config_value("OPENSSL_BIN", "openssl")
+    result = run([openssl, *args], input=stdin, timeout=30)
+    if result.returncode is None and not result.timed_out:
+        result.stderr = f"openssl failed: {result.stderr}"
+    return result
+
+
+def certificate_dir(hostname: str) -> Path:
+    return Path(_config_value("TLS_DIR")) / "certs" / hostname
+
+
+def ticket_key_paths() -> list[Path]:
+    directory = Path(_config_value("TLS_DIR")) / "tickets"
+    count = max(int(_config_value("TLS_TICKET_KEYS", 3)), 1)
+    return [directory / f"ticket.{index}.key" for index in range(count)]
+
+
+def _cert_time(value: str) -> datetime | None:
+    try:
+        return datetime.utcfromtimestamp(ssl.cert_time_to_seconds(" ".join(value.split())))
+    except ValueError:
+        return None
+
+
+def inspect_certificate(pem: str) -> CertificateInfo | None:
+    """Read subject, names, fingerprint and validity of the first certificate in ``pem``."""
+
+    result = _openssl(
+        [
+            "x509", "-noout", "-nameopt", "RFC2253", "-subject", "-issuer",
+            "-startdate", "-enddate", "-fingerprint", "-sha256", "-ext", "subjectAltName",
+        ],
+        stdin=pem,
+    )
+    if not result.success:
+        logger.debug("inspect_certificate failed error=%s", result.stderr)
+        return None
+
+    info = CertificateInfo()
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition("=")
+        key = key.strip().lower()
+        if key == "subject":
+            info.subject = value.strip()
+        elif key == "issuer":
+            info.issuer = value.strip()
+        elif key == "notbefore":
+            info.not_before = _cert_time(value)
+        elif key == "notafter":
+            info.not_after = _cert_time(value)
+        elif key.endswith("fingerprint"):
+            info.fingerprint = value.strip()
+        info.names.extend(_DNS_RE.findall(line))
+    if not info.names and info.subject.startswith("CN="):
+        info.names.append(info.subject[3:].split(",", 1)[0])
+    return info
+
+
+def covers(names: list[str], hostname: str) -> bool:
+    hostname = hostname.lower()
+    for name in (name.lower() for name in names):
+        if name == hostname:
+            return True
+        if name.startswith("*.") and hostname.count(".") == name.count(".") and hostname.endswith(name[1:]):
+            return True
+    return False
+
+
+def _public_key(args: list[str], pem: str) -> str | None:
+    result = _openssl(args, stdin=pem)
+    return result.stdout if result.success else None
+
+
+def _write_file(path: Path, data: str, mode: int) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            handle.write(data)
+        os.replace(name, path)
+    except BaseException:
+        Path(name).unlink(missing_ok=True)
+        raise
+
+
+def vhost_directives(domain: Domain) -> list[str]:
+    """``listen 443`` and certificate directives, without the block markers."""
+
+    certificate = domain.certificate
+    if certificate is None:
+        return []
+    directory = certificate_dir(domain.hostname)
+    http2 = _config_value("TLS_HTTP2", "listen")
+    lines = ["listen 443 ssl http2;" if http2 == "listen" else "listen 443 ssl;"]
+    if http2 == "directive":
+        # nginx >= 1.25.1 deprecates the listen parameter.
+        lines.append("http2 on;")
+    lines += [
+        f"ssl_certificate {directory / CERT_FILE};",
+        f"ssl_certificate_key {directory / KEY_FILE};",
+    ]
+    if certificate.has_chain and _config_value("TLS_RESOLVER", ""):
+        # nginx needs a resolver to reach the OCSP responder.
+        lines += [
+            "ssl_stapling on;",
+            "ssl_stapling_verify on;",
+            f"ssl_trusted_certificate {directory / CHAIN_FILE};",
+        ]
+    return lines
+
+
+def rewrite_vhost(content: str, domain: Domain) -> str:
+    """Replace the managed TLS block of a vhost (added after the first ``listen``)."""
+
+    return rewrite_managed_block(content, "tls", vhost_directives(domain), _LISTEN_RE)
+
+
+def render_include() -> str:
+    """http-level TLS settings shared by every vhost: session cache and tickets."""
+
+    lines = [
+        "# Generated by ezypanel; changes are overwritten.",
+        "ssl_protocols TLSv1.2 TLSv1.3;",
+        "ssl_prefer_server_ciphers off;",
+        f"ssl_session_cache shared:ezp_tls:{_config_value('TLS_SESSION_CACHE_SIZE', '20m')};",
+        f"ssl_session_timeout {_config_value('TLS_SESSION_TIMEOUT', '1d')};",
+        "ssl_session_tickets on;",
+    ]
+    # nginx encrypts new tickets with the first key and still accepts the
+    # others, so tickets stay valid across one rotation per extra key.
+    lines += [f"ssl_session_ticket_key {path};" for path in ticket_key_paths() if path.exists()]
+    resolver = _config_value("TLS_RESOLVER", "")
+    if resolver:
+        lines += [f"resolver {resolver} valid=300s;", "resolver_timeout 5s;"]
+    return "\n".join(lines) + "\n"
+
+
+def _rotate_keys() -> None:
+    paths = ticket_key_paths()
+    paths[0].parent.mkdir(parents=True, exist_ok=True)
+    os.chmod(paths[0].parent, 0o700)
+    for older, newer in zip(reversed(paths[1:]), reversed(paths[:-1])):
+        if newer.exists():
+            os.replace(newer, older)
+    fd, name = tempfile.mkstemp(dir=paths[0].parent, prefix=".ticket.", suffix=".tmp")
+    with os.fdopen(fd, "wb") as handle:
+        handle.write(os.urandom(TICKET_KEY_BYTES))
+    os.replace(name, paths[0])
+
+
+def ticket_key_age() -> float | None:
+    try:
+        return time.time() - ticket_key_paths()[0].stat().st_mtime
+    except OSError:
+        return None
+
+
+def ensure_ticket_keys() -> None:
+    if ticket_key_age() is None:
+        _rotate_keys()
+
+
+def rotate_ticket_keys(force: bool = False) -> CommandResult:
+    """Start encrypting tickets with a fresh key once the current one is due."""
+
+    interval = float(_config_value("TLS_TICKET_ROTATE_HOURS", 12)) * 3600
+    with locked(NGINX):
+        age = ticket_key_age()
+        if not force and age is not None and age < interval:
+            return CommandResult(True, stdout=f"Ticket key is {age / 3600:.1f}h old; not rotated.")
+        _rotate_keys()
+        write_http_include(INCLUDE_NAME, render_include())
+        # Key files are read at config load; TLS on a host without any
+        # certificate yet does not need a reload.
+        if Certificate.query.count() == 0:
+            return CommandResult(True, stdout="Ticket keys rotated.")
+        test_result = test_nginx()
+        if not test_result.success:
+            return CommandResult(False, stderr=f"nginx -t failed: {test_result.stderr}")
+        reload_result = signal_nginx("HUP")
+        if not reload_result.success:
+            return reload_result
+    logger.info("tls_ticket_rotate keys=%s", len(ticket_key_paths()))
+    return CommandResult(True, stdout="Ticket keys rotated and nginx reloaded.")
+
+
+def watch(iterations: int | None = None) -> None:
+    """Rotate due ticket keys and refresh the expiry index in a loop.
+
+    Runs every ``EZYPANEL_TLS_WATCH_INTERVAL`` seconds; rotation is a no-op
+    until the current key is ``EZYPANEL_TLS_TICKET_ROTATE_HOURS`` old.
+    """
+
+    interval = float(_config_value("TLS_WATCH_INTERVAL", 3600))
+    count = 0
+    while iterations is None or count < iterations:
+        started = time.monotonic()
+        try:
+            result = rotate_ticket_keys()
+            if not result.success:
+                logger.warning("tls_ticket_rotate failed error=%s", result.message)
+            for certificate in refresh_expiry_index():
+                logger.info(
+                    "tls_expiring hostname=%s days_left=%s", certificate.domain.hostname, certificate.days_left
+                )
+        except LockTimeout as exc:
+            logger.warning("tls_watch_round skipped error=%s", exc)
+        finally:
+            db.session.remove()
+        count += 1
+        if iterations is None or count < iterations:
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+def _staged_files(domain: Domain, certificate_pem: str, key_pem: str, chain_pem: str) -> tuple[dict[str, str], CertificateInfo] | str:
+    blocks = _PEM_CERT_RE.findall(certificate_pem)
+    if not blocks:
+        return "No PEM certificate found."
+    # Intermediates pasted after the leaf count as the chain too.
+    chain_blocks = blocks[1:] + _PEM_CERT_RE.findall(chain_pem or "")
+    info = inspect_certificate(blocks[0])
+    if info is None:
+        return "The certificate could not be parsed."
+    if not covers(info.names, domain.hostname):
+        return f"The certificate is for {', '.join(info.names) or info.subject}, not {domain.hostname}."
+    if info.not_after is not None and info.not_after <= datetime.utcnow():
+        return f"The certificate expired on {info.not_after:%Y-%m-%d}."
+
+    cert_key = _public_key(["x509", "-noout", "-pubkey"], blocks[0])
+    private_key = _public_key(["pkey", "-pubout"], key_pem)
+    if private_key is None:
+        return "The private key could not be read (passphrase-protected keys are not supported)."
+    if cert_key != private_key:
+        return "The private key does not belong to the certificate."
+
+    files = {
+        CERT_FILE: "\n".join([blocks[0], *chain_blocks]) + "\n",
+        KEY_FILE: key_pem.strip() + "\n",
+    }
+    if chain_blocks:
+        files[CHAIN_FILE] = "\n".join(chain_blocks) + "\n"
+    return files, info
+
+
+def import_certificate(domain: Domain, certificate_pem: str, key_pem: str, chain_pem: str = "") -> CommandResult:
+    staged = _staged_files(domain, certificate_pem, key_pem, chain_pem)
+    if isinstance(staged, str):
+        return CommandResult(False, stderr=staged)
+    files, info = staged
+    with locked(domain_key(domain.hostname), vhost_key(domain.hostname), NGINX):
+        return _install(domain, "imported", files, info)
+
+
+def self_signed_certificate(domain: Domain, days: int | None = None) -> CommandResult:
+    days = days or int(_config_value("TLS_SELF_SIGNED_DAYS", 365))
+    with tempfile.TemporaryDirectory() as workdir:
+        cert_path = Path(workdir) / "cert.pem"
+        key_path = Path(workdir) / "key.pem"
+        result = _openssl(
+            [
+                "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                "-nodes", "-days", str(days), "-subj", f"/CN={domain.hostname}",
+                "-addext", f"subjectAltName=DNS:{domain.hostname}",
+                "-keyout", str(key_path), "-out", str(cert_path),
+            ]
+        )
+        if not result.success:
+            return CommandResult(False, stderr=f"Could not create a certificate: {result.stderr}")
+        staged = _staged_files(domain, cert_path.read_text(), key_path.read_text(), "")
+    if isinstance(staged, str):
+        return CommandResult(False, stderr=staged)
+    files, info = staged
+    with locked(domain_key(domain.hostname), vhost_key(domain.hostname), NGINX):
+        return _install(domain, "self-signed", files, info)
+
+
+def _apply_vhost(domain: Domain) -> CommandResult:
+    """Re-render the TLS block and include, then test and reload nginx."""
+
+    vhost = Path(domain.nginx_config_path)
+    original = read_file(vhost)
+    previous_include = read_file(http_include_path(INCLUDE_NAME))
+    if original:
+        atomic_write(vhost, rewrite_vhost(original, domain))
+    ensure_ticket_keys()
+    write_http_include(INCLUDE_NAME, render_include())
+
+    test_result = test_nginx()
+    if not test_result.success:
+        if original:
+            atomic_write(vhost, original)
+        if previous_include:
+            atomic_write(http_include_path(INCLUDE_NAME), previous_include)
+        return CommandResult(False, stderr=f"nginx -t failed: {test_result.stderr}")
+    return signal_nginx("HUP")
+
+
+def _install(domain: Domain, source: str, files: dict[str, str], info: CertificateInfo) -> CommandResult:
+    directory = certificate_dir(domain.hostname)
+    directory.mkdir(parents=True, exist_ok=True)
+    os.chmod(directory, 0o750)
+    previous = {name: read_file(directory / name) for name in (CERT_FILE, KEY_FILE, CHAIN_FILE)}
+
+    for name, content in files.items():
+        _write_file(directory / name, content, 0o600 if name == KEY_FILE else 0o644)
+    if CHAIN_FILE not in files:
+        (directory / CHAIN_FILE).unlink(missing_ok=True)
+
+    certificate = domain.certificate
+    if certificate is None:
+        certificate = Certificate()
+        domain.certificate = certificate
+    certificate.source = source
+    certificate.subject = info.subject[:512]
+    certificate.issuer = info.issuer[:512]
+    certificate.names = info.names
+    certificate.fingerprint = info.fingerprint
+    certificate.has_chain = CHAIN_FILE in files
+    certificate.not_before = info.not_before
+    certificate.not_after = info.not_after
+    certificate.installed_at = datetime.utcnow()
+    certificate.checked_at = certificate.installed_at
+
+    result = _apply_vhost(domain)
+    if not result.success:
+        logger.warning("tls_install failed hostname=%s error=%s", domain.hostname, result.stderr)
+        db.session.rollback()
+        for name, content in previous.items():
+            if content:
+                _write_file(directory / name, content, 0o600 if name == KEY_FILE else 0o644)
+            else:
+                (directory / name).unlink(missing_ok=True)
+        return CommandResult(False, stderr=f"Certificate not installed: {result.stderr}")
+
+    db.session.commit()
+    logger.info("tls_install hostname=%s source=%s not_after=%s", domain.hostname, source, info.not_after)
+    return CommandResult(True, stdout=f"{SOURCES[source]} certificate installed; valid until {certificate.expires_label}.")
+
+
+def remove_certificate(domain: Domain) -> CommandResult:
+    with locked(domain_key(domain.hostname), vhost_key(domain.hostname), NGINX):
+        if domain.certificate is None:
+            return CommandResult(True, stdout="No certificate installed.")
+        # delete-orphan removes the row on commit.
+        domain.certificate = None
+        result = _apply_vhost(domain)
+        if not result.success:
+            db.session.rollback()
+            return CommandResult(False, stderr=f"Certificate not removed: {result.stderr}")
+        db.session.commit()
+        remove_certificate_files(domain)
+    return CommandResult(True, stdout="Certificate removed; the domain is served over HTTP only.")
+
+
+def remove_certificate_files(domain: Domain) -> None:
+    error = _remove_path(certificate_dir(domain.hostname))
+    if error:
+        logger.warning("tls_remove failed hostname=%s error=%s", domain.hostname, error)
+
+
+def refresh_expiry_index() -> list[Certificate]:
+    """Re-read every installed certificate (e.g. replaced outside the panel).
+
+    Returns the certificates that expire within ``EZYPANEL_TLS_EXPIRY_WARN_DAYS``.
+    """
+
+    warn_days = int(_config_value("TLS_EXPIRY_WARN_DAYS", 21))
+    expiring = []
+    for certificate in Certificate.query.all():
+        pem = read_file(certificate_dir(certificate.domain.hostname) / CERT_FILE)
+        info = inspect_certificate(pem) if pem else None
+        if info is not None:
+            certificate.subject = info.subject[:512]
+            certificate.issuer = info.issuer[:512]
+            certificate.names = info.names
+            certificate.fingerprint = info.fingerprint
+            certificate.not_before = info.not_before
+            certificate.not_after = info.not_after
+        else:
+            logger.warning("tls_check unreadable hostname=%s", certificate.domain.hostname)
+        certificate.checked_at = datetime.utcnow()
+        if certificate.days_left is not None and certificate.days_left <= warn_days:
+            expiring.append(certificate)
+    db.session.commit()
+    return expiring
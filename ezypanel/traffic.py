@@ -0,0 +1,307 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+from .extensions import db
+from .locks import NGINX, domain_key, locked, vhost_key
+from .models import Domain
+from .services import (
+    CommandResult,
+    _config_value,
+    atomic_write,
+    domain_paths,
+    http_include_path,
+    php_fpm_template,
+    read_file,
+    rewrite_managed_block,
+    signal_nginx,
+    test_nginx,
+    write_http_include,
+)
+
+logger = logging.getLogger(__name__)
+
+# Domain column -> panel-wide default. None on the domain means "use the
+# default"; 0 means "no limit".
+SETTINGS = {
+    "rate_limit_rps": "TRAFFIC_RATE_LIMIT_RPS",
+    "rate_limit_burst": "TRAFFIC_RATE_LIMIT_BURST",
+    "conn_limit_per_ip": "TRAFFIC_CONN_LIMIT_PER_IP",
+    "conn_limit_total": "TRAFFIC_CONN_LIMIT_TOTAL",
+    "client_max_body_mb": None,  # derived from the pool's upload limits
+}
+
+INCLUDE_NAME = "traffic-limits.conf"
+REJECTION_LOG = "limited.log"
+
+# Requests are counted per client *and* vhost, so domains that share a
+# zone (same rate) never eat into each other's budget.
+CLIENT_KEY = "$server_name$binary_remote_addr"
+REQ_ZONE = "ezp_req_{rps}"
+CONN_IP_ZONE = "ezp_conn_ip"
+CONN_VHOST_ZONE = "ezp_conn_vhost"
+
+_REQ_ZONE_RE = re.compile(r"zone=ezp_req_(\d+)\b")
+_SERVER_NAME_RE = re.compile(r"^\s*server_name\b")
+_SIZE_RE = re.compile(r"^\s*php(?:_admin)?_value\[(upload_max_filesize|post_max_size)\]\s*=\s*(\d+)\s*([KMG]?)\s*$", re.I)
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+@dataclass
+class Rejections:
+    rate: int = 0
+    conn: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.rate + self.conn
+
+
+def setting(domain: Domain, attribute: str) -> int | None:
+    value = getattr(domain, attribute)
+    if value is None and SETTINGS[attribute]:
+        value = int(_config_value(SETTINGS[attribute], 0))
+    return value
+
+
+def pool_body_limit_mb(domain: Domain) -> int | None:
+    """Largest of ``upload_max_filesize``/``post_max_size`` in the pool, in MB."""
+
+    content = read_file(domain.php_fpm_pool_path) if domain.php_fpm_pool_path else ""
+    if not content:
+        content = php_fpm_template(domain)
+    sizes = []
+    for line in content.splitlines():
+        match = _SIZE_RE.match(line)
+        if match:
+            sizes.append(int(match.group(2)) * _SIZE_UNITS[match.group(3).upper()])
+    if not sizes:
+        return None
+    return max(math.ceil(max(sizes) / 1024**2), 1)
+
+
+def body_limit_mb(domain: Domain) -> int | None:
+    if domain.client_max_body_mb is not None:
+        return domain.client_max_body_mb
+    return pool_body_limit_mb(domain)
+
+
+def rejection_log(domain: Domain) -> Path:
+    return domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)["log_dir"] / REJECTION_LOG
+
+
+def vhost_directives(domain: Domain) -> list[str]:
+    """Per-vhost limit directives, without the block markers."""
+
+    lines = []
+    rps = setting(domain, "rate_limit_rps")
+    if rps:
+        burst = setting(domain, "rate_limit_burst") or 0
+        lines.append(f"limit_req zone={REQ_ZONE.format(rps=rps)} burst={burst} nodelay;")
+    per_ip = setting(domain, "conn_limit_per_ip")
+    if per_ip:
+        lines.append(f"limit_conn {CONN_IP_ZONE} {per_ip};")
+    total = setting(domain, "conn_limit_total")
+    if total:
+        lines.append(f"limit_conn {CONN_VHOST_ZONE} {total};")
+    body = body_limit_mb(domain)
+    if body is not None:
+        lines.append(f"client_max_body_size {body}m;")
+    if rps or per_ip or total:
+        lines.append(f"access_log {rejection_log(domain)} ezp_limited if=$ezp_limited;")
+    return lines
+
+
+def rewrite_vhost(content: str, domain: Domain) -> str:
+    """Replace the managed traffic block of a vhost (added after ``server_name``)."""
+
+    return rewrite_managed_block(content, "traffic", vhost_directives(domain), _SERVER_NAME_RE)
+
+
+def include_path() -> Path:
+    return http_include_path(INCLUDE_NAME)
+
+
+def _rates_in_use() -> set[int]:
+    rates = {setting(domain, "rate_limit_rps") or 0 for domain in Domain.query.all()}
+    # Vhosts on disk may still point at an older rate (e.g. after the default
+    # changed); keep those zones so nginx -t never breaks on them.
+    available = Path(_config_value("NGINX_AVAILABLE_DIR"))
+    for vhost in available.glob("*.conf"):
+        try:
+            rates.update(int(rps) for rps in _REQ_ZONE_RE.findall(vhost.read_text(errors="replace")))
+        except OSError:
+            continue
+    rates.discard(0)
+    return rates
+
+
+def render_include() -> str:
+    """http-level zones shared by every vhost: one request zone per rate."""
+
+    size = _config_value("TRAFFIC_ZONE_SIZE", "10m")
+    lines = [
+        "# Generated by ezypanel; changes are overwritten.",
+        "limit_req_status 429;",
+        "limit_conn_status 429;",
+        "limit_req_log_level warn;",
+        "limit_conn_log_level warn;",
+        "",
+        'map "$limit_req_status:$limit_conn_status" $ezp_limited {',
+        "    ~REJECTED 1;",
+        "    default 0;",
+        "}",
+        "log_format ezp_limited '$time_iso8601 $remote_addr $limit_req_status "
+        "$limit_conn_status \"$request\"';",
+        "",
+        f"limit_conn_zone {CLIENT_KEY} zone={CONN_IP_ZONE}:{size};",
+        f"limit_conn_zone $server_name zone={CONN_VHOST_ZONE}:1m;",
+    ]
+    for rps in sorted(_rates_in_use()):
+        lines.append(f"limit_req_zone {CLIENT_KEY} zone={REQ_ZONE.format(rps=rps)}:{size} rate={rps}r/s;")
+    return "\n".join(lines) + "\n"
+
+
+def write_include() -> bool:
+    """Write the shared include if it changed; True when it was rewritten."""
+
+    return write_http_include(INCLUDE_NAME, render_include())
+
+
+def update_traffic_limits(domain: Domain, values: dict[str, int | None]) -> CommandResult:
+    with locked(domain_key(domain.hostname), vhost_key(domain.hostname), NGINX):
+        return _update_traffic_limits(domain, values)
+
+
+def _update_traffic_limits(domain: Domain, values: dict[str, int | None]) -> CommandResult:
+    for attribute, value in values.items():
+        setattr(domain, attribute, value)
+
+    include = include_path()
+    previous_include = read_file(include)
+    vhost = Path(domain.nginx_config_path)
+    original = read_file(vhost)
+
+    if original:
+        atomic_write(vhost, rewrite_vhost(original, domain))
+    write_include()
+
+    test_result = test_nginx()
+    if not test_result.success:
+        logger.warning("traffic_limits nginx_test_failed hostname=%s error=%s", domain.hostname, test_result.stderr)
+        if original:
+            atomic_write(vhost, original)
+        if previous_include:
+            atomic_write(include, previous_include)
+        db.session.rollback()
+        return CommandResult(False, stderr=f"nginx -t failed: {test_result.stderr}")
+
+    db.session.commit()
+    reload_result = signal_nginx("HUP")
+    if not reload_result.success:
+        return CommandResult(False, stderr=f"Limits saved but nginx reload failed: {reload_result.stderr}")
+    logger.debug("traffic_limits hostname=%s values=%s", domain.hostname, values)
+    return CommandResult(True, stdout="Traffic limits updated.")
+
+
+def sync_all() -> CommandResult:
+    """Re-render every vhost's traffic block and the shared include.
+
+    Picks up changed panel defaults and pool upload limits.
+    """
+
+    domains = Domain.query.order_by(Domain.hostname.asc()).all()
+    keys = [NGINX]
+    for domain in domains:
+        keys += [domain_key(domain.hostname), vhost_key(domain.hostname)]
+    with locked(*keys):
+        originals = {}
+        for domain in domains:
+            vhost = Path(domain.nginx_config_path)
+            content = read_file(vhost)
+            if not content:
+                continue
+            updated = rewrite_vhost(content, domain)
+            if updated != content:
+                originals[vhost] = content
+                atomic_write(vhost, updated)
+        previous_include = read_file(include_path())
+        if not write_include() and not originals:
+            return CommandResult(True, stdout="Traffic limits already up to date.")
+
+        test_result = test_nginx()
+        if not test_result.success:
+            for vhost, content in originals.items():
+                atomic_write(vhost, content)
+            if previous_include:
+                atomic_write(include_path(), previous_include)
+            return CommandResult(False, stderr=f"nginx -t failed: {test_result.stderr}")
+        reload_result = signal_nginx("HUP")
+        if not reload_result.success:
+            return reload_result
+    return CommandResult(True, stdout=f"Traffic limits synced; {len(originals)} vhost(s) rewritten.")
+
+
+# path -> (inode, offset, counts). Only the bytes appended since the last
+# look are read, so the dashboard stays cheap however large the log grows;
+# rotation (new inode or shorter file) starts the count over.
+_rejection_index: dict[str, tuple[int, int, Rejections]] = {}
+_rejection_lock = threading.Lock()
+REJECTION_READ_CHUNK = 1024 * 1024
+# A huge log seen for the first time is caught up over several looks.
+REJECTION_READ_MAX = 64 * 1024 * 1024
+
+
+def _count_rejections(path: Path) -> Rejections:
+    key = str(path)
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        _rejection_index.pop(key, None)
+        return Rejections()
+
+    inode, offset, counts = _rejection_index.get(key, (stat_result.st_ino, 0, Rejections()))
+    if inode != stat_result.st_ino or stat_result.st_size < offset:
+        offset, counts = 0, Rejections()
+    counts = Rejections(counts.rate, counts.conn)
+    end = min(stat_result.st_size, offset + REJECTION_READ_MAX)
+    if end > offset:
+        with open(path, "rb") as handle:
+            handle.seek(offset)
+            pending = b""
+            while offset + len(pending) < end:
+                chunk = handle.read(min(REJECTION_READ_CHUNK, end - offset - len(pending)))
+                if not chunk:
+                    break
+                pending += chunk
+                # Leave a partially written last line for the next chunk or look.
+                complete = pending.rfind(b"\n") + 1
+                _tally_rejections(pending[:complete], counts)
+                offset += complete
+                pending = pending[complete:]
+    _rejection_index[key] = (stat_result.st_ino, offset, counts)
+    return counts
+
+
+def _tally_rejections(data: bytes, counts: Rejections) -> None:
+    for line in data.splitlines():
+        fields = line.split(b" ", 4)
+        if len(fields) < 4:
+            continue
+        if fields[2].startswith(b"REJECTED"):
+            counts.rate += 1
+        elif fields[3].startswith(b"REJECTED"):
+            counts.conn += 1
+
+
+def rejection_counts(domains: list[Domain]) -> dict[int, Rejections]:
+    """Rejected requests per domain id since the rejection log was last rotated."""
+
+    with _rejection_lock:
+        return {domain.id: _count_rejections(rejection_log(domain)) for domain in domains}
@@ -0,0 +1,20 @@
+"""Gunicorn settings for EzyPanel.
+
+The app is preloaded in the master: directories and the database schema are
+prepared once there, and workers are forked from the fully imported app, so
+booting or respawning a worker costs only a fork.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+# Load .env before ezypanel.config reads the environment.
+load_dotenv()
+
+wsgi_app = "ezypanel:create_app()"
+bind = os.environ.get("EZYPANEL_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("EZYPANEL_WORKERS", "4"))
+preload_app = True
+accesslog = "-"
+errorlog = "-"
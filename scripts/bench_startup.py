@@ -0,0 +1,98 @@
+"""Startup-time guard for EzyPanel.
+
+Measures, in fresh interpreters, how long ``import ezypanel`` and
+``create_app()`` take and checks that importing the package has no side
+effects (no output, no files created). Exits non-zero when a budget is
+exceeded so it can run in CI:
+
+    python scripts/bench_startup.py --runs 5 --import-budget 0.05 --app-budget 1.5
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+PROBE = r"""
+import json, os, sys, time
+start = time.perf_counter()
+import ezypanel
+imported = time.perf_counter()
+app = None
+if sys.argv[1] == "app":
+    app = ezypanel.create_app()
+created = time.perf_counter()
+sys.stderr.write(json.dumps({"import": imported - start, "app": created - imported}))
+"""
+
+
+def _probe(mode: str, data_dir: Path) -> dict[str, float]:
+    env = dict(os.environ)
+    env.update(
+        {
+            "PYTHONPATH": str(ROOT),
+            "EZYPANEL_DATABASE_URI": f"sqlite:///{(data_dir / 'panel.db').as_posix()}",
+            "EZYPANEL_WEBROOT": str(data_dir / "www"),
+            "EZYPANEL_NGINX_AVAILABLE": str(data_dir / "sites-available"),
+            "EZYPANEL_NGINX_ENABLED": str(data_dir / "sites-enabled"),
+            "EZYPANEL_PHP_FPM_BASE": str(data_dir / "php-fpm"),
+            "EZYPANEL_PHP_SOCKET_BASE": str(data_dir / "run"),
+        }
+    )
+    completed = subprocess.run(
+        [sys.executable, "-c", PROBE, mode],
+        cwd=data_dir,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=False,
+    )
+    if completed.returncode != 0:
+        raise SystemExit(f"probe failed:\n{completed.stderr}")
+    if mode == "import" and completed.stdout:
+        raise SystemExit(f"import ezypanel wrote to stdout:\n{completed.stdout}")
+    return json.loads(completed.stderr.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--import-budget", type=float, default=0.05, help="seconds")
+    parser.add_argument("--app-budget", type=float, default=1.5, help="seconds")
+    args = parser.parse_args()
+
+    import_times: list[float] = []
+    app_times: list[float] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = Path(tmp)
+        for _ in range(args.runs):
+            before = sorted(p.name for p in data_dir.iterdir())
+            import_times.append(_probe("import", data_dir)["import"])
+            after = sorted(p.name for p in data_dir.iterdir())
+            if before != after:
+                raise SystemExit(f"import ezypanel created files: {set(after) - set(before)}")
+        for _ in range(args.runs):
+            app_times.append(_probe("app", data_dir)["app"])
+
+    import_median = statistics.median(import_times)
+    app_median = statistics.median(app_times)
+    print(f"import ezypanel: median {import_median * 1000:.1f} ms (budget {args.import_budget * 1000:.0f} ms)")
+    print(f"create_app():    median {app_median * 1000:.1f} ms (budget {args.app_budget * 1000:.0f} ms)")
+
+    failed = import_median > args.import_budget or app_median > args.app_budget
+    if failed:
+        print("startup budget exceeded", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
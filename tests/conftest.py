@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from ezypanel import create_app
+from ezypanel.config import Config
+from ezypanel.extensions import db
+from ezypanel.models import Domain
+
+
+def _test_config(root: Path) -> type[Config]:
+    data = root / "data"
+
+    class TestConfig(Config):
+        TESTING = True
+        SIMULATE_SERVER_COMMANDS = True
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{(root / 'panel.db').as_posix()}"
+        DATA_DIR = data
+        DOCUMENT_ROOT_BASE = data / "var" / "www"
+        NGINX_AVAILABLE_DIR = data / "nginx" / "sites-available"
+        NGINX_ENABLED_DIR = data / "nginx" / "sites-enabled"
+        NGINX_HTTP_INCLUDE_DIR = data / "nginx" / "http.d"
+        PHP_FPM_BASE_DIR = data / "php-fpm"
+        PHP_SOCKET_BASE_DIR = data / "run" / "php"
+        SUPERVISOR_INCLUDE_DIR = data / "supervisor"
+        DISK_USAGE_INDEX_DIR = data / "index" / "disk"
+        FPM_STATUS_FILE = data / "index" / "fpm-status.json"
+        LOCK_DIR = data / "locks"
+        TLS_DIR = data / "tls"
+        SNAPSHOT_DIR = data / "snapshots"
+        SESSION_TMPFS_DIR = data / "shm"
+        CGROUP_MOUNT = data / "cgroup"
+        AVAILABLE_PHP_VERSIONS = "8.2,8.1"
+
+    return TestConfig
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app(_test_config(tmp_path))
+    with app.app_context():
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def add_domain(client):
+    """Add a domain through the panel, the way an operator would."""
+
+    def add(hostname: str = "a.test", php_version: str = "8.2") -> Domain:
+        response = client.post("/panel/domains/add", data={"hostname": hostname, "php_version": php_version})
+        assert response.status_code == 302
+        return Domain.query.filter_by(hostname=hostname).one()
+
+    return add
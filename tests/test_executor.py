@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import sys
+import time
+
+import pytest
+
+from ezypanel import executor
+from ezypanel.executor import _acquire_slot, _Capture, _release_slot, run
+
+
+@pytest.fixture(params=["popen", "posix_spawn"])
+def spawn(app, request):
+    app.config["COMMAND_SPAWN"] = request.param
+    return request.param
+
+
+def test_capture_keeps_the_head_and_counts_the_rest():
+    capture = _Capture(5)
+    for chunk in (b"abc", b"defg", b"hij"):
+        capture.feed(chunk)
+
+    assert bytes(capture.data) == b"abcde"
+    assert capture.dropped == 5
+    assert capture.text() == "abcde\n[... 5 more bytes not captured]"
+
+
+def test_run_reports_output_and_exit_status(spawn):
+    result = run(["sh", "-c", "echo out; echo err >&2; exit 3"])
+
+    assert not result.success
+    assert (result.stdout, result.stderr, result.returncode) == ("out", "err", 3)
+    assert result.message == "err"
+
+
+def test_run_falls_back_to_stdout_for_errors(spawn):
+    result = run(["sh", "-c", "echo 'no such process'; exit 1"])
+
+    assert result.stderr == "no such process"
+
+
+def test_run_feeds_input_larger_than_a_pipe(spawn):
+    payload = "x" * (1024 * 1024)
+
+    result = run(["wc", "-c"], input=payload, max_output_kb=1)
+
+    assert result.success
+    assert result.stdout == str(len(payload))
+
+
+def test_run_caps_captured_output(spawn):
+    result = run(["head", "-c", "5000", "/dev/zero"], max_output_kb=1)
+
+    assert result.success
+    assert result.truncated
+    assert result.stdout.endswith("[... 3976 more bytes not captured]")
+
+
+def test_run_kills_the_process_group_on_timeout(app, spawn):
+    app.config["COMMAND_KILL_GRACE"] = 0.2
+    started = time.monotonic()
+
+    result = run(["sh", "-c", "sleep 30 & sleep 30"], timeout=0.3)
+
+    assert time.monotonic() - started < 5
+    assert result.timed_out
+    assert not result.success
+    assert result.exit_signal is not None
+    assert result.stderr.startswith("sh timed out after 0.3s")
+
+
+def test_run_does_not_wait_for_stray_children(app, spawn):
+    app.config["COMMAND_KILL_GRACE"] = 0.2
+    started = time.monotonic()
+
+    result = run(["sh", "-c", "echo started; sleep 30 & exit 0"], timeout=0.5)
+
+    assert time.monotonic() - started < 5
+    assert result.success
+    assert not result.timed_out
+    assert result.stdout == "started"
+
+
+def test_run_reports_missing_commands(spawn):
+    result = run(["ezypanel-no-such-command"])
+
+    assert not result.success
+    assert "ezypanel-no-such-command" in result.stderr
+
+
+def test_run_uses_cwd(spawn, tmp_path):
+    result = run([sys.executable, "-c", "import os; print(os.getcwd())"], cwd=tmp_path)
+
+    assert result.stdout == str(tmp_path)
+
+
+def test_run_queues_for_a_free_slot(app):
+    app.config["COMMAND_CONCURRENCY"] = 1
+    app.config["COMMAND_QUEUE_TIMEOUT"] = 0.1
+    slot, ok = _acquire_slot(1)
+    assert ok and slot is not None
+    try:
+        result = run(["true"])
+    finally:
+        _release_slot(slot)
+
+    assert not result.success
+    assert result.stderr == "Too many commands running; true was not started."
+    assert run(["true"]).success
+
+
+def test_run_without_a_slot_when_the_lock_dir_is_unusable(app, tmp_path, caplog):
+    blocker = tmp_path / "not-a-directory"
+    blocker.write_text("")
+    app.config["LOCK_DIR"] = blocker
+
+    assert _acquire_slot(1) == (None, True)
+    assert run(["true"]).success
+    assert "command_slot_unavailable" in caplog.text
+
+
+def test_run_without_an_app_context():
+    assert executor._setting("LOCK_DIR") is None
+    assert run(["true"]).success
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import zlib
+from pathlib import Path
+
+import pytest
+
+from ezypanel.fpm_shards import place_domain, planned_moves, rebalance
+from ezypanel.services import domain_fpm_shard, domain_paths, fpm_shard
+
+
+@pytest.fixture
+def sharded(app):
+    app.config["PHP_FPM_SHARDS"] = 4
+    return app
+
+
+def test_hostnames_hash_to_a_stable_shard(sharded):
+    assert fpm_shard("a.test") == zlib.crc32(b"a.test") % 4
+    assert fpm_shard("a.test", 6) == 2
+
+
+def test_unsharded_panels_have_no_shard(app):
+    assert fpm_shard("a.test", 2) is None
+    assert domain_paths("a.test", "8.2", 2)["php_pool"].parent.parent.name == "8.2"
+
+
+def test_new_domains_land_on_their_hash_shard(sharded, add_domain):
+    domain = add_domain("a.test")
+
+    expected = f"shard-{fpm_shard('a.test')}"
+    assert Path(domain.php_fpm_pool_path).parent.parent.name == expected
+    assert Path(domain.php_fpm_pool_path).is_file()
+    assert planned_moves() == []
+
+
+def test_place_domain_moves_the_pool(sharded, add_domain):
+    domain = add_domain("a.test")
+    source = Path(domain.php_fpm_pool_path)
+    content = source.read_text()
+    shard = (fpm_shard("a.test") + 1) % 4
+
+    result = place_domain(domain, shard)
+
+    assert result.success, result.stderr
+    assert domain.fpm_shard == shard == domain_fpm_shard(domain)
+    target = Path(domain.php_fpm_pool_path)
+    assert target.parent.parent.name == f"shard-{shard}"
+    assert target.read_text() == content
+    assert not source.exists()
+    # Every later lookup must follow the explicit placement, not the hash.
+    assert domain_paths(domain.hostname, domain.php_version, domain.fpm_shard)["php_pool"] == target
+    assert planned_moves() == []
+
+
+def test_place_domain_rejects_unknown_shards(sharded, add_domain):
+    domain = add_domain("a.test")
+
+    result = place_domain(domain, 4)
+
+    assert not result.success
+    assert result.stderr == "Shard must be between 0 and 3."
+    assert domain.fpm_shard is None
+
+
+def test_rebalance_follows_a_new_shard_count(app, add_domain):
+    domain = add_domain("a.test")
+    unsharded = Path(domain.php_fpm_pool_path)
+    app.config["PHP_FPM_SHARDS"] = 4
+
+    assert rebalance(dry_run=True).stdout.startswith(f"a.test: {unsharded} -> ")
+    result = rebalance()
+
+    assert result.success, result.stderr
+    assert Path(domain.php_fpm_pool_path).parent.parent.name == f"shard-{fpm_shard('a.test')}"
+    assert not unsharded.exists()
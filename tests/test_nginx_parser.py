@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from ezypanel.nginx_parser import NginxSyntaxError, parse, server_names, validate_vhost
+from ezypanel.services import atomic_write, read_file
+
+
+def test_parse_builds_nested_blocks():
+    tree = parse("server { listen 80; location / { try_files $uri =404; } }")
+
+    assert [directive.name for directive in tree] == ["server"]
+    server = tree[0]
+    assert [directive.name for directive in server.block] == ["listen", "location"]
+    assert server.block[1].args == ["/"]
+    assert server.block[1].block[0].args == ["$uri", "=404"]
+
+
+def test_parse_keeps_variables_with_braces():
+    tree = parse('server { set $x "${host}x"; return 301 https://${host}$request_uri; }')
+
+    assert tree[0].block[1].args == ["301", "https://${host}$request_uri"]
+
+
+@pytest.mark.parametrize(
+    ("text", "message"),
+    [
+        ("server {", "expecting '}'"),
+        ("server { }\n}", "unexpected '}'"),
+        ("server { listen 80 }", "not terminated by ';'"),
+        ('server { return 200 "hi; }', "unterminated \" quote"),
+    ],
+)
+def test_parse_reports_syntax_errors(text, message):
+    with pytest.raises(NginxSyntaxError, match=message):
+        parse(text)
+
+
+def test_server_names_skip_regex_and_catch_all():
+    tree = parse("server { server_name Example.COM www.example.com ~^api\\. _; }")
+
+    assert server_names(tree) == {"example.com", "www.example.com"}
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "types { text/html html; application/json json; }",
+        "map $http_upgrade $connection_upgrade { default upgrade; '' close; }",
+        "geo $trusted { default 0; 10.0.0.0/8 1; }",
+        'split_clients "${remote_addr}" $variant { 50% a; * b; }',
+        "upstream php { server unix:/tmp/php.sock; keepalive 8; least_conn; }",
+    ],
+)
+def test_validate_accepts_parameter_blocks_and_upstream_servers(app, content):
+    assert validate_vhost(content).errors == []
+
+
+def test_validate_still_checks_directives_next_to_parameter_blocks(app):
+    result = validate_vhost("server { types { text/html html; } tryfiles $uri; }")
+
+    assert result.errors == ["line 1: unknown directive 'tryfiles'"]
+
+
+def test_validate_requires_block_for_server_outside_upstream(app):
+    result = validate_vhost("server { listen 80; server unix:/tmp/php.sock; }")
+
+    assert result.errors == ["line 1: 'server' requires a block"]
+
+
+def test_validate_rejects_server_name_of_another_domain(app, add_domain):
+    first = add_domain("a.test")
+    add_domain("b.test")
+    content = read_file(first.nginx_config_path)
+
+    assert validate_vhost(content, first).errors == []
+    clash = content.replace("server_name a.test", "server_name a.test b.test")
+    assert validate_vhost(clash, first).errors == ["server_name 'b.test' is already used by b.test"]
+
+
+def test_validate_sees_vhosts_rewritten_since_the_last_check(app, add_domain):
+    first = add_domain("a.test")
+    second = add_domain("b.test")
+    content = read_file(first.nginx_config_path).replace("server_name a.test", "server_name a.test c.test")
+    assert validate_vhost(content, first).errors == []
+
+    other = read_file(second.nginx_config_path)
+    atomic_write(Path(second.nginx_config_path), other.replace("server_name b.test", "server_name b.test c.test"))
+
+    assert validate_vhost(content, first).errors == ["server_name 'c.test' is already used by b.test"]
+
+
+def test_validate_rejects_fastcgi_pass_to_unknown_socket(app, add_domain):
+    domain = add_domain("a.test")
+    content = read_file(domain.nginx_config_path).replace(domain.php_socket_path, "/tmp/nowhere.sock")
+
+    errors = validate_vhost(content, domain).errors
+    assert len(errors) == 1
+    assert "/tmp/nowhere.sock" in errors[0]
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from ezypanel import snapshots
+from ezypanel.extensions import db
+from ezypanel.models import SnapshotObject
+from ezypanel.snapshots import (
+    create_snapshot,
+    discard_snapshot,
+    load_manifest,
+    object_path,
+    prune_snapshots,
+    rebuild_object_index,
+    restore_snapshot,
+    sweep_objects,
+)
+
+
+@pytest.fixture
+def domain(add_domain, monkeypatch):
+    # Objects are normally kept for an hour after their last use.
+    monkeypatch.setattr(snapshots, "SWEEP_GRACE_SECONDS", -60)
+    domain = add_domain("a.test")
+    root = Path(domain.document_root)
+    (root / "assets").mkdir(parents=True, exist_ok=True)
+    (root / "assets" / "app.css").write_text("body {}\n")
+    (root / "copy.php").write_text((root / "index.php").read_text())
+    return domain
+
+
+def _refcounts() -> dict[str, int]:
+    return {row.digest: row.refcount for row in SnapshotObject.query}
+
+
+def _take(domain):
+    result = create_snapshot(domain)
+    assert result.success, result.stderr
+    return domain.snapshots[0]
+
+
+def test_unchanged_files_are_not_rehashed(domain):
+    first = _take(domain)
+    second = _take(domain)
+
+    assert first.hashed_files == first.file_count + 2
+    assert second.hashed_files == 2  # only the nginx and pool configs
+    assert load_manifest(first)["files"] == load_manifest(second)["files"]
+
+
+def test_identical_files_share_one_object(domain):
+    manifest = load_manifest(_take(domain))
+
+    files = manifest["files"]
+    assert files["copy.php"][0] == files["index.php"][0]
+    assert object_path(files["copy.php"][0]).is_file()
+
+
+def test_refcounts_follow_snapshots(domain):
+    first = _take(domain)
+    digests = snapshots._manifest_digests(load_manifest(first))
+    assert _refcounts() == {digest: 1 for digest in digests}
+
+    Path(domain.document_root, "assets", "app.css").write_text("body { margin: 0 }\n")
+    second = _take(domain)
+    old_css = load_manifest(first)["files"]["assets/app.css"][0]
+    new_css = load_manifest(second)["files"]["assets/app.css"][0]
+    assert _refcounts() == {**{digest: 2 for digest in digests}, old_css: 1, new_css: 1}
+
+    discard_snapshot(first)
+    counts = _refcounts()
+    assert set(counts) == snapshots._manifest_digests(load_manifest(second))
+    assert all(count == 1 for count in counts.values())
+
+
+def test_discarding_the_last_snapshot_sweeps_its_objects(domain):
+    snapshot = _take(domain)
+    paths = [object_path(digest) for digest in snapshots._manifest_digests(load_manifest(snapshot))]
+
+    discard_snapshot(snapshot)
+
+    assert SnapshotObject.query.count() == 0
+    assert not any(path.exists() for path in paths)
+
+
+def test_sweep_keeps_recent_objects(domain, monkeypatch):
+    snapshot = _take(domain)
+    digests = snapshots._manifest_digests(load_manifest(snapshot))
+    monkeypatch.setattr(snapshots, "SWEEP_GRACE_SECONDS", 3600)
+    discard_snapshot(snapshot)
+
+    assert _refcounts() == {digest: 0 for digest in digests}
+    assert all(object_path(digest).exists() for digest in digests)
+    monkeypatch.setattr(snapshots, "SWEEP_GRACE_SECONDS", -60)
+    assert sweep_objects() == len(digests)
+
+
+def test_prune_keeps_the_newest_snapshots(domain):
+    domain.snapshot_keep = 2
+    db.session.commit()
+    for _ in range(3):
+        _take(domain)
+
+    assert len(domain.snapshots) == 2
+    assert prune_snapshots(domain) == 0
+    assert all(count == 2 for count in _refcounts().values())
+
+
+def test_rebuild_object_index_matches_incremental_counts(domain):
+    _take(domain)
+    _take(domain)
+    expected = _refcounts()
+    orphan = object_path("ab" + "0" * 62)
+    orphan.parent.mkdir(parents=True, exist_ok=True)
+    orphan.write_bytes(b"")
+
+    assert rebuild_object_index() == len(expected) + 1
+    assert _refcounts() == {**expected, orphan.parent.name + orphan.name: 0}
+
+
+def test_vanished_and_unreadable_files_are_skipped(domain, monkeypatch):
+    ingest = snapshots._ingest
+
+    def flaky_ingest(path, stats):
+        if path.name == "copy.php":
+            raise FileNotFoundError(path)
+        if path.name == "app.css":
+            raise PermissionError(path)
+        return ingest(path, stats)
+
+    monkeypatch.setattr(snapshots, "_ingest", flaky_ingest)
+    result = create_snapshot(domain)
+
+    assert result.success
+    assert "1 file(s) vanished" in result.stdout
+    assert "assets/app.css" in result.stdout
+    manifest = load_manifest(domain.snapshots[0])
+    assert manifest["unreadable"] == ["assets/app.css"]
+    assert "copy.php" not in manifest["files"]
+    assert "assets/app.css" not in manifest["files"]
+
+
+def test_restore_rewrites_changed_files_and_keeps_unreadable_ones(domain, monkeypatch):
+    root = Path(domain.document_root)
+    ingest = snapshots._ingest
+
+    def unreadable_css(path, stats):
+        if path.name == "app.css":
+            raise PermissionError(path)
+        return ingest(path, stats)
+
+    monkeypatch.setattr(snapshots, "_ingest", unreadable_css)
+    snapshot = _take(domain)
+    original = (root / "index.php").read_text()
+    (root / "index.php").write_text("<?php echo 'changed';\n")
+    (root / "extra.txt").write_text("new\n")
+    (root / "assets" / "app.css").write_text("changed\n")
+
+    result = restore_snapshot(snapshot)
+
+    assert result.success, result.stderr
+    assert (root / "index.php").read_text() == original
+    assert not (root / "extra.txt").exists()
+    assert (root / "assets" / "app.css").read_text() == "changed\n"
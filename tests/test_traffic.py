@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import pytest
+
+from ezypanel import traffic
+from ezypanel.extensions import db
+from ezypanel.nginx_parser import validate_vhost
+from ezypanel.services import read_file
+from ezypanel.traffic import (
+    _count_rejections,
+    render_include,
+    rewrite_vhost,
+    update_traffic_limits,
+    vhost_directives,
+)
+
+RATE = "2026-10-19T10:00:00+00:00 10.0.0.1 REJECTED PASSED \"GET / HTTP/1.1\"\n"
+CONN = "2026-10-19T10:00:00+00:00 10.0.0.1 PASSED REJECTED \"GET / HTTP/1.1\"\n"
+
+
+@pytest.fixture
+def domain(add_domain):
+    return add_domain("a.test")
+
+
+def test_limits_are_off_by_default(domain):
+    directives = vhost_directives(domain)
+
+    assert not any(line.startswith(("limit_req", "limit_conn", "access_log")) for line in directives)
+    assert "limit_req_zone" not in render_include()
+
+
+def test_panel_defaults_apply_until_a_domain_overrides_them(app, domain):
+    app.config["TRAFFIC_RATE_LIMIT_RPS"] = 10
+    app.config["TRAFFIC_CONN_LIMIT_PER_IP"] = 20
+
+    assert vhost_directives(domain)[:2] == [
+        "limit_req zone=ezp_req_10 burst=40 nodelay;",
+        "limit_conn ezp_conn_ip 20;",
+    ]
+    domain.rate_limit_rps = 0
+    domain.conn_limit_total = 100
+    directives = vhost_directives(domain)
+    assert not any(line.startswith("limit_req") for line in directives)
+    assert "limit_conn ezp_conn_vhost 100;" in directives
+    assert directives[-1].startswith(f"access_log {traffic.rejection_log(domain)} ezp_limited")
+
+
+def test_body_limit_follows_the_pool_unless_set(domain):
+    assert f"client_max_body_size {traffic.pool_body_limit_mb(domain)}m;" in vhost_directives(domain)
+
+    domain.client_max_body_mb = 7
+    assert "client_max_body_size 7m;" in vhost_directives(domain)
+
+
+def test_include_has_one_zone_per_rate(add_domain):
+    first = add_domain("a.test")
+    second = add_domain("b.test")
+    third = add_domain("c.test")
+    first.rate_limit_rps = 5
+    second.rate_limit_rps = 5
+    third.rate_limit_rps = 50
+    db.session.commit()
+
+    zones = [line for line in render_include().splitlines() if line.startswith("limit_req_zone")]
+    assert zones == [
+        "limit_req_zone $server_name$binary_remote_addr zone=ezp_req_5:10m rate=5r/s;",
+        "limit_req_zone $server_name$binary_remote_addr zone=ezp_req_50:10m rate=50r/s;",
+    ]
+
+
+def test_rewrite_vhost_replaces_its_block(domain):
+    content = read_file(domain.nginx_config_path)
+    domain.rate_limit_rps = 5
+    once = rewrite_vhost(content, domain)
+    domain.rate_limit_rps = 8
+    twice = rewrite_vhost(once, domain)
+
+    assert "zone=ezp_req_5 " not in twice
+    assert twice.count("zone=ezp_req_8 ") == 1
+    assert rewrite_vhost(twice, domain) == twice
+    assert validate_vhost(twice, domain).errors == []
+
+
+def test_update_traffic_limits_writes_vhost_and_zone(domain):
+    result = update_traffic_limits(domain, {"rate_limit_rps": 3})
+
+    assert result.success, result.stderr
+    assert "limit_req zone=ezp_req_3 " in read_file(domain.nginx_config_path)
+    assert "zone=ezp_req_3:" in read_file(traffic.include_path())
+
+
+def test_rejections_are_counted_incrementally(tmp_path):
+    log = tmp_path / "limited.log"
+    log.write_text(RATE * 2 + CONN)
+    assert (_count_rejections(log).rate, _count_rejections(log).conn) == (2, 1)
+
+    with log.open("a") as handle:
+        handle.write(RATE + CONN[:20])
+    assert _count_rejections(log).total == 4
+    with log.open("a") as handle:
+        handle.write(CONN[20:])
+    assert _count_rejections(log).total == 5
+
+    log.write_text(CONN)  # rotated: shorter than what was read
+    assert _count_rejections(log).total == 1
+
+
+def test_rejection_reads_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(traffic, "REJECTION_READ_CHUNK", 100)
+    monkeypatch.setattr(traffic, "REJECTION_READ_MAX", 10 * len(RATE))
+    log = tmp_path / "limited.log"
+    log.write_text(RATE * 25)
+
+    assert [_count_rejections(log).rate for _ in range(4)] == [10, 20, 25, 25]